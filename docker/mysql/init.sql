@@ -73,6 +73,29 @@ DELIMITER ;
 CALL InsertDummyEvents(5000); -- Changed from 1000 to 5000
 DROP PROCEDURE InsertDummyEvents;
 
+-- Hourly and daily event counts per tenant, ad and event type, maintained by the FastAPI events sink
+-- in the same transaction as the events it inserts. Reports read these instead of scanning events.
+CREATE TABLE IF NOT EXISTS event_rollups (
+    tenant_id BIGINT UNSIGNED NOT NULL,
+    granularity VARCHAR(8) NOT NULL, -- 'hour' or 'day'
+    bucket DATETIME NOT NULL, -- Start of the hour or day
+    ad_id BIGINT UNSIGNED NOT NULL,
+    event_type VARCHAR(32) NOT NULL,
+    count BIGINT UNSIGNED NOT NULL DEFAULT 0,
+    PRIMARY KEY (tenant_id, granularity, bucket, ad_id, event_type),
+    INDEX event_rollups_ad_bucket_index (ad_id, granularity, bucket)
+) ENGINE=InnoDB;
+
+-- Roll up the dummy events inserted above (later history can be rebuilt with fastapi/backfill_rollups.py)
+INSERT INTO event_rollups (tenant_id, granularity, bucket, ad_id, event_type, count)
+SELECT tenant_id, 'hour', DATE_FORMAT(occurred_at, '%Y-%m-%d %H:00:00'), ad_id, event_type, COUNT(*)
+FROM events GROUP BY tenant_id, DATE_FORMAT(occurred_at, '%Y-%m-%d %H:00:00'), ad_id, event_type
+ON DUPLICATE KEY UPDATE count = VALUES(count);
+INSERT INTO event_rollups (tenant_id, granularity, bucket, ad_id, event_type, count)
+SELECT tenant_id, 'day', DATE(occurred_at), ad_id, event_type, COUNT(*)
+FROM events GROUP BY tenant_id, DATE(occurred_at), ad_id, event_type
+ON DUPLICATE KEY UPDATE count = VALUES(count);
+
 -- Consider partitioning for large tables in production based on tenant_id or occurred_at
 -- ALTER TABLE events PARTITION BY RANGE (YEAR(occurred_at)) (
 --     PARTITION p2024 VALUES LESS THAN (2025),
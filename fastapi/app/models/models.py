@@ -1,5 +1,5 @@
 # FastAPI app/models/models.py
-from sqlalchemy import Column, Integer, String, Text, DateTime, JSON, TIMESTAMP
+from sqlalchemy import Column, Integer, String, Text, DateTime, JSON, TIMESTAMP, Index
 from sqlalchemy.ext.declarative import declarative_base
 from datetime import datetime
 
@@ -28,3 +28,14 @@ class EventModel(Base):
     occurred_at = Column(TIMESTAMP, default=datetime.now)
     created_at = Column(DateTime, default=datetime.now)
     updated_at = Column(DateTime, default=datetime.now, onupdate=datetime.now)
+
+class EventRollupModel(Base):
+    """Event counts per (tenant, ad, event type) and hour or day bucket, kept up to date by the events sink."""
+    __tablename__ = "event_rollups"
+    tenant_id = Column(Integer, primary_key=True)
+    granularity = Column(String(8), primary_key=True) # 'hour' or 'day'
+    bucket = Column(DateTime, primary_key=True) # Start of the hour or day
+    ad_id = Column(Integer, primary_key=True)
+    event_type = Column(String(32), primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+    __table_args__ = (Index("event_rollups_ad_bucket_index", "ad_id", "granularity", "bucket"),)
@@ -0,0 +1,362 @@
+# FastAPI app/services/ad_catalog.py
+import os
+import sys
+import threading
+import time
+from abc import abstractmethod
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Mapping, Optional, Tuple
+
+import numpy as np
+from sqlalchemy.orm import Session
+
+from app.models.models import AdModel
+from app.services.candidate_index import CandidateIndex
+from app.services.shared_state import SharedState
+
+# How old (in seconds) the in-memory catalog may get before a request triggers an incremental refresh.
+AD_CATALOG_MAX_STALENESS = float(os.getenv("AD_CATALOG_MAX_STALENESS", "30"))
+# Incremental polling on updated_at cannot see deleted ads, so do a full reload every so often.
+AD_CATALOG_FULL_RELOAD_INTERVAL = float(os.getenv("AD_CATALOG_FULL_RELOAD_INTERVAL", "600"))
+# With a shared catalog, how long a worker waits before checking again while another worker refreshes it
+AD_CATALOG_SHARED_RECHECK = 1.0
+
+_OPEN_START = float("-inf")
+_OPEN_END = float("inf")
+
+
+class CatalogSnapshot:
+    """
+    Read-only view of the ads table. A refresh never changes the ads of a published
+    snapshot, it builds new dictionaries and swaps the reference, so a request can keep
+    using the snapshot it started with without locking.
+    """
+    __slots__ = ("ads", "tenants", "windows", "index", "version", "loaded_at")
+
+    def __init__(self, ads: Mapping[int, Dict[str, Any]], tenants: Mapping[int, int],
+                 windows: Mapping[int, Tuple[float, float]], version: int):
+        self.ads = ads          # ad_id -> {"id", "name", "tags"} payload, ready to be returned as-is
+        self.tenants = tenants  # ad_id -> tenant_id
+        self.windows = windows  # ad_id -> (start_ts, end_ts), open ends are -inf / +inf
+        self.index = CandidateIndex(ads, tenants, windows) # Live ads per tenant and per (tenant, tag)
+        self.version = version
+        self.loaded_at = time.monotonic()
+
+    def __len__(self) -> int:
+        return len(self.ads)
+
+
+def _extract_tags(target_audience: Any) -> Tuple[str, ...]:
+    if not target_audience:
+        return ()
+    interests = target_audience.get("interests", []) if isinstance(target_audience, dict) else []
+    # Interning keeps a single copy of each tag string no matter how many ads share it.
+    return tuple(sys.intern(str(tag)) for tag in interests or ())
+
+
+def _to_timestamp(value: Optional[datetime], default: float) -> float:
+    return value.timestamp() if value is not None else default
+
+
+class AdCatalog:
+    """
+    Process-wide cache of the ads table for the recommender.
+
+    The first read loads every ad; afterwards the catalog polls for rows whose
+    `updated_at` moved past the last seen value once it is older than `max_staleness`
+    seconds, and does a full reload every `full_reload_interval` seconds (or after
+    `invalidate(full=True)`) to drop deleted ads.
+    """
+
+    def __init__(self, max_staleness: float = AD_CATALOG_MAX_STALENESS,
+                 full_reload_interval: float = AD_CATALOG_FULL_RELOAD_INTERVAL):
+        self.max_staleness = max_staleness
+        self.full_reload_interval = full_reload_interval
+        self._snapshot: Optional[CatalogSnapshot] = None
+        self._high_watermark: Optional[datetime] = None
+        self._last_full_load = 0.0
+        self._stale = False
+        self._full_reload_requested = False
+        self._lock = threading.Lock()
+
+    def snapshot(self, db: Session) -> CatalogSnapshot:
+        """Return the current snapshot, refreshing it first if it is older than the staleness bound."""
+        snapshot = self._snapshot
+        if snapshot is not None and not self._needs_refresh(snapshot):
+            return snapshot
+
+        # Only the first load makes callers wait; during a refresh the others keep the current snapshot.
+        if not self._lock.acquire(blocking=snapshot is None):
+            return snapshot
+        try:
+            snapshot = self._snapshot
+            if snapshot is not None and not self._needs_refresh(snapshot):
+                return snapshot # Another thread refreshed while we were waiting
+            try:
+                self._refresh(db, snapshot)
+            except Exception as e:
+                if snapshot is None:
+                    raise
+                print(f"Ad catalog refresh failed: {e}. Serving the previous snapshot.", file=sys.stderr)
+                snapshot.loaded_at = time.monotonic() # Back off until the next staleness window
+                return snapshot
+            return self._snapshot
+        finally:
+            self._lock.release()
+
+    def current(self) -> Optional[CatalogSnapshot]:
+        """Return the last loaded snapshot without refreshing it (None before the first load)."""
+        return self._snapshot
+
+    def invalidate(self, full: bool = False) -> None:
+        """Mark the catalog stale so the next read refreshes it (fully, if `full` is set)."""
+        self._stale = True
+        if full:
+            self._full_reload_requested = True
+
+    def _refresh(self, db: Session, snapshot: Optional[CatalogSnapshot]) -> None:
+        if snapshot is None or self._needs_full_reload():
+            self._full_load(db)
+        else:
+            self._incremental_load(db, snapshot)
+
+    def _needs_refresh(self, snapshot: CatalogSnapshot) -> bool:
+        return self._stale or time.monotonic() - snapshot.loaded_at >= self.max_staleness
+
+    def _needs_full_reload(self) -> bool:
+        return self._full_reload_requested or time.monotonic() - self._last_full_load >= self.full_reload_interval
+
+    def _full_load(self, db: Session) -> None:
+        self._stale = False
+        self._full_reload_requested = False
+        ads: Dict[int, Dict[str, Any]] = {}
+        tenants: Dict[int, int] = {}
+        windows: Dict[int, Tuple[float, float]] = {}
+        self._high_watermark = None
+        for ad in db.query(AdModel).all():
+            self._add(ad, ads, tenants, windows)
+        version = self._snapshot.version + 1 if self._snapshot else 1
+        self._snapshot = CatalogSnapshot(ads, tenants, windows, version)
+        self._last_full_load = time.monotonic()
+
+    def _incremental_load(self, db: Session, snapshot: CatalogSnapshot) -> None:
+        self._stale = False
+        query = db.query(AdModel)
+        if self._high_watermark is not None:
+            # >= rather than > because updated_at has one-second resolution in MySQL;
+            # re-reading the rows of the last second is harmless.
+            query = query.filter(AdModel.updated_at >= self._high_watermark)
+        ads: Dict[int, Dict[str, Any]] = {}
+        tenants: Dict[int, int] = {}
+        windows: Dict[int, Tuple[float, float]] = {}
+        for ad in query.all():
+            self._add(ad, ads, tenants, windows)
+        changed = [ad_id for ad_id in ads
+                   if ads[ad_id] != snapshot.ads.get(ad_id)
+                   or tenants[ad_id] != snapshot.tenants.get(ad_id)
+                   or windows[ad_id] != snapshot.windows.get(ad_id)]
+        if not changed:
+            snapshot.loaded_at = time.monotonic()
+            return
+        merged_ads = dict(snapshot.ads)
+        merged_tenants = dict(snapshot.tenants)
+        merged_windows = dict(snapshot.windows)
+        for ad_id in changed:
+            merged_ads[ad_id] = ads[ad_id]
+            merged_tenants[ad_id] = tenants[ad_id]
+            merged_windows[ad_id] = windows[ad_id]
+        self._snapshot = CatalogSnapshot(merged_ads, merged_tenants, merged_windows, snapshot.version + 1)
+
+    def _add(self, ad: AdModel, ads: Dict[int, Dict[str, Any]], tenants: Dict[int, int],
+             windows: Dict[int, Tuple[float, float]]) -> None:
+        ads[ad.id] = {"id": ad.id, "name": ad.name, "tags": _extract_tags(ad.target_audience)}
+        tenants[ad.id] = ad.tenant_id
+        windows[ad.id] = (_to_timestamp(ad.start_time, _OPEN_START), _to_timestamp(ad.end_time, _OPEN_END))
+        if ad.updated_at is not None and (self._high_watermark is None or ad.updated_at > self._high_watermark):
+            self._high_watermark = ad.updated_at
+
+
+class _SharedColumn(Mapping):
+    """
+    ad_id -> value view over the columns of a shared catalog version; values are built on access.
+    Abstract (Mapping is an ABC): subclasses build the value of a row in `_value`.
+    """
+
+    def __init__(self, arrays: Mapping[str, np.ndarray]):
+        self._arrays = arrays
+        self._ad_ids = arrays["ad_ids"]
+        self._sorted_ids = arrays["sorted_ids"] # ad_ids in ascending order, for binary search
+        self._sorted_rows = arrays["sorted_rows"]
+
+    def _row(self, ad_id: Any) -> Optional[int]:
+        position = int(np.searchsorted(self._sorted_ids, ad_id))
+        if position < len(self._sorted_ids) and self._sorted_ids[position] == ad_id:
+            return int(self._sorted_rows[position])
+        return None
+
+    def __getitem__(self, ad_id: int) -> Any:
+        row = self._row(ad_id)
+        if row is None:
+            raise KeyError(ad_id)
+        return self._value(row)
+
+    def __contains__(self, ad_id: object) -> bool:
+        return self._row(ad_id) is not None
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self._ad_ids.tolist()) # Catalog order
+
+    def __len__(self) -> int:
+        return len(self._ad_ids)
+
+    @abstractmethod
+    def _value(self, row: int) -> Any:
+        """The value of the ad at `row` of the arrays."""
+
+
+class _SharedAds(_SharedColumn):
+    def __init__(self, arrays: Mapping[str, np.ndarray], tags: List[str]):
+        super().__init__(arrays)
+        self._tags = [sys.intern(tag) for tag in tags]
+
+    def _value(self, row: int) -> Dict[str, Any]:
+        arrays = self._arrays
+        name = None
+        if not arrays["name_missing"][row]:
+            name = bytes(arrays["names"][arrays["name_ptr"][row]:arrays["name_ptr"][row + 1]]).decode("utf-8")
+        tag_ids = arrays["tag_ids"][arrays["tag_ptr"][row]:arrays["tag_ptr"][row + 1]]
+        return {"id": int(self._ad_ids[row]), "name": name, "tags": tuple(self._tags[tag] for tag in tag_ids.tolist())}
+
+
+class _SharedTenants(_SharedColumn):
+    def _value(self, row: int) -> Optional[int]:
+        tenant_id = int(self._arrays["tenant_ids"][row])
+        return None if tenant_id < 0 else tenant_id
+
+
+class _SharedWindows(_SharedColumn):
+    def _value(self, row: int) -> Tuple[float, float]:
+        return float(self._arrays["starts"][row]), float(self._arrays["ends"][row])
+
+
+def _catalog_arrays(snapshot: CatalogSnapshot) -> Tuple[Dict[str, np.ndarray], List[str]]:
+    """Columnar form of a snapshot: ads in catalog order, tags and names as CSR offsets into flat arrays."""
+    ad_ids = np.fromiter(snapshot.ads.keys(), dtype=np.int64, count=len(snapshot.ads))
+    tag_index: Dict[str, int] = {}
+    tag_ids: List[int] = []
+    tag_ptr = [0]
+    names = bytearray()
+    name_ptr = [0]
+    name_missing = []
+    for ad_info in snapshot.ads.values():
+        tag_ids.extend(tag_index.setdefault(tag, len(tag_index)) for tag in ad_info.get("tags", ()))
+        tag_ptr.append(len(tag_ids))
+        name = ad_info.get("name")
+        name_missing.append(name is None)
+        names.extend(str(name or "").encode("utf-8"))
+        name_ptr.append(len(names))
+    tenant_ids = [snapshot.tenants.get(ad_id) for ad_id in snapshot.ads]
+    windows = [snapshot.windows.get(ad_id, (_OPEN_START, _OPEN_END)) for ad_id in snapshot.ads]
+    sorted_rows = np.argsort(ad_ids, kind="stable")
+    arrays = {
+        "ad_ids": ad_ids,
+        "sorted_ids": ad_ids[sorted_rows],
+        "sorted_rows": sorted_rows.astype(np.int64),
+        "tenant_ids": np.array([-1 if tenant_id is None else tenant_id for tenant_id in tenant_ids], dtype=np.int64),
+        "starts": np.array([start for start, _ in windows], dtype=np.float64),
+        "ends": np.array([end for _, end in windows], dtype=np.float64),
+        "tag_ptr": np.array(tag_ptr, dtype=np.int64),
+        "tag_ids": np.array(tag_ids, dtype=np.int32),
+        "name_ptr": np.array(name_ptr, dtype=np.int64),
+        "names": np.frombuffer(bytes(names), dtype=np.uint8),
+        "name_missing": np.array(name_missing, dtype=bool),
+    }
+    return arrays, list(tag_index)
+
+
+class SharedAdCatalog(AdCatalog):
+    """
+    AdCatalog for multi-process serving. Snapshots are published as memory-mapped columns in a
+    `SharedState` directory and every worker reads them through lazy mappings, so the catalog
+    is stored once however many workers map it; only the per-worker derived arrays (candidate
+    index, tag matrix) are private.
+
+    A stale snapshot is refreshed by whichever worker takes the refresh lock; the others keep
+    serving their version and switch when CURRENT moves. Before anything was published, a worker
+    that loses the lock race loads a private snapshot instead of waiting.
+    """
+
+    def __init__(self, directory: str, max_staleness: float = AD_CATALOG_MAX_STALENESS,
+                 full_reload_interval: float = AD_CATALOG_FULL_RELOAD_INTERVAL):
+        super().__init__(max_staleness, full_reload_interval)
+        self._state = SharedState(directory)
+        self._mapped_version: Optional[str] = None
+        self._mapped: Optional[CatalogSnapshot] = None
+        self._checked_at = float("-inf")
+
+    def snapshot(self, db: Session) -> CatalogSnapshot:
+        # Follow publications by other workers (e.g. after /ad-catalog/invalidate) within a second
+        now = time.monotonic()
+        if now - self._checked_at >= AD_CATALOG_SHARED_RECHECK and self._lock.acquire(blocking=False):
+            try:
+                self._checked_at = now
+                self._map_current()
+            finally:
+                self._lock.release()
+        return super().snapshot(db)
+
+    def _refresh(self, db: Session, snapshot: Optional[CatalogSnapshot]) -> None:
+        published = self._map_current()
+        if published is not None and not self._needs_refresh(published):
+            return # Another worker already refreshed it
+        with self._state.refresh_lock() as leader:
+            if not leader:
+                if published is None and snapshot is None:
+                    super()._refresh(db, None)
+                else:
+                    current = published or snapshot
+                    current.loaded_at = time.monotonic() - self.max_staleness + AD_CATALOG_SHARED_RECHECK
+                return
+            published = self._map_current() or published or snapshot
+            if published is not None and not self._needs_refresh(published):
+                return
+            super()._refresh(db, published)
+            self._publish(self._snapshot)
+
+    def _publish(self, snapshot: CatalogSnapshot) -> None:
+        arrays, tags = _catalog_arrays(snapshot)
+        full_age = time.monotonic() - self._last_full_load
+        self._state.publish(arrays, {
+            "tags": tags,
+            "catalog_version": snapshot.version,
+            "high_watermark": self._high_watermark.isoformat() if self._high_watermark else None,
+            "full_loaded_at": time.time() - full_age,
+        })
+        self._map_current()
+
+    def _map_current(self) -> Optional[CatalogSnapshot]:
+        """Switch to the version CURRENT points to, if it is not the mapped one; returns the mapped snapshot."""
+        version = self._state.current()
+        if version is None:
+            return None
+        if version == self._mapped_version:
+            return self._mapped
+        try:
+            manifest, arrays = self._state.load(version)
+        except Exception as e:
+            print(f"Could not map shared ad catalog {version}: {e}", file=sys.stderr)
+            return self._mapped
+
+        snapshot = self._mapped
+        if snapshot is None or snapshot.version != manifest["catalog_version"]:
+            # A republished but unchanged catalog keeps the existing snapshot, and with it the derived indexes
+            snapshot = CatalogSnapshot(_SharedAds(arrays, manifest["tags"]), _SharedTenants(arrays),
+                                       _SharedWindows(arrays), manifest["catalog_version"])
+        age = max(0.0, time.time() - manifest["published_at"])
+        snapshot.loaded_at = time.monotonic() - age
+        self._last_full_load = time.monotonic() - max(0.0, time.time() - manifest["full_loaded_at"])
+        watermark = manifest.get("high_watermark")
+        self._high_watermark = datetime.fromisoformat(watermark) if watermark else None
+        self._snapshot = self._mapped = snapshot
+        self._mapped_version = version
+        return snapshot
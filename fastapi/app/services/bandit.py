@@ -0,0 +1,71 @@
+# FastAPI app/services/bandit.py
+import os
+import threading
+from typing import Any, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from app.services.ad_catalog import CatalogSnapshot
+
+# Weight of the prior in pseudo-impressions: an ad without events samples around the catalog-wide CTR,
+# and its own counts dominate once it has a few times this many impressions.
+BANDIT_PRIOR_STRENGTH = float(os.getenv("BANDIT_PRIOR_STRENGTH", "10"))
+# Prior mean when the catalog has no impressions at all yet.
+BANDIT_DEFAULT_CTR = float(os.getenv("BANDIT_DEFAULT_CTR", "0.05"))
+
+
+def new_rng(seed: Optional[int] = None) -> np.random.Generator:
+    """Random generator for one request; the same seed reproduces the same draws."""
+    return np.random.default_rng(seed)
+
+
+class ThompsonSampler:
+    """
+    Thompson sampling over the CTR counters, for cold-start users and fill slots.
+
+    Every ad has a Beta posterior over its CTR: the prior (`prior_strength` pseudo-impressions
+    at the catalog-wide CTR) plus its clicks and non-click impressions. A selection draws one
+    CTR per candidate from its posterior and keeps the `top_n` best draws with a partial sort,
+    so well-performing ads win most of the time while rarely shown ones still get explored.
+    The posterior arrays are rebuilt only when the catalog snapshot or the counters change.
+    """
+
+    def __init__(self, prior_strength: float = BANDIT_PRIOR_STRENGTH, default_ctr: float = BANDIT_DEFAULT_CTR):
+        self.prior_strength = prior_strength
+        self.default_ctr = default_ctr
+        self._key: Optional[Tuple[Any, Any, int]] = None
+        self._alpha: Optional[np.ndarray] = None
+        self._beta: Optional[np.ndarray] = None
+        self._lock = threading.Lock()
+
+    def posteriors(self, snapshot: CatalogSnapshot, ctr_stats: Any) -> Tuple[np.ndarray, np.ndarray]:
+        """`(alpha, beta)` per catalog row (the order of `snapshot.index.ad_ids`)."""
+        with self._lock:
+            key = self._key
+            if key is None or key[0] is not snapshot or key[1] is not ctr_stats or key[2] != ctr_stats.version:
+                version = ctr_stats.version # Read first: a concurrent event makes the next call rebuild
+                impressions, clicks = ctr_stats.count_vectors(snapshot.index.ad_ids)
+                shown = impressions.sum()
+                mean = clicks.sum() / shown if shown > 0 else self.default_ctr
+                mean = min(max(mean, 1e-3), 1 - 1e-3)
+                self._alpha = self.prior_strength * mean + clicks
+                self._beta = self.prior_strength * (1 - mean) + np.maximum(impressions - clicks, 0)
+                self._key = (snapshot, ctr_stats, version)
+            return self._alpha, self._beta
+
+    def sample(self, snapshot: CatalogSnapshot, ctr_stats: Any, rows: np.ndarray, top_n: int,
+               exclude: Iterable[int] = (), rng: Optional[np.random.Generator] = None) -> List[int]:
+        """Ad ids of up to `top_n` of the catalog `rows`, best sampled CTR first, skipping `exclude`."""
+        alpha, beta = self.posteriors(snapshot, ctr_stats)
+        ad_ids = snapshot.index.ad_ids[rows]
+        exclude = list(exclude)
+        if exclude and len(rows):
+            keep = ~np.isin(ad_ids, exclude)
+            rows, ad_ids = rows[keep], ad_ids[keep]
+        count = min(top_n, len(rows))
+        if count <= 0:
+            return []
+        draws = (rng if rng is not None else new_rng()).beta(alpha[rows], beta[rows])
+        best = np.argpartition(-draws, count - 1)[:count] if count < len(draws) else np.arange(len(draws))
+        best = best[np.argsort(-draws[best], kind="stable")]
+        return ad_ids[best].tolist()
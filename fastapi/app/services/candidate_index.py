@@ -0,0 +1,99 @@
+# FastAPI app/services/candidate_index.py
+import bisect
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Mapping, Optional, Tuple
+
+import numpy as np
+
+_EMPTY = np.zeros(0, dtype=np.int64)
+_ALWAYS = (float("-inf"), float("inf")) # Ads without a schedule are always live
+
+
+class _LiveSet:
+    """Ads running during [valid_from, valid_until), grouped by tenant and by (tenant, tag)."""
+    __slots__ = ("valid_from", "valid_until", "tenant_rows", "tag_rows")
+
+    def __init__(self, valid_from: float, valid_until: float, tenant_rows: Dict[Optional[int], np.ndarray],
+                 tag_rows: Dict[Tuple[Optional[int], str], np.ndarray]):
+        self.valid_from = valid_from
+        self.valid_until = valid_until
+        self.tenant_rows = tenant_rows # tenant_id (None = every tenant) -> rows
+        self.tag_rows = tag_rows       # (tenant_id, tag) -> rows
+
+
+class CandidateIndex:
+    """
+    Candidate generation for one catalog snapshot. Ads are addressed by their row, i.e.
+    their position in the snapshot's `ads` dict, which is also their row in the scoring
+    engines, and every row array is sorted so candidates keep catalog order.
+
+    The set of live ads only changes when some ad starts or ends, so the per-tenant and
+    inverted (tenant, tag) -> ads postings are built once per interval between two
+    schedule boundaries and reused by every request in that interval.
+    """
+
+    def __init__(self, ads: Mapping[int, Mapping[str, Any]], tenants: Mapping[int, int],
+                 windows: Mapping[int, Tuple[float, float]]):
+        self.ad_ids = np.fromiter(ads.keys(), dtype=np.int64, count=len(ads))
+        self._row_of = {ad_id: row for row, ad_id in enumerate(ads)}
+        self._tenants = [tenants.get(ad_id) for ad_id in ads]
+        self._tags = [ad_info.get("tags", ()) for ad_info in ads.values()]
+        schedule = [windows.get(ad_id, _ALWAYS) for ad_id in ads]
+        self._starts = np.fromiter((start for start, _ in schedule), dtype=np.float64, count=len(ads))
+        self._ends = np.fromiter((end for _, end in schedule), dtype=np.float64, count=len(ads))
+        bounds = np.concatenate((self._starts, self._ends))
+        self._boundaries = sorted(set(bounds[np.isfinite(bounds)].tolist()))
+        self._live: Optional[_LiveSet] = None
+        self._lock = threading.Lock()
+
+    def live_rows(self, tenant_id: Optional[int] = None, now: Optional[float] = None) -> np.ndarray:
+        """Rows of the ads running at `now` (default: the current time), restricted to `tenant_id` if given."""
+        return self._live_set(now).tenant_rows.get(tenant_id, _EMPTY)
+
+    def candidate_rows(self, tenant_id: Optional[int], tags: Iterable[str], now: Optional[float] = None,
+                       ad_ids: Iterable[int] = ()) -> np.ndarray:
+        """
+        Rows of the live ads of `tenant_id` (None = every tenant) that carry at least one of `tags`
+        or are among `ad_ids` (e.g. the neighbours of the user's ads in the similarity matrix).
+        """
+        live = self._live_set(now)
+        tag_rows = live.tag_rows
+        postings = [tag_rows[key] for key in ((tenant_id, tag) for tag in tags) if key in tag_rows]
+        extra = np.fromiter((row for row in map(self._row_of.get, ad_ids) if row is not None), dtype=np.int64)
+        if len(extra):
+            extra = np.unique(extra)
+            postings.append(extra[np.isin(extra, live.tenant_rows.get(tenant_id, _EMPTY), assume_unique=True)])
+        if not postings:
+            return _EMPTY
+        if len(postings) == 1:
+            return postings[0]
+        return np.unique(np.concatenate(postings))
+
+    def _live_set(self, now: Optional[float]) -> _LiveSet:
+        now = time.time() if now is None else now
+        live = self._live
+        if live is not None and live.valid_from <= now < live.valid_until:
+            return live
+        with self._lock:
+            live = self._live
+            if live is None or not live.valid_from <= now < live.valid_until:
+                live = self._live = self._build(now)
+            return live
+
+    def _build(self, now: float) -> _LiveSet:
+        position = bisect.bisect_right(self._boundaries, now)
+        valid_from = self._boundaries[position - 1] if position > 0 else float("-inf")
+        valid_until = self._boundaries[position] if position < len(self._boundaries) else float("inf")
+
+        tenant_rows: Dict[Optional[int], List[int]] = {None: []}
+        tag_rows: Dict[Tuple[Optional[int], str], List[int]] = {}
+        for row in np.flatnonzero((self._starts <= now) & (now < self._ends)).tolist():
+            scopes = (None,) if self._tenants[row] is None else (None, self._tenants[row])
+            for scope in scopes:
+                tenant_rows.setdefault(scope, []).append(row)
+                for tag in set(self._tags[row]):
+                    tag_rows.setdefault((scope, tag), []).append(row)
+        return _LiveSet(valid_from, valid_until,
+                        {key: np.array(rows, dtype=np.int64) for key, rows in tenant_rows.items()},
+                        {key: np.array(rows, dtype=np.int64) for key, rows in tag_rows.items()})
@@ -0,0 +1,153 @@
+# FastAPI app/services/circuit_breaker.py
+import os
+import sys
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+from app.services import metrics
+
+# Consecutive failures of a sink that open its circuit.
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+# Seconds an open circuit skips its sink before a trial call (or a background probe) may close it again.
+CIRCUIT_RESET_TIMEOUT = float(os.getenv("CIRCUIT_RESET_TIMEOUT", "10"))
+# Trial calls let through while half-open; that many successes close the circuit.
+CIRCUIT_HALF_OPEN_CALLS = int(os.getenv("CIRCUIT_HALF_OPEN_CALLS", "1"))
+# Seconds between background probes of an open circuit's sink.
+CIRCUIT_PROBE_INTERVAL = float(os.getenv("CIRCUIT_PROBE_INTERVAL", "2"))
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+_STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2} # Exported as event_sink_circuit_state
+
+
+class CircuitBreaker:
+    """
+    Per-sink circuit breaker for the event fallback chain.
+
+    Closed: every call goes to the sink; `failure_threshold` consecutive failures open the
+    circuit. Open: `allow()` is False, so callers go straight to the next sink instead of
+    waiting on a broken one. After `reset_timeout` the circuit turns half-open, either lazily
+    on the next `allow()` or, when `start()` runs the background `probe`, once the probe
+    succeeds. Half-open: up to `half_open_calls` trial calls go through; that many successes
+    close the circuit, any failure opens it again.
+    """
+
+    def __init__(self, name: str, probe: Optional[Callable[[], Any]] = None,
+                 failure_threshold: int = CIRCUIT_FAILURE_THRESHOLD, reset_timeout: float = CIRCUIT_RESET_TIMEOUT,
+                 half_open_calls: int = CIRCUIT_HALF_OPEN_CALLS, probe_interval: float = CIRCUIT_PROBE_INTERVAL):
+        self.name = name
+        self._probe = probe
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_calls = half_open_calls
+        self.probe_interval = probe_interval
+        self.state = CLOSED
+        self.failures = 0 # Consecutive failures while closed
+        self.opened_count = 0
+        self.last_error: Optional[str] = None
+        self._opened_at: Optional[float] = None
+        self._trials = 0 # Trial calls in flight while half-open
+        self._trial_successes = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        metrics.EVENT_SINK_CIRCUIT_STATE.labels(name).set(_STATE_VALUES[CLOSED])
+
+    def allow(self) -> bool:
+        """Whether the next call should go to the sink. Every allowed call must end in `record_success` or `record_failure`."""
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN:
+                if self._probing() or time.monotonic() - self._opened_at < self.reset_timeout:
+                    return False
+                self._transition(HALF_OPEN)
+            if self._trials >= self.half_open_calls:
+                return False
+            self._trials += 1
+            return True
+
+    def record_success(self) -> None:
+        with self._lock:
+            if self.state == CLOSED:
+                self.failures = 0
+            elif self.state == HALF_OPEN:
+                self._trials = max(self._trials - 1, 0)
+                self._trial_successes += 1
+                if self._trial_successes >= self.half_open_calls:
+                    self._transition(CLOSED)
+
+    def record_failure(self, error: Any = None) -> None:
+        with self._lock:
+            if error is not None:
+                self.last_error = str(error)
+            if self.state == HALF_OPEN:
+                self._transition(OPEN)
+            elif self.state == CLOSED:
+                self.failures += 1
+                if self.failures >= self.failure_threshold:
+                    self._transition(OPEN)
+
+    def status(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "state": self.state,
+                "consecutive_failures": self.failures,
+                "opened_count": self.opened_count,
+                "open_for_seconds": round(time.monotonic() - self._opened_at, 3) if self.state == OPEN else None,
+                "last_error": self.last_error,
+            }
+
+    def start(self) -> None:
+        """Probe the sink in the background while the circuit is open (no-op without a probe)."""
+        if self._probe is None or self._probing():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run_probe, name=f"{self.name}-circuit-probe", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 5.0) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _probing(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def _transition(self, state: str) -> None:
+        # Called with the lock held
+        if state == OPEN:
+            self._opened_at = time.monotonic()
+            self.opened_count += 1
+            print(f"Circuit for {self.name} opened after {self.failures or 'a failed trial'} failure(s): {self.last_error}. "
+                  f"Routing to the next sink.", file=sys.stderr)
+        elif state == CLOSED:
+            print(f"Circuit for {self.name} closed.")
+        self.state = state
+        self.failures = 0
+        self._trials = 0
+        self._trial_successes = 0
+        metrics.EVENT_SINK_CIRCUIT_STATE.labels(self.name).set(_STATE_VALUES[state])
+
+    def _run_probe(self) -> None:
+        while not self._stop.wait(self.probe_interval):
+            with self._lock:
+                due = self.state == OPEN and time.monotonic() - self._opened_at >= self.reset_timeout
+            if not due:
+                continue
+            try:
+                healthy = bool(self._probe())
+                error = None if healthy else "probe reported the sink unhealthy"
+            except Exception as e:
+                healthy, error = False, str(e)
+            with self._lock:
+                if self.state != OPEN:
+                    continue
+                if healthy:
+                    self._transition(HALF_OPEN) # Real traffic confirms the recovery
+                else:
+                    self.last_error = error
+                    self._opened_at = time.monotonic() # Stay open for another reset_timeout
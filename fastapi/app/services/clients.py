@@ -0,0 +1,115 @@
+# FastAPI app/services/clients.py
+import os
+import sys
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+# First delay between connection attempts, doubled after every failure up to CLIENT_RECONNECT_MAX_DELAY.
+CLIENT_RECONNECT_DELAY = float(os.getenv("CLIENT_RECONNECT_DELAY", "1.0"))
+CLIENT_RECONNECT_MAX_DELAY = float(os.getenv("CLIENT_RECONNECT_MAX_DELAY", "30.0"))
+# Seconds between health checks of a connected client.
+CLIENT_HEALTH_CHECK_INTERVAL = float(os.getenv("CLIENT_HEALTH_CHECK_INTERVAL", "10.0"))
+
+
+class ManagedClient:
+    """
+    A Kafka/Redis client created in the background instead of at import time.
+
+    `start()` returns immediately; a daemon thread calls `connect` until it succeeds
+    (with exponential backoff), then runs `check` every `health_check_interval` seconds.
+    A client whose check fails is kept, both libraries reconnect by themselves, and
+    reported as disconnected until a check passes again. `on_change(client)` is called
+    with the new client (or None on `stop()`), so callers can keep a module-level reference.
+    """
+
+    def __init__(self, name: str, connect: Callable[[], Any], check: Callable[[Any], Any],
+                 close: Optional[Callable[[Any], None]] = None, on_change: Optional[Callable[[Any], None]] = None,
+                 reconnect_delay: float = CLIENT_RECONNECT_DELAY, max_reconnect_delay: float = CLIENT_RECONNECT_MAX_DELAY,
+                 health_check_interval: float = CLIENT_HEALTH_CHECK_INTERVAL):
+        self.name = name
+        self._connect = connect
+        self._check = check
+        self._close = close
+        self._on_change = on_change
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self.health_check_interval = health_check_interval
+        self.client: Any = None
+        self.connected = False
+        self.attempts = 0
+        self.last_error: Optional[str] = None
+        self.connect_seconds: Optional[float] = None # Time from start() to the first successful connection
+        self._started_at: Optional[float] = None
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def start(self) -> None:
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._started_at = time.monotonic()
+            self._thread = threading.Thread(target=self._run, name=f"{self.name}-client", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout: float = 5.0) -> None:
+        """Stop the background thread and close the client. A connection attempt in progress is not waited for."""
+        self._stop.set()
+        with self._lock:
+            client, self.client, self.connected = self.client, None, False
+        if client is not None:
+            if self._thread is not None:
+                self._thread.join(timeout) # Health checks wake up on stop, so this returns quickly
+            if self._on_change is not None:
+                self._on_change(None)
+            self._close_client(client)
+
+    def _close_client(self, client: Any) -> None:
+        if self._close is not None:
+            try:
+                self._close(client)
+            except Exception as e:
+                print(f"Closing the {self.name} client failed: {e}", file=sys.stderr)
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "status": "connected" if self.connected else "disconnected",
+            "attempts": self.attempts,
+            "last_error": self.last_error,
+            "connect_seconds": self.connect_seconds,
+        }
+
+    def _run(self) -> None:
+        delay = self.reconnect_delay
+        while not self._stop.is_set() and self.client is None:
+            self.attempts += 1
+            try:
+                client = self._connect()
+            except Exception as e:
+                self.last_error = str(e)
+                print(f"Could not connect to {self.name}: {e}. Retrying in {delay:.0f}s.", file=sys.stderr)
+                self._stop.wait(delay)
+                delay = min(delay * 2, self.max_reconnect_delay)
+                continue
+            with self._lock:
+                if self._stop.is_set(): # Stopped while connecting
+                    self._close_client(client)
+                    return
+                self.client, self.connected, self.last_error = client, True, None
+            self.connect_seconds = time.monotonic() - self._started_at
+            if self._on_change is not None:
+                self._on_change(client)
+            print(f"{self.name} client connected after {self.attempts} attempt(s).")
+
+        while not self._stop.wait(self.health_check_interval):
+            client = self.client
+            if client is None:
+                return
+            try:
+                self.connected = bool(self._check(client))
+                if self.connected:
+                    self.last_error = None
+            except Exception as e:
+                self.connected, self.last_error = False, str(e)
@@ -0,0 +1,260 @@
+# FastAPI app/services/ctr_stats.py
+import os
+import sys
+import threading
+import time
+from typing import Dict, Mapping, Optional, Tuple
+
+import numpy as np
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from app.models.models import EventModel
+from app.services.event_snapshot import EventSnapshot
+from app.services.shared_state import SharedState
+
+# Seconds between bulk reconciliations of the in-memory counters against the events table.
+CTR_RECONCILE_INTERVAL = float(os.getenv("CTR_RECONCILE_INTERVAL", "300"))
+# With shared totals, how long a worker waits before checking again while another worker reconciles
+CTR_SHARED_RECHECK = 1.0
+# Longest delay before incremental counts reach values cached per `version` (the scorer's CTR vector,
+# the bandit's posteriors). Bumping the version per event made every request rebuild them.
+CTR_VERSION_INTERVAL = float(os.getenv("CTR_VERSION_INTERVAL", "1"))
+
+Totals = Tuple[Dict[int, int], Dict[int, int], Dict[int, Tuple[int, int]]] # impressions, clicks, tenant_totals
+
+
+class CtrStats:
+    """
+    Per-ad and per-tenant impression/click counters.
+
+    Counters are bumped as events arrive through `/log-event` and periodically
+    replaced by a `GROUP BY tenant_id, ad_id, event_type` over the events table, which
+    stays the source of truth. Reads are O(1) and never touch the database.
+
+    With `snapshot_dir`, reconciliation counts the memory-mapped events snapshot written by
+    export_events.py and only aggregates the events exported after it from MySQL.
+
+    With `shared_dir`, the worker processes of one host share reconciliations: the worker
+    holding the `SharedState` refresh lock aggregates and publishes the totals, the others
+    load the published ones instead of running the same GROUP BY.
+    """
+
+    def __init__(self, reconcile_interval: float = CTR_RECONCILE_INTERVAL, snapshot_dir: Optional[str] = None,
+                 shared_dir: Optional[str] = None, version_interval: float = CTR_VERSION_INTERVAL):
+        self.reconcile_interval = reconcile_interval
+        self.version_interval = version_interval
+        self.snapshot_dir = snapshot_dir
+        self._shared = SharedState(shared_dir) if shared_dir else None
+        self._shared_version: Optional[str] = None
+        self._version = 0
+        self._versioned_at = float("-inf")
+        self._changed = False # Events were recorded since the last version bump
+        self._impressions: Dict[int, int] = {}
+        self._clicks: Dict[int, int] = {}
+        self._ctrs: Dict[int, float] = {} # Only ads with at least one impression, like the old per-request scan
+        self._tenant_totals: Dict[int, Tuple[int, int]] = {} # tenant_id -> (impressions, clicks)
+        self._last_reconcile: Optional[float] = None
+        self._lock = threading.Lock()
+        self._reconcile_lock = threading.Lock()
+        # Totals of the snapshot rows counted so far: (rows, last_id, impressions, clicks, tenant_totals)
+        self._snapshot_totals: Optional[Tuple[int, int, Dict[int, int], Dict[int, int], Dict[int, Tuple[int, int]]]] = None
+
+    def record(self, tenant_id: int, ad_id: int, event_type: str, count: int = 1) -> None:
+        """Count `count` events of `event_type` for an ad as they are ingested."""
+        if event_type not in ('impression', 'click'):
+            return
+        with self._lock:
+            counters = self._impressions if event_type == 'impression' else self._clicks
+            counters[ad_id] = counters.get(ad_id, 0) + count
+            impressions, clicks = self._tenant_totals.get(tenant_id, (0, 0))
+            if event_type == 'impression':
+                impressions += count
+            else:
+                clicks += count
+            self._tenant_totals[tenant_id] = (impressions, clicks)
+            self._update_ctr(ad_id)
+            self._changed = True
+
+    @property
+    def version(self) -> int:
+        """
+        Changes when the counters changed, lets callers cache values derived from them. A reconciliation
+        changes it right away, recorded events at most once per `version_interval` seconds.
+        """
+        if self._changed and time.monotonic() - self._versioned_at >= self.version_interval:
+            with self._lock:
+                if self._changed:
+                    self._bump_version()
+        return self._version
+
+    def _bump_version(self) -> None:
+        self._version += 1
+        self._versioned_at = time.monotonic()
+        self._changed = False
+
+    def ctr(self, ad_id: int) -> float:
+        return self._ctrs.get(ad_id, 0.0)
+
+    def tenant_ctr(self, tenant_id: int) -> float:
+        impressions, clicks = self._tenant_totals.get(tenant_id, (0, 0))
+        return clicks / impressions if impressions > 0 else 0.0
+
+    def counts(self, ad_id: int) -> Tuple[int, int]:
+        """Return `(impressions, clicks)` for an ad."""
+        return self._impressions.get(ad_id, 0), self._clicks.get(ad_id, 0)
+
+    def count_vectors(self, ad_ids: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Impressions and clicks of every ad in `ad_ids`, as two int64 arrays in the same order."""
+        impressions, clicks = self._impressions, self._clicks
+        return (np.fromiter((impressions.get(ad_id, 0) for ad_id in ad_ids.tolist()), dtype=np.int64, count=len(ad_ids)),
+                np.fromiter((clicks.get(ad_id, 0) for ad_id in ad_ids.tolist()), dtype=np.int64, count=len(ad_ids)))
+
+    @property
+    def loaded(self) -> bool:
+        """Whether a reconciliation ran (or failed) at least once, i.e. `ensure_fresh` no longer blocks."""
+        return self._last_reconcile is not None
+
+    def ctrs(self, db: Optional[Session] = None) -> Mapping[int, float]:
+        """
+        Return the ad_id -> CTR mapping, reconciling first when a session is given and the
+        last reconciliation is older than `reconcile_interval`. The mapping is live; treat it as read-only.
+        """
+        if db is not None:
+            self.ensure_fresh(db)
+        return self._ctrs
+
+    def ensure_fresh(self, db: Session) -> None:
+        last = self._last_reconcile
+        if last is not None and time.monotonic() - last < self.reconcile_interval:
+            return
+        # Only one request reconciles; the others keep serving the current counters unless there are none yet.
+        if not self._reconcile_lock.acquire(blocking=last is None):
+            return
+        try:
+            if self._last_reconcile is not last:
+                return # Reconciled by another thread while we were waiting
+            self.reconcile(db)
+        except Exception as e:
+            # Keep serving the incremental counters; retry after another interval.
+            self._last_reconcile = time.monotonic()
+            print(f"CTR reconciliation failed: {e}. Serving in-memory counters.", file=sys.stderr)
+        finally:
+            self._reconcile_lock.release()
+
+    def reconcile(self, db: Session) -> None:
+        """Replace all counters with exact totals from the events table (and the snapshot, if any)."""
+        if self._shared is None:
+            self._apply(self._aggregate(db))
+            return
+        if self._load_shared():
+            return # Another worker reconciled within the interval
+        with self._shared.refresh_lock() as leader:
+            if leader:
+                if self._load_shared():
+                    return
+                totals = self._aggregate(db)
+                self._publish_shared(totals)
+                self._apply(totals)
+            elif self._last_reconcile is None:
+                self._apply(self._aggregate(db)) # Nothing to serve yet, do not wait for the other worker
+            else:
+                self._last_reconcile = time.monotonic() - self.reconcile_interval + CTR_SHARED_RECHECK
+
+    def _aggregate(self, db: Session) -> Totals:
+        query = db.query(EventModel.tenant_id, EventModel.ad_id, EventModel.event_type, func.count(EventModel.id))
+        impressions: Dict[int, int] = {}
+        clicks: Dict[int, int] = {}
+        tenant_totals: Dict[int, Tuple[int, int]] = {}
+        snapshot_totals = self._count_snapshot() if self.snapshot_dir else None
+        if snapshot_totals is not None:
+            _, last_id, snapshot_impressions, snapshot_clicks, snapshot_tenant_totals = snapshot_totals
+            impressions, clicks, tenant_totals = dict(snapshot_impressions), dict(snapshot_clicks), dict(snapshot_tenant_totals)
+            query = query.filter(EventModel.id > last_id)
+        rows = query.group_by(EventModel.tenant_id, EventModel.ad_id, EventModel.event_type).all()
+        for tenant_id, ad_id, event_type, count in rows:
+            if event_type not in ('impression', 'click'):
+                continue
+            tenant_impressions, tenant_clicks = tenant_totals.get(tenant_id, (0, 0))
+            if event_type == 'impression':
+                impressions[ad_id] = impressions.get(ad_id, 0) + count
+                tenant_impressions += count
+            else:
+                clicks[ad_id] = clicks.get(ad_id, 0) + count
+                tenant_clicks += count
+            tenant_totals[tenant_id] = (tenant_impressions, tenant_clicks)
+
+        return impressions, clicks, tenant_totals
+
+    def _apply(self, totals: Totals, reconciled_at: Optional[float] = None) -> None:
+        impressions, clicks, tenant_totals = totals
+        ctrs = {ad_id: clicks.get(ad_id, 0) / shown for ad_id, shown in impressions.items() if shown > 0}
+        with self._lock:
+            self._impressions = impressions
+            self._clicks = clicks
+            self._tenant_totals = tenant_totals
+            self._ctrs = ctrs
+            self._last_reconcile = time.monotonic() if reconciled_at is None else reconciled_at
+            self._bump_version()
+
+    def _publish_shared(self, totals: Totals) -> None:
+        impressions, clicks, tenant_totals = totals
+        ad_ids = sorted(set(impressions) | set(clicks))
+        tenant_ids = sorted(tenant_totals)
+        self._shared_version = self._shared.publish({
+            "ad_ids": np.array(ad_ids, dtype=np.int64),
+            "impressions": np.array([impressions.get(ad_id, 0) for ad_id in ad_ids], dtype=np.int64),
+            "clicks": np.array([clicks.get(ad_id, 0) for ad_id in ad_ids], dtype=np.int64),
+            "tenant_ids": np.array(tenant_ids, dtype=np.int64),
+            "tenant_impressions": np.array([tenant_totals[tenant_id][0] for tenant_id in tenant_ids], dtype=np.int64),
+            "tenant_clicks": np.array([tenant_totals[tenant_id][1] for tenant_id in tenant_ids], dtype=np.int64),
+        })
+
+    def _load_shared(self) -> bool:
+        """Apply the totals another worker published, if they are newer than ours and within the interval."""
+        version = self._shared.current()
+        if version is None or version == self._shared_version:
+            return False
+        manifest, arrays = self._shared.load(version)
+        age = time.time() - manifest["published_at"]
+        if age >= self.reconcile_interval:
+            return False
+        ad_ids = arrays["ad_ids"].tolist()
+        impressions = {ad_id: count for ad_id, count in zip(ad_ids, arrays["impressions"].tolist()) if count}
+        clicks = {ad_id: count for ad_id, count in zip(ad_ids, arrays["clicks"].tolist()) if count}
+        tenant_totals = dict(zip(arrays["tenant_ids"].tolist(),
+                                 zip(arrays["tenant_impressions"].tolist(), arrays["tenant_clicks"].tolist())))
+        self._apply((impressions, clicks, tenant_totals), reconciled_at=time.monotonic() - max(0.0, age))
+        self._shared_version = version
+        return True
+
+    def _count_snapshot(self):
+        """Totals over the exported snapshot; only rows appended since the previous call are scanned."""
+        snapshot = EventSnapshot.load(self.snapshot_dir)
+        if snapshot is None:
+            return None
+        totals = self._snapshot_totals
+        if totals is None or totals[0] > snapshot.rows: # The snapshot was rebuilt from scratch
+            totals = (0, 0, {}, {}, {})
+        counted, _, impressions, clicks, tenant_totals = totals
+        if counted == snapshot.rows:
+            return totals
+
+        impressions, clicks, tenant_totals = dict(impressions), dict(clicks), dict(tenant_totals)
+        for ad_id, count in snapshot.count_by("ad_id", "impression", start=counted).items():
+            impressions[ad_id] = impressions.get(ad_id, 0) + count
+        for ad_id, count in snapshot.count_by("ad_id", "click", start=counted).items():
+            clicks[ad_id] = clicks.get(ad_id, 0) + count
+        for tenant_id, count in snapshot.count_by("tenant_id", "impression", start=counted).items():
+            tenant_impressions, tenant_clicks = tenant_totals.get(tenant_id, (0, 0))
+            tenant_totals[tenant_id] = (tenant_impressions + count, tenant_clicks)
+        for tenant_id, count in snapshot.count_by("tenant_id", "click", start=counted).items():
+            tenant_impressions, tenant_clicks = tenant_totals.get(tenant_id, (0, 0))
+            tenant_totals[tenant_id] = (tenant_impressions, tenant_clicks + count)
+        self._snapshot_totals = (snapshot.rows, snapshot.last_id, impressions, clicks, tenant_totals)
+        return self._snapshot_totals
+
+    def _update_ctr(self, ad_id: int) -> None:
+        impressions = self._impressions.get(ad_id, 0)
+        if impressions > 0:
+            self._ctrs[ad_id] = self._clicks.get(ad_id, 0) / impressions
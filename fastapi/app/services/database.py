@@ -1,9 +1,11 @@
 # FastAPI app/services/database.py
 from sqlalchemy import create_engine
-from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker
 import os
 
+from app.models.models import Base # noqa: F401 (re-exported: the models and this module share one metadata)
+
 # Database connection details from environment variables
 # In a real app, ensure these are robustly managed (e.g., Docker secrets)
 DB_HOST = os.getenv("DB_HOST", "db")
@@ -12,23 +14,33 @@ DB_DATABASE = os.getenv("DB_DATABASE", "ad_platform_db")
 DB_USERNAME = os.getenv("DB_USERNAME", "user")
 DB_PASSWORD = os.getenv("DB_PASSWORD", "password")
 
-# SQLAlchemy Database URL
-# For MySQL, use mysql+pymysql:// or mysql+mysqlconnector://
+# Connection pool sizing, applied to each engine of each worker process
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))       # Connections kept open
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20")) # Extra connections opened under load, closed when returned
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800")) # Seconds before a connection is replaced (stay below MySQL's wait_timeout)
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10")) # Seconds to wait for a free connection before failing
+
+# SQLAlchemy Database URLs
+# The sync engine uses PyMySQL (background jobs, the events sink); request handlers use aiomysql.
 SQLALCHEMY_DATABASE_URL = f"mysql+pymysql://{DB_USERNAME}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_DATABASE}"
+SQLALCHEMY_ASYNC_DATABASE_URL = f"mysql+aiomysql://{DB_USERNAME}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_DATABASE}"
 
-# Create the SQLAlchemy engine
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, 
-    pool_pre_ping=True # Ensures connections are alive
+_POOL_OPTIONS = dict(
+    pool_pre_ping=True, # Ensures connections are alive
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_recycle=DB_POOL_RECYCLE,
+    pool_timeout=DB_POOL_TIMEOUT,
 )
 
-# Create a SessionLocal class
-# Each instance of SessionLocal will be a database session.
+# Create the SQLAlchemy engines
+engine = create_engine(SQLALCHEMY_DATABASE_URL, **_POOL_OPTIONS)
+async_engine = create_async_engine(SQLALCHEMY_ASYNC_DATABASE_URL, **_POOL_OPTIONS)
+
+# Create the session factories
 # The `autocommit=False` and `autoflush=False` are standard for web applications.
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-
-# Base class for declarative models
-Base = declarative_base()
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
 
 # Dependency to get DB session
 # This is a common pattern in FastAPI to manage database sessions per request.
@@ -38,3 +50,8 @@ def get_db():
         yield db
     finally:
         db.close()
+
+# Async variant for `async def` handlers: waiting on MySQL does not hold a worker thread.
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
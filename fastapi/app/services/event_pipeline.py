@@ -0,0 +1,155 @@
+# FastAPI app/services/event_pipeline.py
+import os
+import queue
+import sys
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from app.services import metrics
+
+# Capacity of the in-process buffer; once full, producers wait up to EVENT_ENQUEUE_TIMEOUT before being rejected.
+EVENT_BUFFER_SIZE = int(os.getenv("EVENT_BUFFER_SIZE", "10000"))
+EVENT_ENQUEUE_TIMEOUT = float(os.getenv("EVENT_ENQUEUE_TIMEOUT", "0.05"))
+# A batch is flushed when it holds EVENT_BATCH_SIZE events or its first event waited EVENT_LINGER_MS.
+EVENT_BATCH_SIZE = int(os.getenv("EVENT_BATCH_SIZE", "500"))
+EVENT_LINGER_MS = float(os.getenv("EVENT_LINGER_MS", "50"))
+
+
+class BufferFull(Exception):
+    """Raised by `EventPipeline.submit` when the buffer stays full for the whole enqueue timeout."""
+
+
+class PendingEvent:
+    """Handle returned for a buffered event; `wait()` blocks until its batch was delivered."""
+    __slots__ = ("event", "sink", "_done")
+
+    def __init__(self, event: Dict[str, Any]):
+        self.event = event
+        self.sink: Optional[str] = None
+        self._done = threading.Event()
+
+    def resolve(self, sink: str) -> None:
+        self.sink = sink
+        self._done.set()
+
+    def wait(self, timeout: Optional[float] = None) -> Optional[str]:
+        """Return the sink the event was written to ('kafka', 'redis' or 'file'), or None on timeout."""
+        self._done.wait(timeout)
+        return self.sink
+
+
+class EventPipeline:
+    """
+    Bounded buffer between the request handlers and the event sinks.
+
+    Handlers enqueue and return immediately; a single background thread drains the
+    buffer in batches and hands each batch to `deliver`, which returns the sink used
+    for every event of the batch (same order).
+    """
+
+    def __init__(self, deliver: Callable[[List[Dict[str, Any]]], List[str]],
+                 buffer_size: int = EVENT_BUFFER_SIZE, batch_size: int = EVENT_BATCH_SIZE,
+                 linger_ms: float = EVENT_LINGER_MS, enqueue_timeout: float = EVENT_ENQUEUE_TIMEOUT):
+        self.deliver = deliver
+        self.batch_size = batch_size
+        self.linger = linger_ms / 1000.0
+        self.enqueue_timeout = enqueue_timeout
+        self._queue: "queue.Queue[PendingEvent]" = queue.Queue(maxsize=buffer_size)
+        self._thread: Optional[threading.Thread] = None
+        self._stopping = threading.Event()
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._batches = 0
+        self._events = 0
+        self._rejected = 0
+        self._last_batch_size = 0
+        self._last_flush_seconds = 0.0
+        self._total_flush_seconds = 0.0
+        self._max_flush_seconds = 0.0
+
+    def start(self) -> None:
+        with self._start_lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name="event-pipeline", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout: float = 5.0) -> None:
+        """Stop the flusher after draining whatever is still buffered."""
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def submit(self, event: Dict[str, Any]) -> PendingEvent:
+        """Buffer an event for delivery; raises `BufferFull` when the buffer stays full (backpressure)."""
+        self.start()
+        pending = PendingEvent(event)
+        try:
+            self._queue.put(pending, timeout=self.enqueue_timeout)
+        except queue.Full:
+            with self._stats_lock:
+                self._rejected += 1
+            raise BufferFull(f"Event buffer is full ({self._queue.maxsize} events)")
+        return pending
+
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._stats_lock:
+            return {
+                "queue_depth": self._queue.qsize(),
+                "queue_capacity": self._queue.maxsize,
+                "batches_flushed": self._batches,
+                "events_flushed": self._events,
+                "events_rejected": self._rejected,
+                "last_batch_size": self._last_batch_size,
+                "avg_batch_size": self._events / self._batches if self._batches else 0.0,
+                "last_flush_latency_ms": self._last_flush_seconds * 1000,
+                "avg_flush_latency_ms": self._total_flush_seconds / self._batches * 1000 if self._batches else 0.0,
+                "max_flush_latency_ms": self._max_flush_seconds * 1000,
+            }
+
+    def _run(self) -> None:
+        while not (self._stopping.is_set() and self._queue.empty()):
+            batch = self._next_batch()
+            metrics.EVENT_BUFFER_DEPTH.set(self._queue.qsize()) # At least every 0.2s, and per batch
+            if batch:
+                self._flush(batch)
+
+    def _next_batch(self) -> List[PendingEvent]:
+        try:
+            first = self._queue.get(timeout=0.2)
+        except queue.Empty:
+            return []
+        batch = [first]
+        deadline = time.monotonic() + self.linger
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _flush(self, batch: List[PendingEvent]) -> None:
+        started = time.perf_counter()
+        try:
+            sinks = self.deliver([pending.event for pending in batch])
+        except Exception as e:
+            print(f"Event batch delivery failed: {e}. {len(batch)} events were not delivered.", file=sys.stderr)
+            sinks = ["failed"] * len(batch)
+        elapsed = time.perf_counter() - started
+        for pending, sink in zip(batch, sinks):
+            pending.resolve(sink)
+        with self._stats_lock:
+            self._batches += 1
+            self._events += len(batch)
+            self._last_batch_size = len(batch)
+            self._last_flush_seconds = elapsed
+            self._total_flush_seconds += elapsed
+            self._max_flush_seconds = max(self._max_flush_seconds, elapsed)
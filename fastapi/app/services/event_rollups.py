@@ -0,0 +1,158 @@
+# FastAPI app/services/event_rollups.py
+import contextlib
+from collections import Counter
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Union
+
+from sqlalchemy import delete, func, select
+from sqlalchemy.dialects import mysql, sqlite
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.orm import Session
+
+from app.models.models import EventModel, EventRollupModel
+
+GRANULARITIES = ("hour", "day")
+_BUCKET_FORMATS = {"hour": "%Y-%m-%d %H:00", "day": "%Y-%m-%d"} # Report keys; "day" matches Laravel's /reports/events
+_UPSERT_CHUNK = 1000 # Rollup rows per multi-row upsert
+
+RollupKey = Tuple[int, str, datetime, int, str] # (tenant_id, granularity, bucket, ad_id, event_type)
+
+
+def bucket_start(occurred_at: datetime, granularity: str) -> datetime:
+    if granularity == "hour":
+        return occurred_at.replace(minute=0, second=0, microsecond=0)
+    return occurred_at.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def rollup_counts(rows: Iterable[Dict[str, Any]]) -> Counter:
+    """Hourly and daily counts of event rows (dicts with tenant_id, ad_id, event_type and occurred_at)."""
+    counts: Counter = Counter()
+    for row in rows:
+        for granularity in GRANULARITIES:
+            counts[(row["tenant_id"], granularity, bucket_start(row["occurred_at"], granularity),
+                    row["ad_id"], row["event_type"])] += 1
+    return counts
+
+
+def upsert_rollups(db: Union[Session, Connection], counts: Dict[RollupKey, int]) -> int:
+    """
+    Add `counts` to the rollup table with multi-row upserts (INSERT ... ON DUPLICATE KEY
+    UPDATE on MySQL, ON CONFLICT on SQLite) in the caller's transaction, so rollups commit
+    or roll back together with the events they count. Returns the number of rollup rows.
+    """
+    if not counts:
+        return 0
+    table = EventRollupModel.__table__
+    dialect = (db.get_bind() if isinstance(db, Session) else db).dialect.name
+    if dialect == "mysql":
+        statement = mysql.insert(table)
+        statement = statement.on_duplicate_key_update(count=table.c["count"] + statement.inserted["count"])
+    else:
+        statement = sqlite.insert(table)
+        statement = statement.on_conflict_do_update(index_elements=list(table.primary_key.columns),
+                                                    set_={"count": table.c["count"] + statement.excluded["count"]})
+    # Sorted keys: concurrent sinks lock rollup rows in the same order and cannot deadlock
+    rows = [{"tenant_id": tenant_id, "granularity": granularity, "bucket": bucket, "ad_id": ad_id,
+             "event_type": event_type, "count": count}
+            for (tenant_id, granularity, bucket, ad_id, event_type), count in sorted(counts.items())]
+    for start in range(0, len(rows), _UPSERT_CHUNK):
+        db.execute(statement, rows[start:start + _UPSERT_CHUNK])
+    return len(rows)
+
+
+def _hour_bucket(dialect: str, column: Any) -> Any:
+    if dialect == "mysql":
+        return func.date_format(column, "%Y-%m-%d %H:00:00")
+    return func.strftime("%Y-%m-%d %H:00:00", column)
+
+
+def backfill_rollups(bind: Union[Engine, Connection], start: Optional[date] = None, end: Optional[date] = None) -> int:
+    """
+    Rebuild the rollups of the days `start` to `end` (inclusive; open-ended when None) from
+    the events table, in one transaction: the rollup rows of those days are deleted, then the
+    events are grouped by hour in SQL and the day rows are summed from the hour rows. Run it
+    for days the sink is not writing to (e.g. history before the rollups were deployed), since
+    events the sink inserts during the backfill may be counted twice or not at all.
+    Returns the number of rollup rows written.
+    """
+    events = EventModel.__table__
+    rollups = EventRollupModel.__table__
+    connection = bind.connect() if isinstance(bind, Engine) else bind
+    try:
+        dialect = connection.dialect.name
+        hour = _hour_bucket(dialect, events.c.occurred_at).label("hour")
+        query = (select(events.c.tenant_id, events.c.ad_id, events.c.event_type, hour, func.count().label("total"))
+                 .where(events.c.occurred_at.is_not(None))
+                 .group_by(events.c.tenant_id, events.c.ad_id, events.c.event_type, hour))
+        cleared = delete(rollups)
+        if start is not None:
+            query = query.where(events.c.occurred_at >= datetime.combine(start, datetime.min.time()))
+            cleared = cleared.where(rollups.c.bucket >= datetime.combine(start, datetime.min.time()))
+        if end is not None:
+            query = query.where(events.c.occurred_at < datetime.combine(end + timedelta(days=1), datetime.min.time()))
+            cleared = cleared.where(rollups.c.bucket < datetime.combine(end + timedelta(days=1), datetime.min.time()))
+
+        with connection.begin() if not connection.in_transaction() else contextlib.nullcontext():
+            connection.execute(cleared)
+            days: Counter = Counter()
+            written = 0
+            for chunk in connection.execution_options(stream_results=True).execute(query).partitions(_UPSERT_CHUNK):
+                hours: Counter = Counter()
+                for row in chunk:
+                    bucket = row.hour if isinstance(row.hour, datetime) else datetime.strptime(row.hour, "%Y-%m-%d %H:%M:%S")
+                    hours[(row.tenant_id, "hour", bucket, row.ad_id, row.event_type)] += row.total
+                    days[(row.tenant_id, "day", bucket_start(bucket, "day"), row.ad_id, row.event_type)] += row.total
+                written += upsert_rollups(connection, hours)
+            written += upsert_rollups(connection, days)
+        return written
+    finally:
+        if connection is not bind:
+            connection.close()
+
+
+def _rollup_totals(db: Session, granularity: str, tenant_id: Optional[int], start: Optional[date],
+                   end: Optional[date], ad_id: Optional[int]) -> List[Any]:
+    rollups = EventRollupModel.__table__
+    query = (select(rollups.c.bucket, rollups.c.event_type, func.sum(rollups.c["count"]).label("total"))
+             .where(rollups.c.granularity == granularity)
+             .group_by(rollups.c.bucket, rollups.c.event_type)
+             .order_by(rollups.c.bucket))
+    if tenant_id is not None:
+        query = query.where(rollups.c.tenant_id == tenant_id)
+    if ad_id is not None:
+        query = query.where(rollups.c.ad_id == ad_id)
+    if start is not None:
+        query = query.where(rollups.c.bucket >= datetime.combine(start, datetime.min.time()))
+    if end is not None:
+        query = query.where(rollups.c.bucket < datetime.combine(end + timedelta(days=1), datetime.min.time()))
+    return db.execute(query).all()
+
+
+def events_report(db: Session, tenant_id: Optional[int] = None, start: Optional[date] = None, end: Optional[date] = None,
+                  granularity: str = "day", ad_id: Optional[int] = None) -> Dict[str, Dict[str, int]]:
+    """
+    Impressions and clicks (and any other event type) per hour or day, read from the rollups:
+    `{"2025-07-01": {"impression": 100, "click": 10}, ...}`, the shape of Laravel's /reports/events.
+    The cost grows with the number of buckets and ads, not with the number of events.
+    """
+    if granularity not in GRANULARITIES:
+        raise ValueError(f"granularity must be one of {', '.join(GRANULARITIES)}")
+    report: Dict[str, Dict[str, int]] = {}
+    for row in _rollup_totals(db, granularity, tenant_id, start, end, ad_id):
+        counts = report.setdefault(row.bucket.strftime(_BUCKET_FORMATS[granularity]), {"impression": 0, "click": 0})
+        counts[row.event_type] = int(row.total)
+    return report
+
+
+def conversion_report(db: Session, tenant_id: Optional[int] = None, start: Optional[date] = None,
+                      end: Optional[date] = None, ad_id: Optional[int] = None) -> Dict[str, Any]:
+    """Total impressions, clicks and click-through rate (in percent) over the daily rollups."""
+    totals: Counter = Counter()
+    for row in _rollup_totals(db, "day", tenant_id, start, end, ad_id):
+        totals[row.event_type] += int(row.total)
+    impressions, clicks = totals["impression"], totals["click"]
+    return {
+        "impressions": impressions,
+        "clicks": clicks,
+        "conversion_rate": round(clicks / impressions * 100, 2) if impressions > 0 else 0.0,
+    }
@@ -0,0 +1,175 @@
+# FastAPI app/services/event_snapshot.py
+import json
+import os
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+
+import numpy as np
+from sqlalchemy import select
+from sqlalchemy.engine import Connection, Engine
+
+from app.models.models import EventModel
+
+# Directory of the columnar events snapshot written by export_events.py; empty disables it.
+EVENT_SNAPSHOT_DIR = os.getenv("EVENT_SNAPSHOT_DIR", "")
+# Rows fetched per round trip from the server-side cursor, and appended per write.
+EVENT_SNAPSHOT_CHUNK_SIZE = int(os.getenv("EVENT_SNAPSHOT_CHUNK_SIZE", "100000"))
+
+MANIFEST = "manifest.json"
+# Column name -> dtype. user_id is -1 for anonymous events, event_type indexes the manifest's `event_types`,
+# occurred_at is seconds since the epoch.
+COLUMNS: Dict[str, str] = {
+    "id": "<i8",
+    "tenant_id": "<i4",
+    "ad_id": "<i4",
+    "user_id": "<i8",
+    "event_type": "u1",
+    "occurred_at": "<i8",
+}
+
+
+def _empty_manifest() -> Dict:
+    return {"rows": 0, "last_id": 0, "event_types": [], "columns": dict(COLUMNS)}
+
+
+def read_manifest(directory: str) -> Optional[Dict]:
+    path = os.path.join(directory, MANIFEST)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def _write_manifest(directory: str, manifest: Dict) -> None:
+    # Written last and swapped in atomically: readers never see rows the column files do not hold yet
+    tmp = os.path.join(directory, MANIFEST + ".tmp")
+    with open(tmp, "w") as f:
+        json.dump(manifest, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, os.path.join(directory, MANIFEST))
+
+
+class EventSnapshot:
+    """
+    Read-only view of an exported events snapshot: one raw little-endian file per column,
+    memory-mapped, so loading costs no I/O until rows are touched and the pages are shared
+    by every process mapping the same files.
+    """
+
+    def __init__(self, directory: str, manifest: Dict):
+        self.directory = directory
+        self.rows: int = manifest["rows"]
+        self.last_id: int = manifest["last_id"]
+        self.event_types: List[str] = manifest["event_types"]
+        self.columns: Dict[str, np.ndarray] = {
+            name: self._map(name, dtype) for name, dtype in manifest["columns"].items()
+        }
+
+    @classmethod
+    def load(cls, directory: str) -> Optional["EventSnapshot"]:
+        """Map the snapshot in `directory`, or return None if nothing was exported there yet."""
+        manifest = read_manifest(directory)
+        return cls(directory, manifest) if manifest is not None else None
+
+    def _map(self, name: str, dtype: str) -> np.ndarray:
+        if self.rows == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(os.path.join(self.directory, name), dtype=dtype, mode="r", shape=(self.rows,))
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        return self.columns[name]
+
+    def event_type_code(self, event_type: str) -> Optional[int]:
+        return self.event_types.index(event_type) if event_type in self.event_types else None
+
+    def chunks(self, start: int = 0, chunk_size: int = EVENT_SNAPSHOT_CHUNK_SIZE) -> Iterator[Tuple[int, int]]:
+        """`(start, stop)` row ranges covering rows `start:` in bounded slices, for scans that should not page in everything at once."""
+        for chunk_start in range(start, self.rows, chunk_size):
+            yield chunk_start, min(chunk_start + chunk_size, self.rows)
+
+    def count_by(self, column: str, event_type: str, start: int = 0) -> Dict[int, int]:
+        """Number of `event_type` events per value of `column` (e.g. per ad_id) among rows `start:`."""
+        code = self.event_type_code(event_type)
+        if code is None:
+            return {}
+        totals = np.zeros(0, dtype=np.int64)
+        for chunk_start, chunk_stop in self.chunks(start):
+            matching = self.columns[column][chunk_start:chunk_stop][self.columns["event_type"][chunk_start:chunk_stop] == code]
+            counts = np.bincount(matching)
+            if len(counts) > len(totals):
+                counts[:len(totals)] += totals
+                totals = counts
+            else:
+                totals[:len(counts)] += counts
+        values = np.flatnonzero(totals)
+        return dict(zip(values.tolist(), totals[values].tolist()))
+
+
+def _truncate_columns(directory: str, manifest: Dict) -> None:
+    """Drop bytes past the manifest's row count, left behind by an export that died before its manifest was written."""
+    for name, dtype in manifest["columns"].items():
+        path = os.path.join(directory, name)
+        expected = manifest["rows"] * np.dtype(dtype).itemsize
+        if not os.path.exists(path):
+            open(path, "wb").close()
+        elif os.path.getsize(path) != expected:
+            os.truncate(path, expected)
+
+
+def export_events(bind: Union[Engine, Connection], directory: str, chunk_size: int = EVENT_SNAPSHOT_CHUNK_SIZE) -> int:
+    """
+    Append the events with an id above the snapshot's `last_id` to the snapshot in `directory`
+    (created if missing) and return the number of rows appended.
+
+    Rows are read in id order through a server-side cursor (`stream_results`), so memory stays
+    bounded by `chunk_size` whatever the size of the table. Each chunk is appended to the column
+    files and the manifest is rewritten after it, which makes the export resumable.
+    """
+    os.makedirs(directory, exist_ok=True)
+    manifest = read_manifest(directory) or _empty_manifest()
+    _truncate_columns(directory, manifest)
+
+    events = EventModel.__table__
+    query = (
+        select(events.c.id, events.c.tenant_id, events.c.ad_id, events.c.user_id, events.c.event_type, events.c.occurred_at)
+        .where(events.c.id > manifest["last_id"])
+        .order_by(events.c.id)
+    )
+    codes = {event_type: code for code, event_type in enumerate(manifest["event_types"])}
+    exported = 0
+    connection = bind.connect() if isinstance(bind, Engine) else bind
+    try:
+        result = connection.execution_options(stream_results=True, yield_per=chunk_size).execute(query)
+        for chunk in result.partitions(chunk_size):
+            columns = {
+                "id": [row.id for row in chunk],
+                "tenant_id": [row.tenant_id for row in chunk],
+                "ad_id": [row.ad_id for row in chunk],
+                "user_id": [row.user_id if row.user_id is not None else -1 for row in chunk],
+                "event_type": [codes.setdefault(row.event_type, len(codes)) for row in chunk],
+                "occurred_at": [int(_epoch(row.occurred_at)) for row in chunk],
+            }
+            if len(codes) > np.iinfo(np.uint8).max + 1:
+                raise ValueError("More than 256 distinct event types; widen the event_type column.")
+            for name, dtype in manifest["columns"].items():
+                with open(os.path.join(directory, name), "ab") as f:
+                    f.write(np.asarray(columns[name], dtype=dtype).tobytes())
+                    f.flush()
+                    os.fsync(f.fileno())
+            manifest["rows"] += len(chunk)
+            manifest["last_id"] = chunk[-1].id
+            manifest["event_types"] = sorted(codes, key=codes.get)
+            manifest["exported_at"] = datetime.now().isoformat()
+            _write_manifest(directory, manifest)
+            exported += len(chunk)
+    finally:
+        if connection is not bind:
+            connection.close()
+    return exported
+
+
+def _epoch(value) -> float:
+    if isinstance(value, datetime):
+        return value.timestamp()
+    return 0.0 if value is None else float(value)
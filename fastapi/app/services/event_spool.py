@@ -0,0 +1,281 @@
+# FastAPI app/services/event_spool.py
+import contextlib
+import fcntl
+import json
+import os
+import sys
+import threading
+import time
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from app.services import metrics
+
+# Directory of the local write-ahead spool, the last sink of the event fallback chain.
+EVENT_SPOOL_DIR = os.getenv("EVENT_SPOOL_DIR", "event_spool")
+# A segment is sealed and a new one started once it reaches this size.
+EVENT_SPOOL_SEGMENT_BYTES = int(os.getenv("EVENT_SPOOL_SEGMENT_BYTES", str(64 * 1024 * 1024)))
+# Longest time written events stay un-fsynced; 0 fsyncs every group commit.
+EVENT_SPOOL_FSYNC_INTERVAL = float(os.getenv("EVENT_SPOOL_FSYNC_INTERVAL", "0.2"))
+# Seconds between attempts to drain sealed segments back to Kafka, and events sent per attempt batch.
+EVENT_SPOOL_REPLAY_INTERVAL = float(os.getenv("EVENT_SPOOL_REPLAY_INTERVAL", "5"))
+EVENT_SPOOL_REPLAY_BATCH = int(os.getenv("EVENT_SPOOL_REPLAY_BATCH", "1000"))
+
+SEGMENT_SUFFIX = ".log"
+
+
+class EventSpool:
+    """
+    Segmented append-only spool of JSON-lines events.
+
+    Appends use group commit: concurrent callers queue their lines, one of them writes the
+    whole queue with a single `write` (and `fsync`, at most every `fsync_interval` seconds)
+    while the others wait for it. Every process writes its own segment, `flock`ed for as long
+    as it is active, and seals it at `segment_bytes`. `replay` hands sealed segments (and
+    segments left by dead processes) to a callback in batches, checkpointing the byte offset
+    after each batch and deleting a segment once it is fully sent, so delivery is at-least-once.
+    """
+
+    def __init__(self, directory: str = EVENT_SPOOL_DIR, segment_bytes: int = EVENT_SPOOL_SEGMENT_BYTES,
+                 fsync_interval: float = EVENT_SPOOL_FSYNC_INTERVAL, replay_interval: float = EVENT_SPOOL_REPLAY_INTERVAL,
+                 replay_batch: int = EVENT_SPOOL_REPLAY_BATCH):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.fsync_interval = fsync_interval
+        self.replay_interval = replay_interval
+        self.replay_batch = replay_batch
+        self._cond = threading.Condition()
+        self._pending: List[Tuple[int, bytes]] = []
+        self._next_seq = 1
+        self._committed = 0 # Highest sequence number written (or failed)
+        self._errors: Dict[int, Exception] = {}
+        self._busy = False # A thread owns the active segment (writing, syncing or sealing it)
+        self._fd: Optional[int] = None
+        self._size = 0
+        self._dirty = False # Written but not fsynced
+        self._synced_at = 0.0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def append(self, events: List[Dict[str, Any]]) -> None:
+        """Write events to the active segment; returns once they are written, raises if the write failed."""
+        data = "".join(json.dumps(event) + "\n" for event in events).encode()
+        with self._cond:
+            seq = self._next_seq
+            self._next_seq += 1
+            self._pending.append((seq, data))
+            while self._committed < seq:
+                if self._busy:
+                    self._cond.wait()
+                    continue
+                # Lead a group commit of everything queued so far, our own lines included
+                batch, self._pending = self._pending, []
+                self._busy = True
+                self._cond.release()
+                error = None
+                try:
+                    self._write(b"".join(chunk for _, chunk in batch))
+                except Exception as e:
+                    error = e
+                finally:
+                    self._cond.acquire()
+                    self._busy = False
+                    self._committed = batch[-1][0]
+                    if error is not None:
+                        self._errors.update((queued, error) for queued, _ in batch)
+                    self._cond.notify_all()
+            error = self._errors.pop(seq, None)
+        if error is not None:
+            raise error
+
+    def sync(self) -> None:
+        """fsync the active segment if it holds unsynced writes."""
+        with self._owned():
+            if self._fd is not None and self._dirty:
+                os.fsync(self._fd)
+                self._dirty = False
+                self._synced_at = time.monotonic()
+
+    def seal(self) -> bool:
+        """Seal the active segment if it holds events, making it replayable; returns whether it did."""
+        with self._owned():
+            if self._fd is None or self._size == 0:
+                return False
+            self._seal()
+            return True
+
+    def segments(self) -> List[str]:
+        """Paths of all segments, oldest first."""
+        if not os.path.isdir(self.directory):
+            return []
+        return [os.path.join(self.directory, name) for name in sorted(os.listdir(self.directory))
+                if name.endswith(SEGMENT_SUFFIX)]
+
+    def events(self) -> Iterator[Dict[str, Any]]:
+        """Every complete event still in the spool, oldest segment first."""
+        for path in self.segments():
+            with open(path, "rb") as f:
+                f.seek(_read_offset(path))
+                for line in f:
+                    if line.endswith(b"\n") and line.strip():
+                        yield json.loads(line)
+
+    def stats(self) -> Dict[str, int]:
+        sizes = [os.path.getsize(path) - _read_offset(path) for path in self.segments()]
+        return {"segments": len(sizes), "bytes": sum(sizes)}
+
+    def replay(self, send: Callable[[List[Dict[str, Any]]], Any]) -> int:
+        """
+        Pass spooled events to `send` in batches of `replay_batch`; `send` raises to stop
+        (the events stay spooled). Returns the number of events sent. Only one process
+        replays at a time; segments still being written by another process are skipped.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, "replay.lock"), "a") as lock:
+            try:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return 0 # Another process is replaying
+            try:
+                replayed = self._replay_sealed(send)
+                # Our own active segment last: sealing it while the sink is down would only pile up small segments
+                if self.seal():
+                    replayed += self._replay_sealed(send)
+                return replayed
+            finally:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+
+    def start(self, replay: Optional[Callable[[List[Dict[str, Any]]], Any]] = None) -> None:
+        """Run the fsync timer and, with `replay`, the replayer on a background thread."""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, args=(replay,), name="event-spool", daemon=True)
+        self._thread.start()
+
+    def close(self) -> None:
+        """Stop the background thread and fsync and seal the active segment."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(self.replay_interval + 5)
+            self._thread = None
+        with self._owned():
+            if self._fd is not None:
+                self._seal()
+
+    @contextlib.contextmanager
+    def _owned(self) -> Iterator[None]:
+        with self._cond:
+            while self._busy:
+                self._cond.wait()
+            self._busy = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._busy = False
+                self._cond.notify_all()
+
+    def _write(self, data: bytes) -> None:
+        # Called by the owner of the active segment
+        if self._fd is None:
+            self._open_segment()
+        view = memoryview(data)
+        while view:
+            view = view[os.write(self._fd, view):]
+        self._size += len(data)
+        now = time.monotonic()
+        if self.fsync_interval <= 0 or now - self._synced_at >= self.fsync_interval:
+            os.fsync(self._fd)
+            self._dirty = False
+            self._synced_at = now
+        else:
+            self._dirty = True
+        if self._size >= self.segment_bytes:
+            self._seal()
+
+    def _open_segment(self) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"segment-{time.time_ns():020d}-{os.getpid()}{SEGMENT_SUFFIX}")
+        # Locked before it gets its final name, so a replayer never takes a segment that is about to be written
+        fd = os.open(path + ".tmp", os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        os.rename(path + ".tmp", path)
+        self._fd, self._size, self._dirty, self._synced_at = fd, 0, False, time.monotonic()
+
+    def _seal(self) -> None:
+        if self._dirty:
+            os.fsync(self._fd)
+        os.close(self._fd) # Also releases the flock
+        self._fd, self._size, self._dirty = None, 0, False
+
+    def _replay_sealed(self, send: Callable[[List[Dict[str, Any]]], Any]) -> int:
+        replayed = 0
+        for path in self.segments():
+            with open(path, "rb") as f:
+                try:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue # Active segment of a live process
+                offset = _read_offset(path)
+                f.seek(offset)
+                batch: List[Dict[str, Any]] = []
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break # Torn tail of a process that died mid-write
+                    offset += len(line)
+                    try:
+                        if line.strip():
+                            batch.append(json.loads(line))
+                    except ValueError as e:
+                        print(f"Skipping corrupt spooled event in {path}: {e}", file=sys.stderr)
+                    if len(batch) >= self.replay_batch:
+                        send(batch)
+                        replayed += len(batch)
+                        batch = []
+                        _write_offset(path, offset)
+                if batch:
+                    send(batch)
+                    replayed += len(batch)
+            os.remove(path)
+            if os.path.exists(path + ".offset"):
+                os.remove(path + ".offset")
+        return replayed
+
+    def _run(self, replay: Optional[Callable[[List[Dict[str, Any]]], Any]]) -> None:
+        tick = min(self.fsync_interval, self.replay_interval) if self.fsync_interval > 0 else self.replay_interval
+        next_replay = time.monotonic() + self.replay_interval
+        while not self._stop.wait(tick):
+            try:
+                self.sync()
+            except Exception as e:
+                print(f"Event spool fsync failed: {e}", file=sys.stderr)
+            try:
+                metrics.EVENT_SPOOL_BYTES.set(self.stats()["bytes"])
+            except OSError as e: # A segment replayed by another process while we listed them
+                print(f"Reading event spool size failed: {e}", file=sys.stderr)
+            if replay is None or time.monotonic() < next_replay:
+                continue
+            next_replay = time.monotonic() + self.replay_interval
+            try:
+                replayed = self.replay(replay)
+                if replayed:
+                    print(f"Replayed {replayed} spooled events.")
+            except Exception as e:
+                print(f"Event spool replay stopped: {e}. Retrying in {self.replay_interval:.0f}s.", file=sys.stderr)
+
+
+def _read_offset(path: str) -> int:
+    try:
+        with open(path + ".offset") as f:
+            return int(f.read().strip() or 0)
+    except FileNotFoundError:
+        return 0
+
+
+def _write_offset(path: str, offset: int) -> None:
+    tmp = path + ".offset.tmp"
+    with open(tmp, "w") as f:
+        f.write(str(offset))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path + ".offset")
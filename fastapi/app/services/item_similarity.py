@@ -0,0 +1,188 @@
+# FastAPI app/services/item_similarity.py
+import os
+import sys
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from app.services.event_snapshot import EventSnapshot
+from app.services.shared_state import SharedState
+
+# Directory holding the similarity matrix versions written by build_similarity.py; empty disables the similarity term.
+ITEM_SIMILARITY_DIR = os.getenv("ITEM_SIMILARITY_DIR", "")
+ITEM_SIMILARITY_TOP_K = int(os.getenv("ITEM_SIMILARITY_TOP_K", "50")) # Neighbours kept per ad
+# Most recent distinct ads per user fed to the co-occurrence counts, so a few heavy users cannot dominate the build
+ITEM_SIMILARITY_MAX_USER_ADS = int(os.getenv("ITEM_SIMILARITY_MAX_USER_ADS", "200"))
+# Seconds between checks of the CURRENT pointer for a newer matrix
+ITEM_SIMILARITY_RELOAD_INTERVAL = float(os.getenv("ITEM_SIMILARITY_RELOAD_INTERVAL", "30"))
+
+_ARRAYS = ("ad_ids", "indptr", "indices", "data")
+_PAIRS_PER_CHUNK = 20_000_000 # Bounds the memory of one batch of generated (ad, ad) pairs
+_INTERACTIONS = ("impression", "click") # Event types that count as a user-ad interaction
+
+
+class SimilarityMatrix:
+    """
+    Top-K ad x ad cosine similarities in CSR layout, stored as four `.npy` files of a
+    `SharedState` version and loaded memory-mapped (so every worker process shares the pages):
+    `ad_ids` (sorted), `indptr`, `indices` (positions in `ad_ids`) and `data`.
+    Row i lists the neighbours of `ad_ids[i]`, most similar first.
+    """
+
+    def __init__(self, state: SharedState, version: str):
+        self.version = version
+        _, arrays = state.load(version)
+        self.ad_ids: np.ndarray = arrays["ad_ids"]
+        self.indptr: np.ndarray = arrays["indptr"]
+        self.indices: np.ndarray = arrays["indices"]
+        self.data: np.ndarray = arrays["data"]
+
+    def neighbours(self, ad_id: int) -> List[Tuple[int, float]]:
+        row = self._row(ad_id)
+        if row is None:
+            return []
+        start, stop = self.indptr[row], self.indptr[row + 1]
+        return list(zip(self.ad_ids[self.indices[start:stop]].tolist(), self.data[start:stop].tolist()))
+
+    def scores(self, ad_ids: Iterable[int]) -> Dict[int, float]:
+        """
+        Similarity of every neighbour of `ad_ids` (a user's recent ads) to that set: the sum of
+        its cosine similarities divided by the number of ads, so the term stays within [0, 1].
+        """
+        ad_ids = list(ad_ids)
+        slices = [(self.indptr[row], self.indptr[row + 1]) for row in map(self._row, ad_ids) if row is not None]
+        if not slices:
+            return {}
+        neighbours = np.concatenate([self.indices[start:stop] for start, stop in slices])
+        similarities = np.concatenate([self.data[start:stop] for start, stop in slices]).astype(np.float64)
+        positions, inverse = np.unique(neighbours, return_inverse=True)
+        totals = np.bincount(inverse, weights=similarities) / len(ad_ids)
+        return dict(zip(self.ad_ids[positions].tolist(), totals.tolist()))
+
+    def _row(self, ad_id: int) -> Optional[int]:
+        row = int(np.searchsorted(self.ad_ids, ad_id))
+        return row if row < len(self.ad_ids) and self.ad_ids[row] == ad_id else None
+
+
+class ItemSimilarity:
+    """
+    The similarity matrix currently published in `directory`. Requests read `current()`; at
+    most every `reload_interval` seconds one of them checks the CURRENT pointer and, when it
+    names a new version, maps it and swaps the reference. Requests holding the old matrix
+    finish on it, so a reload never drops or blocks a request.
+    """
+
+    def __init__(self, directory: Optional[str] = ITEM_SIMILARITY_DIR or None,
+                 reload_interval: float = ITEM_SIMILARITY_RELOAD_INTERVAL):
+        self.directory = directory
+        self.reload_interval = reload_interval
+        self._state = SharedState(directory) if directory else None
+        self._matrix: Optional[SimilarityMatrix] = None
+        self._checked_at: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def current(self) -> Optional[SimilarityMatrix]:
+        checked_at = self._checked_at
+        if self.directory and (checked_at is None or time.monotonic() - checked_at >= self.reload_interval):
+            self.reload()
+        return self._matrix
+
+    def reload(self) -> None:
+        if not self._lock.acquire(blocking=False):
+            return # Another request is already checking; keep serving the current matrix
+        try:
+            self._checked_at = time.monotonic()
+            version = self._state.current()
+            if version is None or (self._matrix is not None and self._matrix.version == version):
+                return
+            self._matrix = SimilarityMatrix(self._state, version)
+            print(f"Loaded item similarity matrix {version}.")
+        except Exception as e:
+            print(f"Item similarity reload failed: {e}. Serving the previous matrix.", file=sys.stderr)
+        finally:
+            self._lock.release()
+
+
+def _recent_user_ads(user_ids: np.ndarray, ad_rows: np.ndarray, max_user_ads: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Distinct (user, ad) pairs sorted by user, keeping each user's `max_user_ads` most recently seen ads."""
+    width = int(ad_rows.max()) + 1
+    # Events are in id order, so the first occurrence in reverse order is a pair's most recent one
+    keys, last_seen = np.unique((user_ids * width + ad_rows)[::-1], return_index=True)
+    last_seen = len(user_ids) - 1 - last_seen
+    users, ads = keys // width, keys % width
+    order = np.lexsort((-last_seen, users))
+    users, ads = users[order], ads[order]
+    group_starts = np.flatnonzero(np.r_[True, users[1:] != users[:-1]])
+    rank = np.arange(len(users)) - np.repeat(group_starts, np.diff(np.r_[group_starts, len(users)]))
+    keep = rank < max_user_ads
+    return users[keep], ads[keep]
+
+
+def _pair_counts(users: np.ndarray, ads: np.ndarray, n_ads: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Co-occurrence counts of every ordered pair of distinct ads, as `(left * n_ads + right, count)`."""
+    group_starts = np.flatnonzero(np.r_[True, users[1:] != users[:-1]]) if len(users) else np.zeros(0, dtype=np.int64)
+    group_sizes = np.diff(np.r_[group_starts, len(users)])
+    keys: List[np.ndarray] = []
+    counts: List[np.ndarray] = []
+    cumulative_pairs = np.cumsum(group_sizes.astype(np.int64) ** 2)
+    first = 0
+    while first < len(group_starts):
+        # Take whole users until the chunk would generate more than _PAIRS_PER_CHUNK pairs
+        before = cumulative_pairs[first - 1] if first else 0
+        last = max(first + 1, int(np.searchsorted(cumulative_pairs, before + _PAIRS_PER_CHUNK, side="right")))
+        starts, sizes = group_starts[first:last], group_sizes[first:last]
+        element_start = np.repeat(starts, sizes) # For every interaction, the first interaction of its user
+        element_size = np.repeat(sizes, sizes)
+        element_ads = ads[starts[0]:starts[-1] + sizes[-1]]
+        left = np.repeat(element_ads, element_size)
+        block_start = np.repeat(np.cumsum(element_size) - element_size, element_size)
+        right = ads[np.repeat(element_start, element_size) + np.arange(len(left)) - block_start]
+        distinct = left != right
+        chunk_keys, chunk_counts = np.unique(left[distinct] * n_ads + right[distinct], return_counts=True)
+        keys.append(chunk_keys)
+        counts.append(chunk_counts)
+        first = last
+    if not keys:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    merged, inverse = np.unique(np.concatenate(keys), return_inverse=True)
+    return merged, np.bincount(inverse, weights=np.concatenate(counts)).astype(np.int64)
+
+
+def compute_similarity(snapshot: EventSnapshot, top_k: int = ITEM_SIMILARITY_TOP_K,
+                       max_user_ads: int = ITEM_SIMILARITY_MAX_USER_ADS) -> Dict[str, np.ndarray]:
+    """
+    Binary item-item cosine similarity from the user-ad interactions of an events snapshot:
+    `sim(i, j) = users(i and j) / sqrt(users(i) * users(j))`, keeping the `top_k` most
+    similar neighbours of every ad. Returns the CSR arrays stored by `SimilarityMatrix`.
+    """
+    codes = [code for code in map(snapshot.event_type_code, _INTERACTIONS) if code is not None]
+    user_ids = np.asarray(snapshot["user_id"])
+    mask = np.isin(np.asarray(snapshot["event_type"]), codes) & (user_ids >= 0)
+    ad_ids, ad_rows = np.unique(np.asarray(snapshot["ad_id"])[mask].astype(np.int64), return_inverse=True)
+    if len(ad_ids) == 0:
+        return {"ad_ids": ad_ids, "indptr": np.zeros(1, dtype=np.int64),
+                "indices": np.zeros(0, dtype=np.int32), "data": np.zeros(0, dtype=np.float32)}
+
+    users, ads = _recent_user_ads(user_ids[mask], ad_rows, max_user_ads)
+    ad_users = np.bincount(ads, minlength=len(ad_ids)).astype(np.float64)
+    keys, counts = _pair_counts(users, ads, len(ad_ids))
+    left, right = keys // len(ad_ids), keys % len(ad_ids)
+    similarity = counts / np.sqrt(ad_users[left] * ad_users[right])
+
+    # Per row, best first (ties by neighbour position), then cut every row to top_k
+    order = np.lexsort((right, -similarity, left))
+    left, right, similarity = left[order], right[order], similarity[order]
+    row_sizes = np.bincount(left, minlength=len(ad_ids))
+    rank = np.arange(len(left)) - np.repeat(np.cumsum(row_sizes) - row_sizes, row_sizes)
+    keep = rank < top_k
+    indptr = np.zeros(len(ad_ids) + 1, dtype=np.int64)
+    np.cumsum(np.minimum(row_sizes, top_k), out=indptr[1:])
+    return {"ad_ids": ad_ids, "indptr": indptr, "indices": right[keep].astype(np.int32),
+            "data": similarity[keep].astype(np.float32)}
+
+
+def publish_similarity(arrays: Dict[str, np.ndarray], directory: str) -> str:
+    """Publish the arrays of `compute_similarity` as a new version of the `directory` state; returns the version."""
+    return SharedState(directory).publish({name: arrays[name] for name in _ARRAYS}, {"neighbours": len(arrays["data"])})
@@ -0,0 +1,127 @@
+# FastAPI app/services/metrics.py
+import os
+import threading
+import time
+from typing import Any, Optional, Tuple
+
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
+
+# With several worker processes, every process writes its samples to files in this directory and /metrics
+# aggregates them. The container entrypoint empties it on start; creating it here keeps a process started
+# any other way from failing on the first metric it defines.
+PROMETHEUS_MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR", "")
+if PROMETHEUS_MULTIPROC_DIR:
+    os.makedirs(PROMETHEUS_MULTIPROC_DIR, exist_ok=True)
+
+# Recommendation stages take microseconds to milliseconds, finer than the default buckets
+_STAGE_BUCKETS = (.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1.0, 2.5)
+
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds", "HTTP request latency by route template.", ["method", "route", "status"])
+RECOMMENDATION_STAGE_LATENCY = Histogram(
+    "recommendation_stage_duration_seconds", "Time spent in each stage of enhanced_collaborative_filtering.",
+    ["stage"], buckets=_STAGE_BUCKETS)
+EVENTS_LOGGED = Counter(
+    "events_logged_total", "Events written, by the sink that took them (kafka, redis or file).", ["sink"])
+EVENT_SINK_FAILURES = Counter(
+    "event_sink_failures_total", "Events a sink could not take, so they fell back to the next one.", ["sink"])
+DB_POOL_CHECKOUT_WAIT = Histogram(
+    "db_pool_checkout_wait_seconds", "Time spent waiting for a connection from a SQLAlchemy pool.",
+    ["pool"], buckets=_STAGE_BUCKETS)
+# Gauges are set where their value changes, never through set_function callbacks, which multiprocess
+# mode cannot export. Per-process values are summed over the live workers; the spool directory is shared,
+# so every worker reports the same total and the largest live value is exported.
+DB_POOL_CONNECTIONS = Gauge(
+    "db_pool_connections", "SQLAlchemy pool connections by state.", ["pool", "state"], multiprocess_mode="livesum")
+KAFKA_PRODUCER_QUEUE_DEPTH = Gauge(
+    "kafka_producer_queue_depth", "Records handed to the Kafka producer and not yet acknowledged by the broker.",
+    multiprocess_mode="livesum")
+EVENT_BUFFER_DEPTH = Gauge(
+    "event_buffer_queue_depth", "Events waiting in the asynchronous ingestion buffer.", multiprocess_mode="livesum")
+EVENT_SPOOL_BYTES = Gauge(
+    "event_spool_bytes", "Bytes of spooled events not yet replayed to Kafka.", multiprocess_mode="livemax")
+EVENTS_REPLAYED = Counter("events_replayed_total", "Spooled events replayed to Kafka.")
+EVENT_SINK_CIRCUIT_STATE = Gauge(
+    "event_sink_circuit_state", "Circuit breaker state of each event sink: 0 closed, 1 half-open, 2 open.", ["sink"])
+SINGLE_FLIGHT_CALLS = Counter(
+    "single_flight_calls_total",
+    "Coalesced computations: leaders ran one, followers waited for a leader's result instead.", ["flight", "role"])
+STARTUP_DURATION = Gauge(
+    "app_startup_duration_seconds",
+    "Seconds spent importing main, running the startup hook, and warming up the recommender state.", ["phase"])
+
+
+class InFlightRecords:
+    """Counts Kafka records between `send()` and the broker's acknowledgement (or failure), exported as `gauge`."""
+
+    def __init__(self, gauge: Optional[Gauge] = None):
+        self.gauge = gauge
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def track(self, future: Any) -> Any:
+        add_both = getattr(future, "add_both", None)
+        if add_both is not None:
+            with self._lock:
+                self._count += 1
+                if self.gauge is not None:
+                    self.gauge.set(self._count)
+            add_both(self._done)
+        return future
+
+    def _done(self, _result: Any) -> None:
+        with self._lock:
+            self._count -= 1
+            if self.gauge is not None:
+                self.gauge.set(self._count)
+
+    def __call__(self) -> int:
+        return self._count
+
+
+def instrument_pool(pool: Any, name: str) -> None:
+    """
+    Time every connection checkout of a SQLAlchemy pool and export its size as gauges,
+    labelled `name`, updated whenever a connection is checked out or returned.
+    For an async engine, pass `async_engine.sync_engine.pool`.
+    """
+    connect, return_conn = pool.connect, pool._return_conn
+    checkout_wait = DB_POOL_CHECKOUT_WAIT.labels(name)
+    sizes = [(DB_POOL_CONNECTIONS.labels(name, state), getattr(pool, reader))
+             for state, reader in (("checked_out", "checkedout"), ("idle", "checkedin"), ("overflow", "overflow"))
+             if hasattr(pool, reader)]
+
+    def update_sizes():
+        for gauge, read in sizes:
+            gauge.set(read())
+
+    def timed_connect():
+        started = time.perf_counter()
+        try:
+            return connect()
+        finally:
+            checkout_wait.observe(time.perf_counter() - started)
+            update_sizes()
+
+    def counted_return(record):
+        try:
+            return_conn(record)
+        finally:
+            update_sizes()
+
+    pool.connect = timed_connect
+    pool._return_conn = counted_return # Every checkin ends here, after the connection is back in the pool
+    update_sizes()
+
+
+def render() -> Tuple[bytes, str]:
+    """
+    Return the exposition payload and its content type. With several uvicorn workers, set
+    PROMETHEUS_MULTIPROC_DIR so every metric is aggregated over all workers (gauges as
+    declared by their `multiprocess_mode`).
+    """
+    if PROMETHEUS_MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(), CONTENT_TYPE_LATEST
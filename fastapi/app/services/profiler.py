@@ -0,0 +1,76 @@
+# FastAPI app/services/profiler.py
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Dict, Optional
+
+# Longest profile /admin/profile runs, and the shortest interval between two samples
+PROFILER_MAX_SECONDS = float(os.getenv("PROFILER_MAX_SECONDS", "60"))
+PROFILER_MIN_INTERVAL = 0.001
+
+
+class SamplingProfiler:
+    """
+    Wall-clock sampling profiler over all threads of the process. Every `interval` seconds
+    it reads the current frame of each thread with `sys._current_frames()` and counts the
+    stacks, so the profiled code runs unmodified and the cost is one stack walk per thread
+    and sample. Only one profile runs at a time.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self._lock.locked()
+
+    def profile(self, seconds: float, interval: float = 0.01, idle: bool = False) -> Optional[Counter]:
+        """
+        Sample for `seconds` and return the count of each collapsed stack ("thread;outer;...;inner"),
+        or None if another profile is running. Samples of idle threads (waiting on a condition or
+        queue, or an event loop waiting in its selector) are left out unless `idle` is set.
+        """
+        if not self._lock.acquire(blocking=False):
+            return None
+        try:
+            seconds = min(max(seconds, 0.0), PROFILER_MAX_SECONDS)
+            interval = max(interval, PROFILER_MIN_INTERVAL)
+            stacks: Counter = Counter()
+            own = threading.get_ident()
+            deadline = time.perf_counter() + seconds
+            while True:
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+                for ident, frame in sys._current_frames().items():
+                    if ident == own or (not idle and _is_idle(frame)):
+                        continue
+                    stacks[_collapse(names.get(ident, str(ident)), frame)] += 1
+                if time.perf_counter() + interval > deadline:
+                    return stacks
+                time.sleep(interval)
+        finally:
+            self._lock.release()
+
+
+def render_collapsed(stacks: Dict[str, int]) -> str:
+    """The collapsed-stack format of flamegraph.pl and speedscope: one "frames count" line per stack."""
+    return "".join(f"{stack} {count}\n" for stack, count in sorted(stacks.items()))
+
+
+# Innermost Python functions of threads that are blocked: lock and queue waits, the event loop's selector
+_IDLE_FUNCTIONS = {"wait", "select", "poll", "accept"}
+
+
+def _is_idle(frame) -> bool:
+    return frame.f_code.co_name in _IDLE_FUNCTIONS
+
+
+def _collapse(thread_name: str, frame) -> str:
+    frames = []
+    while frame is not None:
+        code = frame.f_code
+        frames.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})".replace(";", ":"))
+        frame = frame.f_back
+    frames.append(thread_name.replace(";", ":"))
+    return ";".join(reversed(frames))
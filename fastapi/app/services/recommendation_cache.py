@@ -0,0 +1,240 @@
+# FastAPI app/services/recommendation_cache.py
+import asyncio
+import json
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from app.services.single_flight import SingleFlight
+
+# Seconds a cached recommendation list is considered fresh
+RECOMMENDATION_CACHE_TTL = float(os.getenv("RECOMMENDATION_CACHE_TTL", "60"))
+# Extra seconds a stale entry may still be served while a background refresh recomputes it (0 disables)
+RECOMMENDATION_CACHE_STALE_TTL = float(os.getenv("RECOMMENDATION_CACHE_STALE_TTL", "300"))
+# In-process LRU tier in front of Redis
+RECOMMENDATION_CACHE_LOCAL_SIZE = int(os.getenv("RECOMMENDATION_CACHE_LOCAL_SIZE", "10000"))
+# Invalidations only reach the local tier of the process that logged the click, so other
+# processes re-read Redis once their local copy is older than this.
+RECOMMENDATION_CACHE_LOCAL_TTL = float(os.getenv("RECOMMENDATION_CACHE_LOCAL_TTL", "5"))
+# Threads recomputing stale entries, and how many refreshes may wait for one; beyond that stale entries
+# are served without scheduling a refresh until they expire.
+RECOMMENDATION_CACHE_REFRESH_WORKERS = int(os.getenv("RECOMMENDATION_CACHE_REFRESH_WORKERS", "4"))
+RECOMMENDATION_CACHE_REFRESH_BACKLOG = int(os.getenv("RECOMMENDATION_CACHE_REFRESH_BACKLOG", "1000"))
+
+Entry = Tuple[float, List[Dict[str, Any]]] # (computed_at, recommendations)
+
+
+class RecommendationCache:
+    """
+    Per (tenant, user) cache of recommendation lists with an in-process LRU tier in
+    front of Redis. Redis errors are treated as misses so the cache never fails a request.
+    Concurrent misses for the same entry are coalesced: one caller computes it, the
+    others wait for its result. A result computed (or refreshed) across an `invalidate()`
+    of its entry is dropped instead of stored, so a click is never followed by a list
+    computed before it.
+    """
+
+    def __init__(self, redis_client: Callable[[], Any], ttl: float = RECOMMENDATION_CACHE_TTL,
+                 stale_ttl: float = RECOMMENDATION_CACHE_STALE_TTL, local_size: int = RECOMMENDATION_CACHE_LOCAL_SIZE,
+                 local_ttl: float = RECOMMENDATION_CACHE_LOCAL_TTL, refresh_workers: int = RECOMMENDATION_CACHE_REFRESH_WORKERS,
+                 refresh_backlog: int = RECOMMENDATION_CACHE_REFRESH_BACKLOG):
+        self.redis_client = redis_client # Called on every use, so a reconnected client is picked up
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.local_size = local_size
+        self.local_ttl = local_ttl
+        self._local: "OrderedDict[str, Tuple[float, Entry]]" = OrderedDict() # key -> (cached_locally_at, entry)
+        self._lock = threading.Lock()
+        self._refreshing: set = set()
+        self._refresher = ThreadPoolExecutor(max_workers=refresh_workers, thread_name_prefix="reco-refresh")
+        self.refresh_backlog = refresh_backlog
+        self._flight = SingleFlight("recommendation")
+        # Generation of each entry's last invalidation; a computation records the current generation
+        # when it starts and its result is dropped if the entry was invalidated since. Bounded like the
+        # local tier: a forgotten entry counts as invalidated at the highest forgotten generation.
+        self._generation = 0
+        self._invalidated: "OrderedDict[str, int]" = OrderedDict()
+        self._forgotten = 0
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(tenant_id: Optional[int], user_id: int) -> str:
+        return f"reco:{tenant_id if tenant_id is not None else 'all'}:{user_id}"
+
+    def get_or_compute(self, tenant_id: Optional[int], user_id: int, compute: Callable[[], List[Dict[str, Any]]],
+                       refresh: Optional[Callable[[], List[Dict[str, Any]]]] = None) -> List[Dict[str, Any]]:
+        """
+        Return cached recommendations, calling `compute` on a miss. A stale entry is
+        returned as-is while `refresh` (which must not depend on the caller's request
+        state, e.g. its DB session) recomputes it in the background.
+        """
+        key = self.key(tenant_id, user_id)
+        entry = self._fresh_or_stale(key, refresh)
+        if entry is not None:
+            return entry
+
+        def compute_and_set():
+            generation = self._current_generation()
+            return self._stored(key, compute(), generation)
+
+        return self._flight.do(key, compute_and_set)
+
+    async def get_or_compute_async(self, tenant_id: Optional[int], user_id: int,
+                                   compute: Callable[[], Awaitable[List[Dict[str, Any]]]],
+                                   refresh: Optional[Callable[[], List[Dict[str, Any]]]] = None) -> List[Dict[str, Any]]:
+        """
+        `get_or_compute` for async handlers: `compute` returns an awaitable, `refresh` stays synchronous.
+        Local hits are served on the event loop; Redis reads and writes run in a worker thread.
+        """
+        key = self.key(tenant_id, user_id)
+        fresh, cached = self._get_local(key)
+        entry = cached[1] if fresh else await asyncio.to_thread(self._get_remote, key, cached)
+        recommendations = self._serve(key, entry, refresh)
+        if recommendations is not None:
+            return recommendations
+
+        async def compute_and_set():
+            generation = self._current_generation()
+            recommendations = await compute()
+            await asyncio.to_thread(self.set, key, recommendations, generation)
+            return recommendations
+
+        return await self._flight.do_async(key, compute_and_set)
+
+    def _stored(self, key: str, recommendations: List[Dict[str, Any]], generation: int) -> List[Dict[str, Any]]:
+        self.set(key, recommendations, generation)
+        return recommendations
+
+    def _fresh_or_stale(self, key: str, refresh: Optional[Callable[[], List[Dict[str, Any]]]]) -> Optional[List[Dict[str, Any]]]:
+        return self._serve(key, self._get(key), refresh)
+
+    def _serve(self, key: str, entry: Optional[Entry], refresh: Optional[Callable[[], List[Dict[str, Any]]]]) -> Optional[List[Dict[str, Any]]]:
+        """Return a servable cached list (scheduling a refresh if stale), or None after counting a miss."""
+        if entry is not None:
+            age = time.time() - entry[0]
+            if age < self.ttl:
+                self.hits += 1
+                return entry[1]
+            if refresh is not None and age < self.ttl + self.stale_ttl:
+                self.stale_hits += 1
+                self._refresh_in_background(key, refresh)
+                return entry[1]
+        self.misses += 1
+        return None
+
+    def set(self, key: str, recommendations: List[Dict[str, Any]], generation: Optional[int] = None) -> None:
+        """
+        Store an entry. With `generation` (`_current_generation()` from before the computation
+        started), the entry is dropped if it was invalidated in between.
+        """
+        if not recommendations:
+            return # Empty lists come from fallbacks (e.g. the DB being down); don't pin them
+        entry = (time.time(), recommendations)
+        with self._lock:
+            if generation is not None and self._invalidated_since(key, generation):
+                return
+            self._set_local_locked(key, entry)
+        client = self.redis_client()
+        if client is not None:
+            try:
+                client.set(key, json.dumps({"computed_at": entry[0], "recommendations": recommendations}),
+                           ex=max(1, int(self.ttl + self.stale_ttl)))
+                if generation is not None and self._invalidated_since(key, generation):
+                    client.delete(key) # Invalidated while we were writing; its DEL may have run first
+            except Exception as e:
+                print(f"Recommendation cache write to Redis failed: {e}", file=sys.stderr)
+
+    def invalidate(self, tenant_id: Optional[int], user_id: int) -> None:
+        """Drop the user's entries for the tenant and for the tenant-less /recommend call."""
+        keys = {self.key(tenant_id, user_id), self.key(None, user_id)}
+        with self._lock:
+            self._generation += 1
+            for key in keys:
+                self._local.pop(key, None)
+                self._invalidated[key] = self._generation
+                self._invalidated.move_to_end(key)
+            while len(self._invalidated) > self.local_size:
+                self._forgotten = max(self._forgotten, self._invalidated.popitem(last=False)[1])
+        client = self.redis_client()
+        if client is not None:
+            try:
+                client.delete(*keys)
+            except Exception as e:
+                print(f"Recommendation cache invalidation in Redis failed: {e}", file=sys.stderr)
+
+    def clear_local(self) -> None:
+        with self._lock:
+            self._local.clear()
+
+    def _get(self, key: str) -> Optional[Entry]:
+        fresh, cached = self._get_local(key)
+        return cached[1] if fresh else self._get_remote(key, cached)
+
+    def _get_local(self, key: str) -> Tuple[bool, Optional[Tuple[float, Entry]]]:
+        """The local copy of an entry, and whether it is recent enough to skip Redis."""
+        with self._lock:
+            cached = self._local.get(key)
+            if cached is not None and time.time() - cached[0] < self.local_ttl:
+                self._local.move_to_end(key)
+                return True, cached
+        return False, cached
+
+    def _get_remote(self, key: str, cached: Optional[Tuple[float, Entry]]) -> Optional[Entry]:
+        """Read an entry from Redis, falling back to the local copy while Redis is unavailable."""
+        client = self.redis_client()
+        if client is None:
+            return cached[1] if cached is not None else None
+        try:
+            raw = client.get(key)
+        except Exception as e:
+            print(f"Recommendation cache read from Redis failed: {e}", file=sys.stderr)
+            return cached[1] if cached is not None else None
+        if raw is None:
+            with self._lock:
+                self._local.pop(key, None) # Invalidated (or expired) in Redis
+            return None
+        payload = json.loads(raw)
+        entry = (payload["computed_at"], payload["recommendations"])
+        self._set_local(key, entry)
+        return entry
+
+    def _set_local(self, key: str, entry: Entry) -> None:
+        with self._lock:
+            self._set_local_locked(key, entry)
+
+    def _set_local_locked(self, key: str, entry: Entry) -> None:
+        self._local[key] = (time.time(), entry)
+        self._local.move_to_end(key)
+        while len(self._local) > self.local_size:
+            self._local.popitem(last=False)
+
+    def _current_generation(self) -> int:
+        with self._lock:
+            return self._generation
+
+    def _invalidated_since(self, key: str, generation: int) -> bool:
+        return self._invalidated.get(key, self._forgotten) > generation
+
+    def _refresh_in_background(self, key: str, refresh: Callable[[], List[Dict[str, Any]]]) -> None:
+        with self._lock:
+            if key in self._refreshing or len(self._refreshing) >= self.refresh_backlog:
+                return # Already being recomputed, or the refreshers are saturated: keep serving the stale entry
+            self._refreshing.add(key)
+            generation = self._generation
+
+        def run():
+            try:
+                self.set(key, refresh(), generation)
+            except Exception as e:
+                print(f"Background refresh of {key} failed: {e}", file=sys.stderr)
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+
+        self._refresher.submit(run)
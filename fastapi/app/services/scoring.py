@@ -0,0 +1,224 @@
+# FastAPI app/services/scoring.py
+import threading
+import time
+from typing import Any, Dict, Hashable, Iterable, List, Mapping, Optional, Sequence, Set, Tuple
+
+import numpy as np
+
+from app.services.ad_catalog import CatalogSnapshot
+
+# Weight of the general popularity (CTR) term, scaled down to not overpower personalization
+CTR_WEIGHT = 0.5
+# Weight of the item-to-item similarity term (mean cosine similarity to the user's recent ads, in [0, 1])
+SIMILARITY_WEIGHT = 1.0
+
+# Users scored per users x ads matrix in batch ranking
+_BATCH_ROWS = 64
+
+
+def rank_ads_python(all_ads_data: Mapping[int, Dict[str, Any]], tag_scores: Mapping[str, float],
+                    ad_ctrs: Mapping[int, float], exclude: Set[int], top_n: int,
+                    candidates: Optional[Iterable[int]] = None, timings: Optional[Dict[str, float]] = None,
+                    similarity: Optional[Mapping[int, float]] = None) -> List[int]:
+    """
+    Reference implementation: score every ad (or only the `candidates` ad ids, given in
+    catalog order) with dict lookups and sort all of them. `similarity` maps ad ids to their
+    item-to-item similarity with the user's recent ads (see `SimilarityMatrix.scores`).
+    Returns up to `top_n` ad ids with a positive score, best first. Seconds spent scoring
+    and sorting are added to `timings["score"]` and `timings["sort"]` if given.
+    """
+    started = time.perf_counter()
+    ad_scores: Dict[int, float] = {}
+    for ad_id in (all_ads_data if candidates is None else candidates):
+        ad_info = all_ads_data[ad_id]
+        if ad_id in exclude:
+            continue # Do not recommend ads the user has already interacted with recently
+
+        current_ad_score = 0.0
+        if "tags" in ad_info:
+            for tag in ad_info["tags"]:
+                current_ad_score += tag_scores.get(tag, 0.0) # Add score from collaborative filtering
+
+        # Add a component for general popularity (CTR), scaled down to not overpower personalization
+        current_ad_score += ad_ctrs.get(ad_id, 0) * CTR_WEIGHT
+
+        # Add the item-to-item collaborative filtering term
+        if similarity:
+            current_ad_score += similarity.get(ad_id, 0.0) * SIMILARITY_WEIGHT
+
+        ad_scores[ad_id] = current_ad_score
+
+    scored = time.perf_counter()
+    sorted_ads = sorted(ad_scores.items(), key=lambda item: item[1], reverse=True)
+
+    ranked = []
+    for ad_id, score in sorted_ads:
+        if score > 0: # Only recommend ads with a positive score
+            ranked.append(ad_id)
+            if len(ranked) >= top_n:
+                break
+    if timings is not None:
+        _add_timings(timings, scored - started, time.perf_counter() - scored)
+    return ranked
+
+
+def _add_timings(timings: Dict[str, float], score_seconds: float, sort_seconds: float) -> None:
+    timings["score"] = timings.get("score", 0.0) + score_seconds
+    timings["sort"] = timings.get("sort", 0.0) + sort_seconds
+
+
+class _TagMatrix:
+    """
+    Ad x tag matrix of one catalog snapshot in ELLPACK layout: row i holds the tag
+    indices of ad i, padded with the index of an always-zero slot. Summing the
+    gathered weights column by column is a sparse matrix-vector product that adds
+    the terms in the same order as the reference loop, so both engines produce
+    bit-identical scores and therefore identical rankings.
+    """
+
+    def __init__(self, snapshot: CatalogSnapshot):
+        self.snapshot = snapshot
+        self.ad_ids = np.fromiter(snapshot.ads.keys(), dtype=np.int64, count=len(snapshot.ads))
+        self.row_of = {int(ad_id): row for row, ad_id in enumerate(self.ad_ids)}
+        self.tag_index: Dict[str, int] = {}
+        rows = []
+        for ad_info in snapshot.ads.values():
+            rows.append([self.tag_index.setdefault(tag, len(self.tag_index)) for tag in ad_info.get("tags", ())])
+        self.pad = len(self.tag_index)
+        width = max((len(row) for row in rows), default=0)
+        self.tags = np.full((len(rows), width), self.pad, dtype=np.int32)
+        for row, tag_ids in enumerate(rows):
+            self.tags[row, :len(tag_ids)] = tag_ids
+
+    def user_vector(self, tag_scores: Mapping[str, float]) -> np.ndarray:
+        weights = np.zeros(self.pad + 1, dtype=np.float64)
+        for tag, score in tag_scores.items():
+            column = self.tag_index.get(tag)
+            if column is not None:
+                weights[column] = score
+        return weights
+
+    def scores(self, weights: np.ndarray, rows: Optional[np.ndarray] = None) -> np.ndarray:
+        """Score every ad (or the ads at `rows`) for one user vector, or for each row of a users x tags matrix."""
+        tags = self.tags if rows is None else self.tags[rows]
+        scores = np.zeros(weights.shape[:-1] + (len(tags),), dtype=np.float64)
+        for column in range(tags.shape[1]):
+            scores += weights[..., tags[:, column]]
+        return scores
+
+
+class NumpyScorer:
+    """
+    Vectorized scoring engine. The tag matrix is rebuilt only when the catalog
+    snapshot changes and the CTR vector only when the CTR counters change, so a
+    request costs a handful of array operations plus a partial sort.
+    """
+
+    def __init__(self):
+        self._matrix: Optional[_TagMatrix] = None
+        self._ctr_key: Optional[Tuple[int, Hashable]] = None
+        self._ctr_vector: Optional[np.ndarray] = None
+        self._lock = threading.Lock()
+
+    def rank(self, snapshot: CatalogSnapshot, tag_scores: Mapping[str, float], ad_ctrs: Mapping[int, float],
+             exclude: Set[int], top_n: int, ctr_version: Optional[Hashable] = None,
+             candidate_rows: Optional[np.ndarray] = None, similarity: Optional[Mapping[int, float]] = None) -> List[int]:
+        """
+        Same contract as `rank_ads_python`, `ctr_version` identifies the state of `ad_ctrs` for caching.
+        `candidate_rows` are sorted catalog positions (as returned by the snapshot's `CandidateIndex`).
+        """
+        return self.rank_many(snapshot, [(tag_scores, exclude)], ad_ctrs, top_n, ctr_version,
+                              None if candidate_rows is None else [candidate_rows],
+                              similarity=None if similarity is None else [similarity])[0]
+
+    def rank_many(self, snapshot: CatalogSnapshot, profiles: Sequence[Tuple[Mapping[str, float], Set[int]]],
+                  ad_ctrs: Mapping[int, float], top_n: int, ctr_version: Optional[Hashable] = None,
+                  candidate_rows: Optional[Sequence[np.ndarray]] = None,
+                  timings: Optional[Dict[str, float]] = None,
+                  similarity: Optional[Sequence[Mapping[int, float]]] = None) -> List[List[int]]:
+        """
+        Rank the catalog for several users at once. Each profile is a `(tag_scores, exclude)` pair;
+        users are scored together as a users x ads matrix, `_BATCH_ROWS` users at a time to bound memory.
+        With `candidate_rows` (one sorted row array per profile) only the union of a chunk's
+        candidates is scored and every user is restricted to their own candidates.
+        `similarity` (one mapping per profile) and `timings` work as in `rank_ads_python`.
+        """
+        started = time.perf_counter()
+        sort_seconds = 0.0
+        matrix, ctr_vector = self._prepare(snapshot, ad_ctrs, ctr_version)
+        if len(matrix.ad_ids) == 0 or top_n <= 0:
+            return [[] for _ in profiles]
+
+        ranked: List[List[int]] = []
+        for start in range(0, len(profiles), _BATCH_ROWS):
+            chunk = profiles[start:start + _BATCH_ROWS]
+            weights = np.stack([matrix.user_vector(tag_scores) for tag_scores, _ in chunk])
+            if candidate_rows is None:
+                rows = None
+                scores = matrix.scores(weights)
+                scores += ctr_vector
+            else:
+                chunk_rows = candidate_rows[start:start + _BATCH_ROWS]
+                rows = chunk_rows[0] if len(chunk_rows) == 1 else np.unique(np.concatenate(chunk_rows))
+                scores = matrix.scores(weights, rows)
+                scores += ctr_vector[rows]
+                if len(chunk_rows) > 1:
+                    for row_scores, user_rows in zip(scores, chunk_rows):
+                        row_scores[~np.isin(rows, user_rows, assume_unique=True)] = -np.inf
+            ad_ids = matrix.ad_ids if rows is None else matrix.ad_ids[rows]
+            for offset, (row_scores, (_, exclude)) in enumerate(zip(scores, chunk)):
+                if similarity is not None and similarity[start + offset]:
+                    self._add_similarity(matrix, row_scores, rows, similarity[start + offset])
+                excluded = [matrix.row_of[ad_id] for ad_id in exclude if ad_id in matrix.row_of]
+                if rows is None:
+                    row_scores[excluded] = -np.inf
+                elif excluded and len(rows):
+                    excluded_rows = np.asarray(excluded, dtype=np.int64)
+                    positions = np.minimum(np.searchsorted(rows, excluded_rows), len(rows) - 1)
+                    row_scores[positions[rows[positions] == excluded_rows]] = -np.inf
+                sort_started = time.perf_counter()
+                ranked.append(self._top(ad_ids, row_scores, top_n))
+                sort_seconds += time.perf_counter() - sort_started
+        if timings is not None:
+            _add_timings(timings, time.perf_counter() - started - sort_seconds, sort_seconds)
+        return ranked
+
+    @staticmethod
+    def _add_similarity(matrix: _TagMatrix, row_scores: np.ndarray, rows: Optional[np.ndarray],
+                        similarity: Mapping[int, float]) -> None:
+        similar_rows = np.fromiter((matrix.row_of.get(ad_id, -1) for ad_id in similarity), dtype=np.int64, count=len(similarity))
+        values = np.fromiter(similarity.values(), dtype=np.float64, count=len(similarity)) * SIMILARITY_WEIGHT
+        known = similar_rows >= 0
+        similar_rows, values = similar_rows[known], values[known]
+        if rows is None:
+            row_scores[similar_rows] += values
+        elif len(rows):
+            # Only ads among the scored rows get the term; the others are not candidates
+            positions = np.minimum(np.searchsorted(rows, similar_rows), len(rows) - 1)
+            scored = rows[positions] == similar_rows
+            row_scores[positions[scored]] += values[scored]
+
+    @staticmethod
+    def _top(ad_ids: np.ndarray, scores: np.ndarray, top_n: int) -> List[int]:
+        candidates = np.flatnonzero(scores > 0)
+        if len(candidates) > top_n:
+            # Keep everything tied with the n-th best score so the final order can break ties like sorted() does
+            kth = np.partition(scores[candidates], len(candidates) - top_n)[len(candidates) - top_n]
+            candidates = candidates[scores[candidates] >= kth]
+        # lexsort sorts by the last key first: descending score, then catalog order (what a stable sort keeps)
+        order = np.lexsort((candidates, -scores[candidates]))
+        return [int(ad_id) for ad_id in ad_ids[candidates[order][:top_n]]]
+
+    def _prepare(self, snapshot: CatalogSnapshot, ad_ctrs: Mapping[int, float],
+                 ctr_version: Optional[Hashable]) -> Tuple[_TagMatrix, np.ndarray]:
+        with self._lock:
+            matrix = self._matrix
+            if matrix is None or matrix.snapshot is not snapshot:
+                matrix = self._matrix = _TagMatrix(snapshot)
+                self._ctr_key = None
+            ctr_key = (id(ad_ctrs), ctr_version) if ctr_version is not None else None
+            if ctr_key is None or ctr_key != self._ctr_key:
+                self._ctr_vector = np.fromiter((ad_ctrs.get(int(ad_id), 0) for ad_id in matrix.ad_ids),
+                                               dtype=np.float64, count=len(matrix.ad_ids)) * CTR_WEIGHT
+                self._ctr_key = ctr_key
+            return matrix, self._ctr_vector
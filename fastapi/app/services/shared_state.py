@@ -0,0 +1,97 @@
+# FastAPI app/services/shared_state.py
+import contextlib
+import fcntl
+import json
+import os
+import shutil
+from datetime import datetime
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+import numpy as np
+
+# Directory where worker processes share model state (catalog, CTR table) as memory-mapped files;
+# empty keeps every worker's state private. Put it on tmpfs (/dev/shm) so the pages never hit a disk.
+MODEL_STATE_DIR = os.getenv("MODEL_STATE_DIR", "")
+
+CURRENT = "CURRENT"
+MANIFEST = "manifest.json"
+
+
+class SharedState:
+    """
+    Versioned state published in a directory for several processes.
+
+    Every publication writes a fresh `v<timestamp>` directory (arrays as `.npy` files plus
+    a JSON manifest) and then swaps the CURRENT pointer with an atomic rename, so a reader
+    maps either the old or the new version, never a partial one. Readers map the arrays
+    read-only, which lets all processes share one copy of the pages. An exclusive `flock`
+    on `refresh.lock` elects the process that rebuilds the state; the others keep serving
+    the version they have and pick the new one up from CURRENT.
+    """
+
+    def __init__(self, directory: str, keep_versions: int = 2):
+        self.directory = directory
+        self.keep_versions = keep_versions
+
+    def current(self) -> Optional[str]:
+        """Version CURRENT points to, or None if nothing was published yet."""
+        try:
+            with open(os.path.join(self.directory, CURRENT)) as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def load(self, version: str) -> Tuple[Dict[str, Any], Dict[str, np.ndarray]]:
+        """Return the manifest and the memory-mapped arrays of `version`."""
+        path = os.path.join(self.directory, version)
+        with open(os.path.join(path, MANIFEST)) as f:
+            manifest = json.load(f)
+        arrays = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r") for name in manifest["arrays"]}
+        return manifest, arrays
+
+    @contextlib.contextmanager
+    def refresh_lock(self, blocking: bool = False) -> Iterator[bool]:
+        """Hold the refresh lock for the block; yields False if another process holds it and `blocking` is off."""
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, "refresh.lock"), "a") as f:
+            try:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def publish(self, arrays: Dict[str, np.ndarray], manifest: Optional[Dict[str, Any]] = None) -> str:
+        """Write a new version and point CURRENT at it; returns the version name."""
+        version = datetime.now().strftime("v%Y%m%d%H%M%S%f")
+        path = os.path.join(self.directory, version)
+        os.makedirs(path) # Also creates the state directory on first use
+        for name, array in arrays.items():
+            with open(os.path.join(path, f"{name}.npy"), "wb") as f:
+                np.save(f, array)
+                f.flush()
+                os.fsync(f.fileno())
+        manifest = dict(manifest or {}, arrays=list(arrays), published_at=datetime.now().timestamp())
+        _write_atomically(os.path.join(path, MANIFEST), json.dumps(manifest))
+        _write_atomically(os.path.join(self.directory, CURRENT), version)
+        self._prune()
+        return version
+
+    def _prune(self) -> None:
+        # The previous version stays: a process may have read CURRENT just before the swap
+        versions = sorted(name for name in os.listdir(self.directory)
+                          if name.startswith("v") and os.path.isdir(os.path.join(self.directory, name)))
+        for old in versions[:-self.keep_versions] if self.keep_versions > 0 else []:
+            shutil.rmtree(os.path.join(self.directory, old), ignore_errors=True)
+
+
+def _write_atomically(path: str, content: str) -> None:
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
@@ -0,0 +1,91 @@
+# FastAPI app/services/single_flight.py
+import asyncio
+import threading
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional
+
+from app.services import metrics
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class _LeaderCancelled(Exception):
+    """The coroutine computing a result was cancelled; its followers elect a new leader."""
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent identical computations: while a computation for a key is in flight,
+    further callers for the same key wait for it and receive its result (or its exception)
+    instead of running their own. Nothing is kept once the computation finishes, so this
+    only deduplicates work that overlaps in time; caching stays with the caller.
+
+    `do` coalesces threads, `do_async` coroutines of one event loop. Results are shared
+    between all waiters, so treat them as read-only.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._calls: Dict[Hashable, _Call] = {}
+        self._futures: Dict[Hashable, "asyncio.Future[Any]"] = {}
+        self._lock = threading.Lock()
+        self._leaders = metrics.SINGLE_FLIGHT_CALLS.labels(name, "leader")
+        self._followers = metrics.SINGLE_FLIGHT_CALLS.labels(name, "follower")
+
+    def do(self, key: Hashable, compute: Callable[[], Any]) -> Any:
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            self._followers.inc()
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        self._leaders.inc()
+        try:
+            call.result = compute()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    async def do_async(self, key: Hashable, compute: Callable[[], Awaitable[Any]]) -> Any:
+        while True:
+            future = self._futures.get(key)
+            if future is None:
+                break
+            self._followers.inc()
+            try:
+                # Shielded: a cancelled follower must not cancel the leader's result for the others
+                return await asyncio.shield(future)
+            except _LeaderCancelled:
+                continue # Its request went away; the first follower to get here takes over
+
+        future = self._futures[key] = asyncio.get_running_loop().create_future()
+        self._leaders.inc()
+        try:
+            result = await compute()
+        except asyncio.CancelledError:
+            future.set_exception(_LeaderCancelled())
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            del self._futures[key]
+            future.exception() # Marks an exception as retrieved, asyncio would log it when nobody waited
@@ -0,0 +1,176 @@
+# FastAPI app/services/tracing.py
+import contextlib
+import contextvars
+import json
+import os
+import sys
+import time
+import uuid
+from typing import Any, Dict, Iterator, List, Optional
+
+from sqlalchemy import event
+
+# Directory the traces of requests sent with `X-Trace: 1` (or `?trace=1`) are written to.
+REQUEST_TRACE_DIR = os.getenv("REQUEST_TRACE_DIR", "request_traces")
+# Newest trace files kept; older ones are deleted when a trace is written.
+REQUEST_TRACE_KEEP = int(os.getenv("REQUEST_TRACE_KEEP", "200"))
+# SQL statements recorded per trace; further ones are only counted.
+REQUEST_TRACE_MAX_QUERIES = int(os.getenv("REQUEST_TRACE_MAX_QUERIES", "500"))
+# Characters of each SQL statement kept in a trace (parameters are never recorded).
+REQUEST_TRACE_STATEMENT_CHARS = 2000
+
+_current: "contextvars.ContextVar[Optional[RequestTrace]]" = contextvars.ContextVar("request_trace", default=None)
+
+
+class RequestTrace:
+    """
+    Spans and SQL statements of one request. SQL is recorded by the cursor hooks of
+    `instrument_engine`, spans by `span`; each span also reports the SQL time spent inside
+    it, so the rest of its duration is Python (ORM hydration, scoring loops, ...).
+    """
+
+    def __init__(self, method: str, path: str):
+        self.trace_id = uuid.uuid4().hex
+        self.method = method
+        self.path = path
+        self.started_at = time.time()
+        self._started = time.perf_counter()
+        self.spans: List[Dict[str, Any]] = []
+        self.queries: List[Dict[str, Any]] = []
+        self.query_count = 0
+        self.sql_seconds = 0.0
+        self.duration: Optional[float] = None
+
+    def offset_ms(self, at: float) -> float:
+        return round((at - self._started) * 1000, 3)
+
+    def add_span(self, name: str, started: Optional[float], seconds: float, sql_seconds: Optional[float] = None) -> None:
+        span: Dict[str, Any] = {"name": name, "duration_ms": round(seconds * 1000, 3)}
+        if started is not None:
+            span["offset_ms"] = self.offset_ms(started)
+        if sql_seconds is not None:
+            span["sql_ms"] = round(sql_seconds * 1000, 3)
+        self.spans.append(span)
+
+    def add_query(self, statement: str, started: float, seconds: float, rowcount: int, executemany: bool) -> None:
+        self.query_count += 1
+        self.sql_seconds += seconds
+        if len(self.queries) < REQUEST_TRACE_MAX_QUERIES:
+            self.queries.append({
+                "statement": " ".join(statement.split())[:REQUEST_TRACE_STATEMENT_CHARS],
+                "offset_ms": self.offset_ms(started),
+                "duration_ms": round(seconds * 1000, 3),
+                "rowcount": rowcount,
+                "executemany": executemany,
+            })
+
+    def finish(self) -> None:
+        self.duration = time.perf_counter() - self._started
+
+    def server_timing(self) -> str:
+        """`Server-Timing` header value: SQL, every span name (summed over repeats) and the total."""
+        totals: Dict[str, float] = {}
+        for span in self.spans:
+            totals[span["name"]] = totals.get(span["name"], 0.0) + span["duration_ms"]
+        entries = [f'sql;dur={self.sql_seconds * 1000:.3f};desc="{self.query_count} queries"']
+        entries += [f"{name};dur={ms:.3f}" for name, ms in totals.items()]
+        if self.duration is not None:
+            entries.append(f"total;dur={self.duration * 1000:.3f}")
+        return ", ".join(entries)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "trace_id": self.trace_id,
+            "method": self.method,
+            "path": self.path,
+            "started_at": self.started_at,
+            "duration_ms": round(self.duration * 1000, 3) if self.duration is not None else None,
+            "sql": {"count": self.query_count, "duration_ms": round(self.sql_seconds * 1000, 3),
+                    "dropped": self.query_count - len(self.queries)},
+            "spans": self.spans,
+            "queries": self.queries,
+        }
+
+
+def current() -> Optional[RequestTrace]:
+    return _current.get()
+
+
+@contextlib.contextmanager
+def start(method: str, path: str) -> Iterator[RequestTrace]:
+    """Trace everything run in this context (including `run_sync` greenlets and threadpool calls)."""
+    trace = RequestTrace(method, path)
+    token = _current.set(trace)
+    try:
+        yield trace
+    finally:
+        trace.finish()
+        _current.reset(token)
+
+
+@contextlib.contextmanager
+def span(name: str) -> Iterator[None]:
+    """Time a block as a span of the current trace; a no-op for untraced requests."""
+    trace = _current.get()
+    if trace is None:
+        yield
+        return
+    started, sql_before = time.perf_counter(), trace.sql_seconds
+    try:
+        yield
+    finally:
+        trace.add_span(name, started, time.perf_counter() - started, trace.sql_seconds - sql_before)
+
+
+def record_span(name: str, seconds: float) -> None:
+    """Add a duration measured by the caller (e.g. a total over a loop), without an offset."""
+    trace = _current.get()
+    if trace is not None:
+        trace.add_span(name, None, seconds)
+
+
+def instrument_engine(engine: Any) -> None:
+    """
+    Record the statements a (sync) engine executes in the current trace. For an async engine,
+    pass `async_engine.sync_engine`. Untraced statements only pay for a context variable lookup.
+    """
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if _current.get() is not None:
+            context._trace_started = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        trace = _current.get()
+        started = getattr(context, "_trace_started", None)
+        if trace is not None and started is not None:
+            trace.add_query(statement, started, time.perf_counter() - started, getattr(cursor, "rowcount", -1), executemany)
+
+
+def write(trace: RequestTrace, directory: Optional[str] = None, keep: int = REQUEST_TRACE_KEEP) -> Optional[str]:
+    """Write the trace as `<directory>/<trace_id>.json`, pruning the oldest files beyond `keep`; returns the path."""
+    directory = directory or REQUEST_TRACE_DIR
+    try:
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"{trace.trace_id}.json")
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(trace.to_dict(), f)
+        os.replace(tmp, path)
+    except OSError as e:
+        print(f"Writing request trace {trace.trace_id} failed: {e}", file=sys.stderr)
+        return None
+    _prune(directory, keep)
+    return path
+
+
+def _prune(directory: str, keep: int) -> None:
+    traces = []
+    for entry in os.scandir(directory):
+        if entry.name.endswith(".json"):
+            with contextlib.suppress(FileNotFoundError): # Pruned concurrently by another request
+                traces.append((entry.stat().st_mtime, entry.path))
+    for _, path in sorted(traces)[:max(0, len(traces) - keep)]:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path)
@@ -0,0 +1,271 @@
+# FastAPI app/services/user_profiles.py
+import math
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Iterable, List, Mapping, Optional, Set, Tuple
+
+from redis.exceptions import WatchError
+
+# Half-life of an interaction's weight in a user's tag affinities
+USER_PROFILE_HALF_LIFE_DAYS = float(os.getenv("USER_PROFILE_HALF_LIFE_DAYS", "21"))
+# Most recent interacted ads remembered per user (these are excluded from recommendations)
+USER_PROFILE_MAX_ADS = int(os.getenv("USER_PROFILE_MAX_ADS", "200"))
+# Redis expiry of an idle profile; it is rebuilt from the events table when next needed
+USER_PROFILE_TTL = int(os.getenv("USER_PROFILE_TTL", str(30 * 86400)))
+# Without Redis, profiles live in each process and only see that process's events, so they are
+# rebuilt from the events table this often and bounded in number.
+USER_PROFILE_LOCAL_TTL = float(os.getenv("USER_PROFILE_LOCAL_TTL", "600"))
+USER_PROFILE_LOCAL_SIZE = int(os.getenv("USER_PROFILE_LOCAL_SIZE", "100000"))
+# Attempts to store a materialized profile while events of the user keep changing its hash
+USER_PROFILE_MATERIALIZE_RETRIES = int(os.getenv("USER_PROFILE_MATERIALIZE_RETRIES", "5"))
+
+# Tag scores are stored scaled to this fixed epoch: an event adds weight * 2^((timestamp - epoch) / half-life),
+# so concurrent updates are plain HINCRBYFLOAT additions and decay only shows when scores are compared.
+# A double holds about 1000 half-lives past the epoch (58 years with the default half-life).
+USER_PROFILE_EPOCH = float(os.getenv("USER_PROFILE_EPOCH", "1767225600")) # 2026-01-01 UTC
+
+EVENT_WEIGHTS = {'click': 1.0, 'impression': 0.5} # Clicks are weighted higher
+
+
+class UserProfile:
+    """
+    Tag affinities and recently interacted ads of one user. Tag scores are epoch-scaled
+    (see USER_PROFILE_EPOCH), so an update costs O(tags) and events commute.
+    """
+    __slots__ = ("tag_scores", "ad_ids", "updated_at")
+
+    def __init__(self, tag_scores: Optional[Dict[str, float]] = None, ad_ids: Optional[Dict[int, float]] = None,
+                 updated_at: float = 0.0):
+        self.tag_scores = tag_scores or {}
+        self.ad_ids = ad_ids or {} # ad_id -> last interaction timestamp
+        self.updated_at = updated_at # When the profile was materialized
+
+    def add(self, tags: Iterable[str], ad_id: int, scaled_weight: float, timestamp: float, max_ads: int) -> None:
+        for tag in tags:
+            self.tag_scores[tag] = self.tag_scores.get(tag, 0.0) + scaled_weight
+        if timestamp >= self.ad_ids.get(ad_id, float("-inf")):
+            self.ad_ids[ad_id] = timestamp
+        if len(self.ad_ids) > max_ads:
+            keep = sorted(self.ad_ids.items(), key=lambda item: item[1], reverse=True)[:max_ads]
+            self.ad_ids = dict(keep)
+
+
+class UserProfiles:
+    """
+    Materialized per-user profiles, kept in Redis hashes (`profile:v2:<user_id>` across tenants,
+    `profile:v2:<tenant_id>:<user_id>` for the user's events of one tenant) when Redis is
+    reachable and in a bounded in-process map otherwise. Profiles are built once from
+    the user's history and then updated incrementally as events are logged; an update only
+    increments and sets individual hash fields, so concurrent events never overwrite each other.
+    Events logged before the profile is materialized accumulate in the same hash without the
+    `_materialized_at` marker; materializing merges them in, as they may not be in the events table yet.
+    """
+
+    def __init__(self, redis_client: Callable[[], Any], half_life_days: float = USER_PROFILE_HALF_LIFE_DAYS,
+                 max_ads: int = USER_PROFILE_MAX_ADS, ttl: int = USER_PROFILE_TTL,
+                 local_ttl: float = USER_PROFILE_LOCAL_TTL, local_size: int = USER_PROFILE_LOCAL_SIZE,
+                 epoch: float = USER_PROFILE_EPOCH, materialize_retries: int = USER_PROFILE_MATERIALIZE_RETRIES):
+        self.redis_client = redis_client
+        self.half_life = half_life_days * 86400
+        self.max_ads = max_ads
+        self.ttl = ttl
+        self.local_ttl = local_ttl
+        self.local_size = local_size
+        self.epoch = epoch
+        self.materialize_retries = materialize_retries
+        self._local: "OrderedDict[Tuple[int, Optional[int]], Tuple[float, UserProfile]]" = OrderedDict() # (user_id, tenant_id) -> (materialized_at, profile)
+        self._lock = threading.Lock()
+
+    def get(self, user_id: int, tenant_id: Optional[int] = None) -> Optional[UserProfile]:
+        """The user's profile over the events of `tenant_id` (every tenant if None), or None until it is materialized."""
+        client = self.redis_client()
+        if client is not None:
+            try:
+                profile = self._decode(client.hgetall(self._key(user_id, tenant_id)))
+                if profile is not None and len(profile.ad_ids) > self.max_ads:
+                    self._trim(client, self._key(user_id, tenant_id), profile)
+                return profile
+            except Exception as e:
+                print(f"Reading profile of user {user_id} from Redis failed: {e}. Using the local copy.", file=sys.stderr)
+        with self._lock:
+            cached = self._local.get((user_id, tenant_id))
+            if cached is None or time.time() - cached[0] >= self.local_ttl:
+                return None
+            return cached[1]
+
+    def record(self, user_id: int, ad_id: int, tags: Iterable[str], event_type: str, timestamp: Optional[float] = None,
+               tenant_id: Optional[int] = None) -> None:
+        """Fold a newly logged event into the user's profiles (see `record_many`)."""
+        self.record_many([(user_id, ad_id, tags, event_type, timestamp, tenant_id)])
+
+    def record_many(self, events: Iterable[Tuple[int, int, Iterable[str], str, Optional[float], Optional[int]]]) -> None:
+        """
+        Fold newly logged `(user_id, ad_id, tags, event_type, timestamp, tenant_id)` events into the
+        users' profiles: the one across tenants and the one of the event's tenant (if given). Users without a profile get one on their next recommendation: in Redis their
+        events are kept in the not yet materialized hash (see `materialize`), locally they are left
+        alone. The events are merged per user (one increment per tag, one write per ad) and sent to
+        Redis in a single pipeline of per-field updates (HINCRBYFLOAT, HSET, HSETNX), so it needs no
+        read and cannot lose a concurrent event of the same user.
+        """
+        now = time.time()
+        updates: Dict[Tuple[int, Optional[int]], Tuple[Dict[str, float], Dict[int, float]]] = {} # -> (tag increments, ad timestamps)
+        with self._lock:
+            for user_id, ad_id, tags, event_type, timestamp, tenant_id in events:
+                weight = EVENT_WEIGHTS.get(event_type)
+                if weight is None:
+                    continue
+                timestamp = timestamp if timestamp is not None else now
+                tags = list(tags)
+                scaled_weight = weight * self._scale(timestamp)
+                for profile_key in ((user_id, None),) if tenant_id is None else ((user_id, None), (user_id, tenant_id)):
+                    tag_increments, ad_ids = updates.setdefault(profile_key, ({}, {}))
+                    for tag in tags:
+                        tag_increments[tag] = tag_increments.get(tag, 0.0) + scaled_weight
+                    ad_ids[ad_id] = max(timestamp, ad_ids.get(ad_id, float("-inf")))
+                    cached = self._local.get(profile_key)
+                    if cached is not None:
+                        cached[1].add(tags, ad_id, scaled_weight, timestamp, self.max_ads)
+        client = self.redis_client()
+        if client is None or not updates:
+            return
+        try:
+            pipe = client.pipeline(transaction=False) # Increments commute, no need to isolate them
+            for (user_id, tenant_id), (tag_increments, ad_ids) in updates.items():
+                key = self._key(user_id, tenant_id)
+                for tag, increment in tag_increments.items():
+                    pipe.hincrbyfloat(key, f"t:{tag}", increment)
+                pipe.hset(key, mapping={f"a:{ad_id}": repr(ts) for ad_id, ts in ad_ids.items()})
+                # Where the events of a hash without a profile start, see `materialize`
+                pipe.hsetnx(key, "_pending_since", repr(min(ad_ids.values())))
+                pipe.expire(key, self.ttl)
+            pipe.execute()
+        except Exception as e:
+            print(f"Updating {len(updates)} profiles in Redis failed: {e}", file=sys.stderr)
+
+    def materialize(self, user_id: int, events: Iterable[Any], ad_tags: Mapping[int, Mapping[str, Any]],
+                    tenant_id: Optional[int] = None) -> UserProfile:
+        """
+        Build a user's profile from their events (objects with ad_id, event_type, occurred_at) and store it;
+        with `tenant_id`, the events must be those of that tenant.
+        In Redis, the events logged since the hash was created (`_pending_since`) are already counted in
+        it and may not have reached the events table, so only older events are read from `events` and the
+        hash's fields are merged in. The hash is written under WATCH, so a concurrent event is never lost:
+        the merge is retried instead.
+        """
+        events = list(events)
+        with self._lock:
+            self._local.pop((user_id, tenant_id), None) # Restart the local TTL
+        client = self.redis_client()
+        profile = None
+        if client is not None:
+            try:
+                profile = self._materialize_remote(client, self._key(user_id, tenant_id), events, ad_tags)
+            except Exception as e:
+                print(f"Writing profile of user {user_id} to Redis failed: {e}", file=sys.stderr)
+        if profile is None:
+            profile = self._build(events, ad_tags)
+        with self._lock:
+            self._local[(user_id, tenant_id)] = (time.time(), profile)
+            while len(self._local) > self.local_size:
+                self._local.popitem(last=False)
+        return profile
+
+    def _materialize_remote(self, client: Any, key: str, events: List[Any], ad_tags: Mapping[int, Mapping[str, Any]]) -> Optional[UserProfile]:
+        for _ in range(self.materialize_retries):
+            pipe = client.pipeline(transaction=True)
+            try:
+                pipe.watch(key)
+                fields = pipe.hgetall(key)
+                existing = self._decode(fields)
+                if existing is not None:
+                    return existing # Materialized by another worker meanwhile
+                pending_since = self._field(fields, "_pending_since")
+                profile = self._build(events, ad_tags, before=pending_since)
+                pending = self._decode(fields, partial=True)
+                for tag, score in pending.tag_scores.items():
+                    profile.tag_scores[tag] = profile.tag_scores.get(tag, 0.0) + score
+                for ad_id, timestamp in pending.ad_ids.items():
+                    profile.add((), ad_id, 0.0, timestamp, self.max_ads)
+                pipe.multi()
+                pipe.hset(key, mapping=self._encode(profile))
+                pipe.expire(key, self.ttl)
+                pipe.execute()
+                return profile
+            except WatchError:
+                continue # An event of the user changed the hash, merge again
+            finally:
+                pipe.reset()
+        print(f"Profile {key} kept changing while it was materialized; not stored in Redis.", file=sys.stderr)
+        return None
+
+    def _build(self, events: Iterable[Any], ad_tags: Mapping[int, Mapping[str, Any]], before: Optional[float] = None) -> UserProfile:
+        profile = UserProfile(updated_at=time.time()) # Also marks "no history", so it is not rebuilt on every request
+        for event in events:
+            weight = EVENT_WEIGHTS.get(event.event_type)
+            if weight is None:
+                continue
+            timestamp = event.occurred_at.timestamp()
+            if before is not None and timestamp >= before:
+                continue # Already counted in the hash
+            ad_info = ad_tags.get(event.ad_id)
+            tags = ad_info.get("tags", ()) if ad_info else ()
+            profile.add(tags, event.ad_id, weight * self._scale(timestamp), timestamp, self.max_ads)
+        return profile
+
+    def tag_profile(self, profile: UserProfile) -> Tuple[Dict[str, float], Set[int]]:
+        """
+        Return normalized, decayed tag scores and the recently interacted ad ids of a profile.
+        Decay scales every epoch-scaled score by the same factor, so normalizing alone applies it.
+        """
+        tag_scores = profile.tag_scores
+        total_score = sum(tag_scores.values())
+        if total_score > 0:
+            tag_scores = {tag: score / total_score for tag, score in tag_scores.items()}
+        return dict(tag_scores), set(profile.ad_ids)
+
+    def _scale(self, timestamp: float) -> float:
+        return math.pow(2.0, (timestamp - self.epoch) / self.half_life)
+
+    def _trim(self, client: Any, key: str, profile: UserProfile) -> None:
+        """Forget the oldest interacted ads beyond `max_ads`; HDEL of stale fields is safe to race."""
+        oldest = sorted(profile.ad_ids.items(), key=lambda item: item[1])[:len(profile.ad_ids) - self.max_ads]
+        for ad_id, _ in oldest:
+            del profile.ad_ids[ad_id]
+        client.hdel(key, *(f"a:{ad_id}" for ad_id, _ in oldest))
+
+    @staticmethod
+    def _key(user_id: int, tenant_id: Optional[int] = None) -> str:
+        # v2: epoch-scaled scores; v1 profiles expire unread
+        return f"profile:v2:{user_id}" if tenant_id is None else f"profile:v2:{tenant_id}:{user_id}"
+
+    @staticmethod
+    def _encode(profile: UserProfile) -> Dict[str, str]:
+        fields = {"_materialized_at": repr(profile.updated_at)}
+        fields.update({f"t:{tag}": repr(score) for tag, score in profile.tag_scores.items()})
+        fields.update({f"a:{ad_id}": repr(ts) for ad_id, ts in profile.ad_ids.items()})
+        return fields
+
+    @staticmethod
+    def _field(fields: Mapping[Any, Any], name: str) -> Optional[float]:
+        value = fields.get(name.encode(), fields.get(name))
+        return float(value) if value is not None else None
+
+    @staticmethod
+    def _decode(fields: Mapping[Any, Any], partial: bool = False) -> Optional[UserProfile]:
+        profile = UserProfile()
+        materialized = False
+        for raw_name, raw_value in fields.items():
+            name = raw_name.decode() if isinstance(raw_name, bytes) else raw_name
+            value = float(raw_value)
+            if name == "_materialized_at":
+                profile.updated_at = value
+                materialized = True
+            elif name.startswith("t:"):
+                profile.tag_scores[name[2:]] = value
+            elif name.startswith("a:"):
+                profile.ad_ids[int(name[2:])] = value
+        # Without the marker, only events of a profile that was never materialized (or expired) landed here
+        return profile if materialized or partial else None
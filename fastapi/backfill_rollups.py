@@ -0,0 +1,37 @@
+"""
+Rollup backfill: rebuilds the hourly and daily `event_rollups` counts from the MySQL
+`events` table, for history inserted before the events sink maintained them.
+
+    python backfill_rollups.py [--start 2025-06-01] [--end 2025-06-30]
+
+The rollups of the selected days are deleted and recomputed in one transaction, grouped
+by hour in SQL. Restrict the range to days the sink is no longer writing to.
+"""
+import argparse
+import sys
+import time
+from datetime import date
+from typing import List, Optional
+
+from app.services.event_rollups import backfill_rollups
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Rebuild the event rollups from the events table.")
+    parser.add_argument("--start", type=date.fromisoformat, default=None, help="First day to rebuild (default: the oldest event)")
+    parser.add_argument("--end", type=date.fromisoformat, default=None, help="Last day to rebuild, inclusive (default: the newest event)")
+    args = parser.parse_args(argv)
+
+    from app.services.database import engine
+
+    started = time.monotonic()
+    try:
+        written = backfill_rollups(engine, start=args.start, end=args.end)
+    except Exception as e:
+        print(f"Rollup backfill failed: {e}", file=sys.stderr)
+        sys.exit(1)
+    print(f"Wrote {written} rollup rows in {time.monotonic() - started:.1f}s.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,388 @@
+"""
+Benchmark harness for the recommender and the event ingestion endpoints.
+
+Generate a synthetic, reproducible dataset (SQLite file or any SQLAlchemy URL, e.g. a
+local MySQL), then measure against it:
+
+    python benchmark.py generate --db sqlite:///bench.db --ads 10000 --events 10000000 --users 1000000
+    python benchmark.py ecf --db sqlite:///bench.db --requests 2000 --engine numpy
+    python benchmark.py load --db sqlite:///bench.db --endpoint recommend --rps 200 --duration 30
+    python benchmark.py load --url http://localhost:8001 --endpoint log-event --rps 500 --duration 30
+
+`ecf` calls `enhanced_collaborative_filtering` directly. `load` drives the HTTP API at a
+fixed request rate (open loop: requests are sent on schedule whether or not earlier ones
+finished, and latency is measured from the scheduled send time); with `--db` it serves
+the app in-process against that database, with `--url` it targets a running server.
+
+Every run prints one JSON document (also written to `--output`) with the configuration,
+the environment and p50/p95/p99 latencies, so runs can be stored and compared.
+"""
+import argparse
+import contextlib
+import http.client
+import json
+import os
+import platform
+import queue
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Sequence
+from urllib.parse import urlsplit
+
+import numpy as np
+from sqlalchemy import create_engine, event, insert
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from app.models.models import AdModel, Base, EventModel
+
+TAG_VOCABULARY = [
+    "tech", "electronics", "fashion", "sale", "travel", "sports", "fitness", "food", "winter", "summer",
+    "gaming", "music", "books", "home", "garden", "beauty", "health", "finance", "auto", "kids",
+    "pets", "outdoor", "luxury", "budget", "movies", "education", "crypto", "jewelry", "coffee", "wellness",
+]
+CLICK_RATE = 0.05
+INSERT_CHUNK = 50000
+
+
+# --- Dataset generation ---
+
+def _engine(db_url: str):
+    engine = create_engine(db_url, connect_args={"check_same_thread": False} if db_url.startswith("sqlite") else {})
+    if db_url.startswith("sqlite"):
+        @event.listens_for(engine, "connect")
+        def _fast_sqlite(dbapi_connection, _record):
+            cursor = dbapi_connection.cursor()
+            cursor.execute("PRAGMA journal_mode=WAL")
+            cursor.execute("PRAGMA synchronous=OFF")
+            cursor.close()
+    return engine
+
+
+def _zipf_weights(n: int, exponent: float) -> np.ndarray:
+    weights = 1.0 / np.arange(1, n + 1, dtype=np.float64) ** exponent
+    return weights / weights.sum()
+
+
+def generate(db_url: str, ads: int, events: int, users: int, tenants: int, days: int, seed: int,
+             expired_fraction: float = 0.1, zipf_exponent: float = 1.1) -> Dict[str, Any]:
+    """
+    Write `ads` ads and `events` events of `users` users into a fresh schema. Ad and user
+    popularity follow Zipf distributions so a few ads and users dominate, like real traffic;
+    the same seed always produces the same dataset.
+    """
+    rng = np.random.default_rng(seed)
+    engine = _engine(db_url)
+    Base.metadata.drop_all(bind=engine, tables=[AdModel.__table__, EventModel.__table__])
+    Base.metadata.create_all(bind=engine, tables=[AdModel.__table__, EventModel.__table__])
+    now = datetime.now().replace(microsecond=0)
+    started = time.perf_counter()
+
+    ad_tenants = rng.integers(1, tenants + 1, size=ads)
+    tag_weights = _zipf_weights(len(TAG_VOCABULARY), 0.8)
+    with engine.begin() as connection:
+        rows = []
+        for i in range(ads):
+            tags = rng.choice(len(TAG_VOCABULARY), size=int(rng.integers(1, 5)), replace=False, p=tag_weights)
+            expired = rng.random() < expired_fraction
+            rows.append({
+                "id": i + 1,
+                "tenant_id": int(ad_tenants[i]),
+                "name": f"Ad {i + 1}",
+                "content": "",
+                "start_time": now - timedelta(days=days + 30),
+                "end_time": now - timedelta(days=1) if expired else now + timedelta(days=365),
+                "target_audience": {"interests": [TAG_VOCABULARY[t] for t in sorted(tags)]},
+                "created_at": now,
+                "updated_at": now,
+            })
+            if len(rows) == INSERT_CHUNK:
+                connection.execute(insert(AdModel.__table__), rows)
+                rows = []
+        if rows:
+            connection.execute(insert(AdModel.__table__), rows)
+
+    ad_popularity = _zipf_weights(ads, zipf_exponent)
+    ad_order = rng.permutation(ads) + 1 # Popular ads are spread over ids and tenants
+    user_activity = _zipf_weights(users, 0.9)
+    span = days * 86400
+    written = 0
+    while written < events:
+        size = min(INSERT_CHUNK, events - written)
+        ad_ids = ad_order[rng.choice(ads, size=size, p=ad_popularity)]
+        user_ids = rng.choice(users, size=size, p=user_activity) + 1
+        clicks = rng.random(size) < CLICK_RATE
+        offsets = rng.integers(0, span, size=size)
+        rows = [{
+            "tenant_id": int(ad_tenants[ad_id - 1]),
+            "ad_id": int(ad_id),
+            "user_id": int(user_id),
+            "event_type": "click" if click else "impression",
+            "data": {},
+            "occurred_at": now - timedelta(seconds=int(offset)),
+            "created_at": now,
+            "updated_at": now,
+        } for ad_id, user_id, click, offset in zip(ad_ids, user_ids, clicks, offsets)]
+        with engine.begin() as connection:
+            connection.execute(insert(EventModel.__table__), rows)
+        written += size
+        print(f"Generated {written}/{events} events", file=sys.stderr)
+    engine.dispose()
+    return {"ads": ads, "events": events, "users": users, "tenants": tenants, "days": days,
+            "seconds": round(time.perf_counter() - started, 3)}
+
+
+# --- Measurement helpers ---
+
+def summarize(latencies: Sequence[float], errors: int = 0, elapsed: Optional[float] = None) -> Dict[str, Any]:
+    """Latency percentiles in milliseconds (plus throughput when `elapsed` is given)."""
+    values = np.asarray(latencies, dtype=np.float64) * 1000
+    summary: Dict[str, Any] = {"count": int(len(values)), "errors": errors}
+    if len(values):
+        p50, p95, p99 = np.percentile(values, [50, 95, 99])
+        summary.update({
+            "p50_ms": round(float(p50), 3),
+            "p95_ms": round(float(p95), 3),
+            "p99_ms": round(float(p99), 3),
+            "mean_ms": round(float(values.mean()), 3),
+            "max_ms": round(float(values.max()), 3),
+        })
+    if elapsed:
+        summary["throughput_rps"] = round(len(values) / elapsed, 2)
+    return summary
+
+
+def _environment() -> Dict[str, Any]:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)), timeout=5).stdout.strip() or None
+    except Exception:
+        commit = None
+    return {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count(),
+            "numpy": np.__version__, "git_commit": commit}
+
+
+def _user_ids(db_url: str, count: int, seed: int) -> List[int]:
+    """Sample users with history, weighted by activity like the generated traffic."""
+    engine = _engine(db_url)
+    with engine.connect() as connection:
+        rows = connection.exec_driver_sql("SELECT user_id FROM events WHERE user_id IS NOT NULL LIMIT 200000").fetchall()
+    engine.dispose()
+    if not rows:
+        raise SystemExit("The database has no events; run `benchmark.py generate` first.")
+    population = [row[0] for row in rows]
+    return random.Random(seed).choices(population, k=count)
+
+
+# --- Benchmarks ---
+
+def bench_ecf(db_url: str, requests: int, warmup: int, top_n: int, engine_name: Optional[str],
+              profile_source: Optional[str], tenant_id: Optional[int], seed: int) -> Dict[str, Any]:
+    """Time `enhanced_collaborative_filtering` for a sample of users, one session per call like /recommend."""
+    import main
+
+    if profile_source:
+        main.USER_PROFILE_SOURCE = profile_source
+    session_factory = sessionmaker(autocommit=False, autoflush=False, bind=_engine(db_url))
+    user_ids = _user_ids(db_url, warmup + requests, seed)
+
+    def run(batch: List[int]):
+        latencies = []
+        errors = 0
+        for user_id in batch:
+            db = session_factory()
+            call_started = time.perf_counter()
+            try:
+                if not main.enhanced_collaborative_filtering(user_id, db, top_n=top_n, scoring_engine=engine_name, tenant_id=tenant_id):
+                    errors += 1 # Empty lists only come from the error fallbacks
+            finally:
+                db.close()
+            latencies.append(time.perf_counter() - call_started)
+        return latencies, errors
+
+    run(user_ids[:warmup]) # Loads the catalog, CTR counters and numpy matrices
+    started = time.perf_counter()
+    latencies, errors = run(user_ids[warmup:])
+    return summarize(latencies, errors, time.perf_counter() - started)
+
+
+def _serve_in_process(db_url: str, ingestion_mode: Optional[str]) -> str:
+    """Serve main.app from a background thread with its sessions bound to `db_url`; returns the base URL."""
+    import uvicorn
+    import main
+
+    session_factory = sessionmaker(autocommit=False, autoflush=False, bind=_engine(db_url))
+    async_url = make_url(db_url)
+    async_url = async_url.set(drivername={"sqlite": "sqlite+aiosqlite", "mysql+pymysql": "mysql+aiomysql"}.get(async_url.drivername, async_url.drivername))
+    async_session_factory = async_sessionmaker(create_async_engine(async_url), autoflush=False, expire_on_commit=False)
+
+    async def bench_async_db():
+        async with async_session_factory() as db:
+            yield db
+
+    main.app.dependency_overrides[main.get_async_db] = bench_async_db
+    main.SessionLocal = session_factory # Background cache refreshes open their own sessions
+    if ingestion_mode:
+        main.EVENT_INGESTION_MODE = ingestion_mode
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(main.app, host="127.0.0.1", port=port, log_level="warning", access_log=False))
+    threading.Thread(target=server.run, name="bench-server", daemon=True).start()
+    deadline = time.monotonic() + 10
+    while not server.started:
+        if time.monotonic() > deadline:
+            raise SystemExit("The in-process server did not start.")
+        time.sleep(0.05)
+    return f"http://127.0.0.1:{port}"
+
+
+def _request_factory(endpoint: str, user_ids: List[int], ads: int, tenants: int, seed: int):
+    rng = random.Random(seed)
+
+    def recommend():
+        return "GET", f"/recommend?user_id={rng.choice(user_ids)}", None
+
+    def log_event():
+        body = {"user_id": rng.choice(user_ids), "ad_id": rng.randint(1, ads), "tenant_id": rng.randint(1, tenants),
+                "event_type": "click" if rng.random() < CLICK_RATE else "impression"}
+        return "POST", "/log-event", json.dumps(body)
+
+    return {"recommend": recommend, "log-event": log_event}[endpoint]
+
+
+def bench_load(base_url: str, endpoint: str, rps: float, duration: float, concurrency: int,
+               user_ids: List[int], ads: int, tenants: int, seed: int, timeout: float) -> Dict[str, Any]:
+    """
+    Send `rps` requests per second for `duration` seconds from `concurrency` keep-alive
+    connections. Latency counts from each request's scheduled send time, so a slow server
+    shows up as latency instead of silently lowering the offered rate.
+    """
+    target = urlsplit(base_url)
+    next_request = _request_factory(endpoint, user_ids, ads, tenants, seed)
+    schedule: "queue.Queue[Optional[tuple]]" = queue.Queue()
+    lock = threading.Lock()
+    latencies: List[float] = []
+    status_codes: Dict[str, int] = {}
+    errors = 0
+
+    def worker():
+        nonlocal errors
+        connection = http.client.HTTPConnection(target.hostname, target.port or 80, timeout=timeout)
+        while True:
+            item = schedule.get()
+            if item is None:
+                break
+            scheduled_at, (method, path, body) = item
+            delay = scheduled_at - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                connection.request(method, path, body=body, headers={"Content-Type": "application/json"} if body else {})
+                response = connection.getresponse()
+                response.read()
+                status = str(response.status)
+                failed = response.status >= 500
+            except Exception as e:
+                connection.close()
+                connection = http.client.HTTPConnection(target.hostname, target.port or 80, timeout=timeout)
+                status, failed = type(e).__name__, True
+            elapsed = time.perf_counter() - scheduled_at
+            with lock:
+                latencies.append(elapsed)
+                status_codes[status] = status_codes.get(status, 0) + 1
+                errors += failed
+        connection.close()
+
+    workers = [threading.Thread(target=worker, name=f"bench-client-{i}", daemon=True) for i in range(concurrency)]
+    for thread in workers:
+        thread.start()
+    started = time.perf_counter() + 0.1
+    total = int(rps * duration)
+    for i in range(total):
+        schedule.put((started + i / rps, next_request()))
+    for _ in workers:
+        schedule.put(None)
+    for thread in workers:
+        thread.join()
+    summary = summarize(latencies, errors, time.perf_counter() - started)
+    summary["target_rps"] = rps
+    summary["status_codes"] = status_codes
+    return summary
+
+
+def main(argv: Optional[List[str]] = None) -> Dict[str, Any]:
+    parser = argparse.ArgumentParser(description="Generate benchmark data and measure the recommender and ingestion paths.")
+    parser.add_argument("--output", help="Also write the JSON result to this file")
+    parser.add_argument("--seed", type=int, default=42)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    gen = commands.add_parser("generate", help="Write a synthetic catalog and event log")
+    gen.add_argument("--db", default="sqlite:///bench.db", help="SQLAlchemy URL (SQLite file or a local MySQL)")
+    gen.add_argument("--ads", type=int, default=10000)
+    gen.add_argument("--events", type=int, default=1000000)
+    gen.add_argument("--users", type=int, default=100000)
+    gen.add_argument("--tenants", type=int, default=10)
+    gen.add_argument("--days", type=int, default=90, help="Events are spread over this many past days")
+
+    ecf = commands.add_parser("ecf", help="Benchmark enhanced_collaborative_filtering directly")
+    ecf.add_argument("--db", default="sqlite:///bench.db")
+    ecf.add_argument("--requests", type=int, default=1000)
+    ecf.add_argument("--warmup", type=int, default=50)
+    ecf.add_argument("--top-n", type=int, default=5)
+    ecf.add_argument("--engine", choices=["numpy", "python"], help="Defaults to RECOMMENDER_SCORING_ENGINE")
+    ecf.add_argument("--profile-source", choices=["materialized", "history"], help="Defaults to USER_PROFILE_SOURCE")
+    ecf.add_argument("--tenant-id", type=int)
+
+    load = commands.add_parser("load", help="Drive /recommend or /log-event at a target request rate")
+    target = load.add_mutually_exclusive_group(required=True)
+    target.add_argument("--url", help="Base URL of a running server")
+    target.add_argument("--db", help="Serve the app in-process against this database")
+    load.add_argument("--endpoint", choices=["recommend", "log-event"], default="recommend")
+    load.add_argument("--rps", type=float, default=100)
+    load.add_argument("--duration", type=float, default=10, help="Seconds")
+    load.add_argument("--concurrency", type=int, default=32, help="Client connections")
+    load.add_argument("--timeout", type=float, default=10)
+    load.add_argument("--users", type=int, default=100000, help="User id range when --url has no --db to sample from")
+    load.add_argument("--ads", type=int, default=10000)
+    load.add_argument("--tenants", type=int, default=10)
+    load.add_argument("--ingestion-mode", choices=["sync", "async"], help="EVENT_INGESTION_MODE of the in-process server")
+    args = parser.parse_args(argv)
+
+    config = {key: value for key, value in vars(args).items() if key != "output"}
+    with contextlib.redirect_stdout(sys.stderr): # The app logs to stdout; keep it for the JSON report
+        results = _run(args)
+
+    report = {"benchmark": args.command, "config": config, "environment": _environment(),
+              "timestamp": datetime.now().isoformat(timespec="seconds"), "results": results}
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    return report
+
+
+def _run(args: argparse.Namespace) -> Dict[str, Any]:
+    if args.command == "generate":
+        return generate(args.db, args.ads, args.events, args.users, args.tenants, args.days, args.seed)
+    if args.command == "ecf":
+        return bench_ecf(args.db, args.requests, args.warmup, args.top_n, args.engine, args.profile_source,
+                         args.tenant_id, args.seed)
+    if args.db:
+        user_ids = _user_ids(args.db, 10000, args.seed)
+        base_url = _serve_in_process(args.db, args.ingestion_mode)
+    else:
+        user_ids = list(range(1, args.users + 1))
+        base_url = args.url
+    return bench_load(base_url, args.endpoint, args.rps, args.duration, args.concurrency, user_ids,
+                      args.ads, args.tenants, args.seed, args.timeout)
+
+
+if __name__ == "__main__":
+    main()
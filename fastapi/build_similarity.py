@@ -0,0 +1,60 @@
+"""
+Item similarity builder: computes top-K ad x ad cosine similarities from the columnar
+events snapshot written by export_events.py and publishes them for /recommend.
+
+    python build_similarity.py [--snapshot-dir /data/events] [--dir /data/similarity] [--top-k 50] [--interval 3600]
+
+Every build goes to a new version directory; the CURRENT pointer is swapped last, and
+the API picks the new matrix up within ITEM_SIMILARITY_RELOAD_INTERVAL seconds.
+"""
+import argparse
+import signal
+import sys
+import threading
+import time
+from typing import List, Optional
+
+from app.services.event_snapshot import EVENT_SNAPSHOT_DIR, EventSnapshot
+from app.services.item_similarity import (ITEM_SIMILARITY_DIR, ITEM_SIMILARITY_MAX_USER_ADS, ITEM_SIMILARITY_TOP_K,
+                                          compute_similarity, publish_similarity)
+
+
+def build(snapshot_dir: str, directory: str, top_k: int, max_user_ads: int) -> Optional[str]:
+    snapshot = EventSnapshot.load(snapshot_dir)
+    if snapshot is None:
+        print(f"No events snapshot in {snapshot_dir} yet; run export_events.py first.", file=sys.stderr)
+        return None
+    started = time.monotonic()
+    arrays = compute_similarity(snapshot, top_k=top_k, max_user_ads=max_user_ads)
+    version = publish_similarity(arrays, directory)
+    print(f"Published item similarity {version}: {len(arrays['ad_ids'])} ads, {len(arrays['data'])} neighbours "
+          f"from {snapshot.rows} events in {time.monotonic() - started:.1f}s.")
+    return version
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Build the item-to-item similarity matrix from the events snapshot.")
+    parser.add_argument("--snapshot-dir", default=EVENT_SNAPSHOT_DIR or "events_snapshot")
+    parser.add_argument("--dir", default=ITEM_SIMILARITY_DIR or "item_similarity", help="Output directory")
+    parser.add_argument("--top-k", type=int, default=ITEM_SIMILARITY_TOP_K)
+    parser.add_argument("--max-user-ads", type=int, default=ITEM_SIMILARITY_MAX_USER_ADS)
+    parser.add_argument("--interval", type=float, default=0,
+                        help="Keep running and rebuild every N seconds (default: build once and exit)")
+    args = parser.parse_args(argv)
+
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    signal.signal(signal.SIGINT, lambda *_: stop.set())
+    while True:
+        try:
+            build(args.snapshot_dir, args.dir, args.top_k, args.max_user_ads)
+        except Exception as e:
+            print(f"Item similarity build failed: {e}", file=sys.stderr)
+            if not args.interval:
+                sys.exit(1)
+        if not args.interval or stop.wait(args.interval):
+            break
+
+
+if __name__ == "__main__":
+    main()
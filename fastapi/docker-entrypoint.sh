@@ -0,0 +1,11 @@
+#!/bin/sh
+# Entrypoint of every service built from Dockerfile.fastapi (API, events sink, exporter, similarity builder).
+# In multiprocess mode prometheus_client writes one file per process and metric type to
+# PROMETHEUS_MULTIPROC_DIR; files left by the processes of a previous run would be added to this run's
+# metrics, so the directory must exist and start out empty before any process imports the app.
+set -e
+if [ -n "$PROMETHEUS_MULTIPROC_DIR" ]; then
+    rm -rf "$PROMETHEUS_MULTIPROC_DIR"
+    mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
+fi
+exec "$@"
@@ -0,0 +1,264 @@
+"""
+Events sink worker: drains the `ad_events` Kafka topic, the Redis `event_queue` list,
+the API's event spool and a legacy `event_log_fallback.txt` into the MySQL `events`
+table with multi-row inserts.
+
+Run it next to the API:
+
+    python events_sink.py [--batch-size 500] [--flush-interval 1.0] [--once]
+
+Kafka offsets are committed and Redis entries trimmed only after the rows they carry
+were inserted, so a crash replays events instead of losing them. The hourly and daily
+`event_rollups` counts are updated in the same transaction as the inserted events.
+"""
+import argparse
+import json
+import os
+import signal
+import sys
+import threading
+import time
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional
+
+from sqlalchemy import insert
+from sqlalchemy.orm import Session
+
+from app.models.models import EventModel
+from app.services.event_rollups import rollup_counts, upsert_rollups
+from app.services.event_spool import EVENT_SPOOL_DIR, EventSpool
+
+EVENT_SINK_BATCH_SIZE = int(os.getenv("EVENT_SINK_BATCH_SIZE", "500"))
+# Longest time events are accumulated before a batch is inserted, also the idle poll interval
+EVENT_SINK_FLUSH_INTERVAL = float(os.getenv("EVENT_SINK_FLUSH_INTERVAL", "1.0"))
+KAFKA_BROKER = os.getenv('KAFKA_BROKER', 'kafka:9092')
+KAFKA_TOPIC = 'ad_events'
+KAFKA_GROUP_ID = os.getenv("EVENT_SINK_GROUP_ID", "events-sink")
+REDIS_HOST = os.getenv('REDIS_HOST', 'redis')
+REDIS_QUEUE = 'event_queue'
+FALLBACK_FILE = "event_log_fallback.txt" # Written by API versions before the event spool
+
+
+def event_row(event: Dict[str, Any]) -> Dict[str, Any]:
+    """Map an event as logged by /log-event to a row of the events table."""
+    now = datetime.now()
+    timestamp = event.get("timestamp")
+    return {
+        "tenant_id": int(event["tenant_id"]),
+        "ad_id": int(event["ad_id"]),
+        "user_id": int(event["user_id"]) if event.get("user_id") is not None else None,
+        "event_type": str(event["event_type"]),
+        "data": {},
+        "occurred_at": datetime.fromtimestamp(timestamp) if timestamp is not None else now,
+        "created_at": now,
+        "updated_at": now,
+    }
+
+
+def _parse(raw: Any) -> Optional[Dict[str, Any]]:
+    try:
+        event = json.loads(raw) if isinstance(raw, (bytes, str)) else raw
+        return event_row(event)
+    except Exception as e:
+        print(f"Skipping malformed event {raw!r}: {e}", file=sys.stderr)
+        return None
+
+
+class EventsSink:
+    """
+    Moves buffered events into MySQL. Each source is optional, so the sink can run
+    against any subset of Kafka, Redis, the event spool and the fallback file (and
+    against SQLite in tests).
+    """
+
+    def __init__(self, session_factory: Callable[[], Session], consumer: Any = None, redis_client: Any = None,
+                 fallback_path: Optional[str] = FALLBACK_FILE, batch_size: int = EVENT_SINK_BATCH_SIZE,
+                 flush_interval: float = EVENT_SINK_FLUSH_INTERVAL, spool_dir: Optional[str] = None):
+        self.session_factory = session_factory
+        self.consumer = consumer
+        self.redis_client = redis_client
+        self.fallback_path = fallback_path
+        self.spool = EventSpool(spool_dir, replay_batch=batch_size) if spool_dir else None
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.inserted = 0
+
+    def insert_rows(self, rows: List[Dict[str, Any]]) -> int:
+        """Insert rows with one multi-row INSERT per batch, add them to the rollups and commit both together."""
+        if not rows:
+            return 0
+        db = self.session_factory()
+        try:
+            for start in range(0, len(rows), self.batch_size):
+                db.execute(insert(EventModel.__table__), rows[start:start + self.batch_size])
+            upsert_rollups(db, rollup_counts(rows))
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+        self.inserted += len(rows)
+        return len(rows)
+
+    def drain_kafka(self) -> int:
+        """Accumulate up to one batch (or one flush interval) of records, insert them, then commit offsets."""
+        if self.consumer is None:
+            return 0
+        records: Dict[Any, List[Any]] = {}
+        count = 0
+        deadline = time.monotonic() + self.flush_interval
+        while count < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            polled = self.consumer.poll(timeout_ms=int(remaining * 1000), max_records=self.batch_size - count)
+            for partition, partition_records in polled.items():
+                records.setdefault(partition, []).extend(partition_records)
+                count += len(partition_records)
+        if not count:
+            return 0
+
+        rows = [row for partition_records in records.values() for row in map(_parse, (r.value for r in partition_records)) if row]
+        try:
+            self.insert_rows(rows)
+        except Exception:
+            # Rewind to the first uncommitted record so the batch is consumed again
+            for partition, partition_records in records.items():
+                self.consumer.seek(partition, partition_records[0].offset)
+            raise
+        self.consumer.commit()
+        return count
+
+    def drain_redis(self) -> int:
+        """
+        Insert the head of the Redis list, then trim it. Peek-then-trim keeps the entries in
+        Redis until they are in MySQL; it assumes a single sink drains the list.
+        """
+        if self.redis_client is None:
+            return 0
+        raw_events = self.redis_client.lrange(REDIS_QUEUE, 0, self.batch_size - 1)
+        if not raw_events:
+            return 0
+        self.insert_rows([row for row in map(_parse, raw_events) if row])
+        self.redis_client.ltrim(REDIS_QUEUE, len(raw_events), -1)
+        return len(raw_events)
+
+    def replay_fallback_file(self) -> int:
+        """
+        Replay events written to the fallback file. The file is first renamed so new
+        fallback writes go to a fresh file; progress is recorded after every inserted
+        batch so an interrupted replay resumes where it stopped.
+        """
+        if not self.fallback_path:
+            return 0
+        replaying = self.fallback_path + ".replaying"
+        progress_path = replaying + ".offset"
+        if not os.path.exists(replaying):
+            if not os.path.exists(self.fallback_path) or os.path.getsize(self.fallback_path) == 0:
+                return 0
+            os.replace(self.fallback_path, replaying)
+
+        done = 0
+        if os.path.exists(progress_path):
+            with open(progress_path) as f:
+                done = int(f.read().strip() or 0)
+
+        replayed = 0
+        with open(replaying) as f:
+            lines = [line for line in f if line.strip()]
+        for start in range(done, len(lines), self.batch_size):
+            chunk = lines[start:start + self.batch_size]
+            self.insert_rows([row for row in map(_parse, chunk) if row])
+            replayed += len(chunk)
+            with open(progress_path, "w") as f:
+                f.write(str(start + len(chunk)))
+        os.remove(replaying)
+        if os.path.exists(progress_path):
+            os.remove(progress_path)
+        return replayed
+
+    def replay_spool(self) -> int:
+        """
+        Insert the sealed segments of the API's event spool. The API replays them to Kafka
+        itself; this drains them straight to MySQL when Kafka stays down. Both take the
+        spool's replay lock, so a segment is never replayed twice concurrently.
+        """
+        if self.spool is None:
+            return 0
+        return self.spool.replay(lambda events: self.insert_rows([row for row in map(_parse, events) if row]))
+
+    def run_once(self) -> int:
+        """Drain every configured source once; returns the number of events consumed."""
+        total = 0
+        for drain in (self.drain_kafka, self.drain_redis, self.replay_spool, self.replay_fallback_file):
+            try:
+                total += drain()
+            except Exception as e:
+                print(f"Events sink: {drain.__name__} failed: {e}", file=sys.stderr)
+        return total
+
+    def run(self, stop: threading.Event) -> None:
+        while not stop.is_set():
+            if not self.run_once():
+                stop.wait(self.flush_interval)
+
+
+def _kafka_consumer() -> Any:
+    try:
+        from kafka import KafkaConsumer
+        return KafkaConsumer(
+            KAFKA_TOPIC,
+            bootstrap_servers=KAFKA_BROKER.split(','),
+            group_id=KAFKA_GROUP_ID,
+            enable_auto_commit=False, # Offsets are committed only after the insert succeeded
+            auto_offset_reset='earliest',
+            api_version=(0, 10, 1),
+        )
+    except Exception as e:
+        print(f"Could not connect to Kafka at {KAFKA_BROKER}: {e}. Kafka will not be drained.", file=sys.stderr)
+        return None
+
+
+def _redis_client() -> Any:
+    try:
+        import redis
+        client = redis.StrictRedis(host=REDIS_HOST, port=6379, db=0, socket_connect_timeout=1)
+        client.ping()
+        return client
+    except Exception as e:
+        print(f"Could not connect to Redis at {REDIS_HOST}: {e}. Redis will not be drained.", file=sys.stderr)
+        return None
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Drain buffered ad events into the MySQL events table.")
+    parser.add_argument("--batch-size", type=int, default=EVENT_SINK_BATCH_SIZE)
+    parser.add_argument("--flush-interval", type=float, default=EVENT_SINK_FLUSH_INTERVAL)
+    parser.add_argument("--fallback-file", default=FALLBACK_FILE)
+    parser.add_argument("--spool-dir", default="",
+                        help=f"Also drain the API's event spool (e.g. {EVENT_SPOOL_DIR}) straight to MySQL, for outages where Kafka stays down")
+    parser.add_argument("--once", action="store_true", help="Drain each source once and exit")
+    args = parser.parse_args(argv)
+
+    from app.services.database import SessionLocal
+
+    sink = EventsSink(SessionLocal, consumer=_kafka_consumer(), redis_client=_redis_client(),
+                      fallback_path=args.fallback_file, batch_size=args.batch_size, flush_interval=args.flush_interval,
+                      spool_dir=args.spool_dir or None)
+    if args.once:
+        print(f"Events sink drained {sink.run_once()} events.")
+        return
+
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    signal.signal(signal.SIGINT, lambda *_: stop.set())
+    print("Events sink started.")
+    sink.run(stop)
+    if sink.consumer is not None:
+        sink.consumer.close()
+    print(f"Events sink stopped after inserting {sink.inserted} events.")
+
+
+if __name__ == "__main__":
+    main()
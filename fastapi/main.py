@@ -1,69 +1,58 @@
-from fastapi import FastAPI, HTTPException, Depends
-from pydantic import BaseModel
-from typing import List, Optional, Dict, Any
-import random
 import time
+_import_started = time.perf_counter() # Exported as app_startup_duration_seconds{phase="import"}
+
+from fastapi import FastAPI, HTTPException, Depends, Header, Query, Request, Response, Body
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import PlainTextResponse
+from pydantic import BaseModel, ValidationError, conint
+from typing import List, Optional, Dict, Any, Mapping, Set, Tuple
+import random
 import json
 import redis
 from kafka import KafkaProducer
 import os
 import sys
+import atexit
+import hmac
+import threading
+from contextlib import asynccontextmanager, contextmanager
 
 # Import SQLAlchemy components for database integration
 from sqlalchemy.orm import Session
-from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime, JSON, TIMESTAMP
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
-from datetime import datetime, timedelta
+from sqlalchemy.ext.asyncio import AsyncSession
+from datetime import date, datetime
 
-# --- Database Configuration (FastAPI's perspective) ---
-DB_HOST = os.getenv("DB_HOST", "db")
-DB_PORT = os.getenv("DB_PORT", "3306")
-DB_DATABASE = os.getenv("DB_DATABASE", "ad_platform_db")
-DB_USERNAME = os.getenv("DB_USERNAME", "user")
-DB_PASSWORD = os.getenv("DB_PASSWORD", "password")
-
-SQLALCHEMY_DATABASE_URL = f"mysql+pymysql://{DB_USERNAME}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_DATABASE}"
+from app.models.models import Base, AdModel, EventModel # noqa: F401 (Base and AdModel are re-exported)
+from app.services.ad_catalog import AdCatalog, CatalogSnapshot, SharedAdCatalog
+from app.services.ctr_stats import CtrStats
+from app.services.event_snapshot import EVENT_SNAPSHOT_DIR
+from app.services.item_similarity import ItemSimilarity
+from app.services.shared_state import MODEL_STATE_DIR
+from app.services.scoring import NumpyScorer, rank_ads_python
+from app.services.bandit import ThompsonSampler, new_rng
+from app.services.event_pipeline import BufferFull, EventPipeline
+from app.services.event_spool import EventSpool
+from app.services.event_rollups import GRANULARITIES, conversion_report, events_report
+from app.services.recommendation_cache import RecommendationCache
+from app.services.single_flight import SingleFlight
+from app.services.user_profiles import UserProfiles
+from app.services.clients import CLIENT_RECONNECT_DELAY, CLIENT_RECONNECT_MAX_DELAY, ManagedClient
+from app.services.circuit_breaker import OPEN, CircuitBreaker
+from app.services import metrics, tracing
+from app.services.profiler import SamplingProfiler, render_collapsed
 
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL,
-    pool_pre_ping=True
-)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-Base = declarative_base()
+# --- Database Configuration (FastAPI's perspective) ---
+# Engines, pool sizing (DB_POOL_* env vars) and the session dependencies live in app/services/database.py.
+# Recommendation handlers use the async engine; background refreshes use the sync one.
+from app.services.database import engine, async_engine, SessionLocal, get_async_db
 
-# Dependency to get DB session
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+metrics.instrument_pool(engine.pool, "sync") # Exposes checkout wait and pool usage on /metrics
+metrics.instrument_pool(async_engine.sync_engine.pool, "async")
+tracing.instrument_engine(engine) # Records SQL statements of traced requests
+tracing.instrument_engine(async_engine.sync_engine)
 
 # --- SQLAlchemy Models (FastAPI's view of Laravel's tables) ---
-class AdModel(Base):
-    __tablename__ = "ads"
-    id = Column(Integer, primary_key=True, index=True)
-    tenant_id = Column(Integer, index=True)
-    name = Column(String)
-    content = Column(Text)
-    start_time = Column(DateTime)
-    end_time = Column(DateTime)
-    target_audience = Column(JSON, nullable=True) # Assuming JSON support
-    created_at = Column(DateTime, default=datetime.now)
-    updated_at = Column(DateTime, default=datetime.now, onupdate=datetime.now)
-
-class EventModel(Base):
-    __tablename__ = "events"
-    id = Column(Integer, primary_key=True, index=True)
-    tenant_id = Column(Integer, index=True)
-    ad_id = Column(Integer, index=True)
-    user_id = Column(Integer, nullable=True, index=True)
-    event_type = Column(String)
-    data = Column(JSON, nullable=True)
-    occurred_at = Column(TIMESTAMP, default=datetime.now)
-    created_at = Column(DateTime, default=datetime.now)
-    updated_at = Column(DateTime, default=datetime.now, onupdate=datetime.now)
+# AdModel and EventModel are defined in app/models/models.py and shared with the services.
 
 # Attempt to create tables (for development/testing, migrations handle this in production Laravel)
 # Base.metadata.create_all(bind=engine) # This should be handled by Laravel migrations. Keep commented for now.
@@ -73,139 +62,507 @@ KAFKA_BROKER = os.getenv('KAFKA_BROKER', 'kafka:9092')
 REDIS_HOST = os.getenv('REDIS_HOST', 'redis')
 
 # --- Clients ---
+# Created in the background once the app starts (see `lifespan`), never at import time: a slow or
+# unreachable broker delays neither the import nor the startup. Until a client is connected it is
+# None and events fall back to the next sink.
 kafka_producer = None
-try:
-    kafka_producer = KafkaProducer(
+redis_client = None
+
+def _connect_kafka() -> KafkaProducer:
+    producer = KafkaProducer(
         bootstrap_servers=KAFKA_BROKER.split(','), # Split brokers for multiple nodes
         value_serializer=lambda v: json.dumps(v).encode('utf-8'),
         api_version=(0, 10, 1) # Specify API version to avoid common connection issues
     )
-    # Test if Kafka is reachable by trying to list topics (non-blocking)
-    kafka_producer.bootstrap_connected()
-    print("Kafka producer initialized successfully and connected to broker.")
-except Exception as e:
-    print(f"Could not connect to Kafka at {KAFKA_BROKER}: {e}. Event logging to Kafka will be disabled.", file=sys.stderr)
-    kafka_producer = None # Ensure it's None if connection fails
-    
-redis_client = None
-try:
-    redis_client = redis.StrictRedis(host=REDIS_HOST, port=6379, db=0, socket_connect_timeout=1) # Short timeout
-    redis_client.ping() # Test connection
-    print("Redis client initialized successfully and connected.")
-except Exception as e:
-    print(f"Could not connect to Redis at {REDIS_HOST}: {e}. Event logging to Redis will be disabled.", file=sys.stderr)
-    redis_client = None # Ensure it's None if connection fails
+    if not producer.bootstrap_connected():
+        producer.close(timeout=0)
+        raise ConnectionError(f"no broker reachable at {KAFKA_BROKER}")
+    return producer
+
+def _connect_redis() -> redis.StrictRedis:
+    client = redis.StrictRedis(host=REDIS_HOST, port=6379, db=0, socket_connect_timeout=1) # Short timeout
+    client.ping() # Test connection
+    return client
+
+def _set_kafka_producer(producer) -> None:
+    global kafka_producer
+    kafka_producer = producer
+
+def _set_redis_client(client) -> None:
+    global redis_client
+    redis_client = client
+
+kafka_connection = ManagedClient("kafka", _connect_kafka, check=lambda producer: producer.bootstrap_connected(),
+                                 close=lambda producer: producer.close(timeout=KAFKA_FLUSH_TIMEOUT), on_change=_set_kafka_producer)
+redis_connection = ManagedClient("redis", _connect_redis, check=lambda client: client.ping(),
+                                 close=lambda client: client.close(), on_change=_set_redis_client)
+
+# --- Circuit Breakers ---
+# One per sink: after CIRCUIT_FAILURE_THRESHOLD consecutive failures, events go straight to the next
+# sink instead of waiting on a broken one, and a background probe detects when the sink is back.
+kafka_breaker = CircuitBreaker("kafka", probe=lambda: kafka_producer is not None and kafka_producer.bootstrap_connected())
+redis_breaker = CircuitBreaker("redis", probe=lambda: redis_client is not None and redis_client.ping())
+
+def _kafka_available() -> bool:
+    """Whether to send to Kafka: the producer exists, its circuit lets the call through and it reaches a broker."""
+    if not kafka_producer or not kafka_breaker.allow():
+        return False
+    if not kafka_producer.bootstrap_connected():
+        kafka_breaker.record_failure("not connected to any bootstrap server")
+        return False
+    return True
+
+# Records sent to Kafka but not yet acknowledged, exported as the producer's queue depth
+kafka_in_flight = metrics.InFlightRecords(metrics.KAFKA_PRODUCER_QUEUE_DEPTH)
+
+# --- Ad Catalog ---
+# Ads are served from memory and refreshed incrementally instead of re-reading the whole table per request.
+# With MODEL_STATE_DIR (multi-worker serving) one worker refreshes and all workers map the published catalog.
+ad_catalog = SharedAdCatalog(os.path.join(MODEL_STATE_DIR, "catalog")) if MODEL_STATE_DIR else AdCatalog()
+
+# --- CTR Statistics ---
+# Per-ad impression/click counters, bumped by /log-event and reconciled against the events table
+# (or against the exported events snapshot plus the events added since, when EVENT_SNAPSHOT_DIR is set).
+# With MODEL_STATE_DIR, one worker reconciles and the others load its published totals.
+ctr_stats = CtrStats(snapshot_dir=EVENT_SNAPSHOT_DIR or None,
+                     shared_dir=os.path.join(MODEL_STATE_DIR, "ctr") if MODEL_STATE_DIR else None)
+
+# --- Scoring Engine ---
+# "numpy" scores the whole catalog with vectorized array operations, "python" is the original dict-based loop.
+RECOMMENDER_SCORING_ENGINE = os.getenv("RECOMMENDER_SCORING_ENGINE", "numpy")
+numpy_scorer = NumpyScorer()
+
+# --- Exploration ---
+# Cold-start users and fill slots get ads by Thompson sampling over per-ad Beta posteriors of the CTR counters.
+thompson_sampler = ThompsonSampler()
+
+# --- Recommendation Cache ---
+# Per-user results in an in-process LRU backed by Redis, dropped when the user clicks.
+recommendation_cache = RecommendationCache(redis_client=lambda: redis_client)
+
+# --- User Profiles ---
+# "materialized" keeps per-user tag affinities up to date as events arrive (O(tags) per request);
+# "history" re-reads and re-weights the user's whole event history on every request.
+USER_PROFILE_SOURCE = os.getenv("USER_PROFILE_SOURCE", "materialized")
+user_profiles = UserProfiles(redis_client=lambda: redis_client)
+
+# --- Item Similarity ---
+# Top-K ad x ad cosine similarities built offline by build_similarity.py (ITEM_SIMILARITY_DIR), hot-reloaded.
+item_similarity = ItemSimilarity()
+
+# Upper bound on user_ids per /recommend/batch call, keeps the IN (...) list and the score matrix bounded
+RECOMMEND_BATCH_MAX_USERS = int(os.getenv("RECOMMEND_BATCH_MAX_USERS", "500"))
+# Recommendations per user: /recommend returns (and caches) RECOMMEND_DEFAULT_TOP_N unless asked for
+# another count, at most RECOMMEND_MAX_TOP_N, which bounds the ranking and sampling work per user.
+RECOMMEND_DEFAULT_TOP_N = 5
+RECOMMEND_MAX_TOP_N = int(os.getenv("RECOMMEND_MAX_TOP_N", "50"))
+
+# --- Profiling ---
+# Whether any client may trace its request with `X-Trace: 1` or `?trace=1`; otherwise only callers sending ADMIN_TOKEN can
+REQUEST_TRACE_ENABLED = os.getenv("REQUEST_TRACE_ENABLED", "false").lower() in ("1", "true", "yes")
+# Token expected in the X-Admin-Token header by the /admin and /reports endpoints; they are disabled while it is empty
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+sampling_profiler = SamplingProfiler()
 
 # --- Recommendation Logic (Enhanced Collaborative Filtering with DB Data) ---
-def enhanced_collaborative_filtering(user_id: int, db: Session, top_n: int = 5) -> List[Dict[str, Any]]:
+def _user_interactions(user_events: List[EventModel]) -> List[Dict[str, Any]]:
+    """Turn a user's events (newest first) into weighted interactions."""
+    user_interactions = []
+    for event in user_events:
+        # Assign weights based on event type and recency
+        weight = 1.0 if event.event_type == 'click' else 0.5 # Clicks are weighted higher
+        
+        # Recency factor: more recent events have higher impact
+        time_diff_seconds = (datetime.now() - event.occurred_at).total_seconds()
+        # Normalize recency over a period (e.g., 60 days)
+        recency_factor = max(0.1, 1 - (time_diff_seconds / (86400 * 60))) # Max 60 days relevance
+        
+        user_interactions.append({"ad_id": event.ad_id, "timestamp": event.occurred_at.timestamp(), "weight": weight * recency_factor})
+    return user_interactions
+
+def _tag_profile(user_interactions: List[Dict[str, Any]], all_ads_data: Dict[int, Dict[str, Any]]) -> Tuple[Dict[str, float], Set[int]]:
+    """Return the user's normalized tag scores and the ids of the ads they interacted with."""
+    tag_scores: Dict[str, float] = {}
+    interacted_ad_ids = set()
+    for interaction in user_interactions:
+        ad_id = interaction["ad_id"]
+        interacted_ad_ids.add(ad_id)
+        ad_info = all_ads_data.get(ad_id)
+        if ad_info and "tags" in ad_info:
+            weight = interaction.get("weight", 1.0)
+            for tag in ad_info["tags"]:
+                tag_scores[tag] = tag_scores.get(tag, 0.0) + weight
+
+    total_score = sum(tag_scores.values())
+    if total_score > 0:
+        for tag in tag_scores:
+            tag_scores[tag] /= total_score # Normalize tag scores
+    return tag_scores, interacted_ad_ids
+
+def _cached_tag_profiles(user_ids: List[int], tenant_id: Optional[int] = None) -> Tuple[Dict[int, Optional[Tuple[Dict[str, float], Set[int]]]], List[int]]:
+    """
+    Return the `(tag_scores, interacted_ad_ids)` of the users with a materialized profile (None for
+    users without history) and the users whose history has to be read. A tenant-restricted request
+    uses the users' profiles of that tenant, which are kept alongside their cross-tenant ones.
+    """
+    if USER_PROFILE_SOURCE != "materialized":
+        return {}, list(user_ids)
+    results: Dict[int, Optional[Tuple[Dict[str, float], Set[int]]]] = {}
+    missing = []
+    for user_id in user_ids:
+        profile = user_profiles.get(user_id, tenant_id)
+        if profile is None:
+            missing.append(user_id)
+        else:
+            results[user_id] = user_profiles.tag_profile(profile) if profile.ad_ids else None
+    return results, missing
+
+def _history_events(user_ids: List[int], db: Session, tenant_id: Optional[int] = None) -> Dict[int, List[EventModel]]:
+    """Fetch the event history (newest first) of all `user_ids` with a single query."""
+    history_query = db.query(EventModel).filter(EventModel.user_id.in_(user_ids))
+    if tenant_id is not None:
+        history_query = history_query.filter(EventModel.tenant_id == tenant_id)
+    events_by_user: Dict[int, List[EventModel]] = {user_id: [] for user_id in user_ids}
+    for event in history_query.order_by(EventModel.occurred_at.desc()).all():
+        events_by_user[event.user_id].append(event)
+    return events_by_user
+
+def _history_tag_profiles(events_by_user: Dict[int, List[EventModel]], all_ads_data: Dict[int, Dict[str, Any]], tenant_id: Optional[int] = None) -> Dict[int, Optional[Tuple[Dict[str, float], Set[int]]]]:
+    """Build the profiles of users from their history, materializing them when profiles are in use."""
+    results: Dict[int, Optional[Tuple[Dict[str, float], Set[int]]]] = {}
+    for user_id, events in events_by_user.items():
+        if USER_PROFILE_SOURCE == "materialized":
+            # Materialize once; from now on the profile is updated as events are logged
+            profile = user_profiles.materialize(user_id, events, all_ads_data, tenant_id)
+            results[user_id] = user_profiles.tag_profile(profile) if profile.ad_ids else None
+        else:
+            user_interactions = _user_interactions(events)
+            results[user_id] = _tag_profile(user_interactions, all_ads_data) if user_interactions else None
+    return results
+
+def _load_tag_profiles(user_ids: List[int], db: Session, all_ads_data: Dict[int, Dict[str, Any]], tenant_id: Optional[int] = None) -> Dict[int, Optional[Tuple[Dict[str, float], Set[int]]]]:
+    """
+    Return `(tag_scores, interacted_ad_ids)` per user, or None for users without history.
+    Materialized profiles are used when available; the events of all other users are
+    fetched with a single query.
+    """
+    results, missing = _cached_tag_profiles(user_ids, tenant_id)
+    if missing:
+        results.update(_history_tag_profiles(_history_events(missing, db, tenant_id), all_ads_data, tenant_id))
+    return results
+
+async def _load_tag_profiles_async(user_ids: List[int], db: AsyncSession, all_ads_data: Dict[int, Dict[str, Any]], tenant_id: Optional[int] = None) -> Dict[int, Optional[Tuple[Dict[str, float], Set[int]]]]:
+    """
+    `_load_tag_profiles` for async handlers: only the history query runs through `run_sync` on the
+    event loop; the Redis reads and writes of the profiles and building them run in worker threads.
+    """
+    results, missing = await run_in_threadpool(_cached_tag_profiles, user_ids, tenant_id)
+    if missing:
+        events_by_user = await db.run_sync(lambda session: _history_events(missing, session, tenant_id))
+        results.update(await run_in_threadpool(_history_tag_profiles, events_by_user, all_ads_data, tenant_id))
+    return results
+
+def _rank_profiles(catalog: CatalogSnapshot, profiles: List[Tuple[Dict[str, float], Set[int]]], ad_ctrs, top_n: int, scoring_engine: Optional[str], tenant_id: Optional[int] = None, timings: Optional[Dict[str, float]] = None) -> List[List[int]]:
+    """
+    Rank the candidates of each `(tag_scores, interacted_ad_ids)` profile with the selected scoring engine.
+    Candidates are the live ads of the tenant (every tenant if None) sharing at least one tag with the profile
+    or, when a similarity matrix is loaded, similar to one of the interacted ads.
+    Seconds spent per stage ("candidates", "score", "sort") are added to `timings` if given.
+    """
+    started = time.perf_counter()
+    index = catalog.index
+    matrix = item_similarity.current()
+    similarity = [matrix.scores(interacted_ad_ids) for _, interacted_ad_ids in profiles] if matrix is not None else None
+    candidate_rows = [index.candidate_rows(tenant_id, [tag for tag, score in tag_scores.items() if score > 0],
+                                           ad_ids=similarity[position] if similarity is not None else ())
+                      for position, (tag_scores, _) in enumerate(profiles)]
+    if timings is not None:
+        timings["candidates"] = timings.get("candidates", 0.0) + time.perf_counter() - started
+    engine_name = scoring_engine or RECOMMENDER_SCORING_ENGINE
+    if engine_name == "numpy":
+        return numpy_scorer.rank_many(catalog, profiles, ad_ctrs, top_n, ctr_version=ctr_stats.version,
+                                      candidate_rows=candidate_rows, timings=timings, similarity=similarity)
+    return [rank_ads_python(catalog.ads, tag_scores, ad_ctrs, interacted_ad_ids, top_n, candidates=index.ad_ids[rows].tolist(), timings=timings,
+                            similarity=similarity[position] if similarity is not None else None)
+            for position, ((tag_scores, interacted_ad_ids), rows) in enumerate(zip(profiles, candidate_rows))]
+
+def _live_ads(catalog: CatalogSnapshot, tenant_id: Optional[int] = None) -> List[Dict[str, Any]]:
+    """Ads of the tenant (every tenant if None) whose start_time/end_time window contains now."""
+    index = catalog.index
+    return [catalog.ads[ad_id] for ad_id in index.ad_ids[index.live_rows(tenant_id)].tolist()]
+
+def _cold_start_recommendations(catalog: CatalogSnapshot, top_n: int, tenant_id: Optional[int] = None, rng=None) -> List[Dict[str, Any]]:
+    # If no history, explore the live ads by Thompson sampling: high CTRs win most draws, unproven ads still get shown
+    ad_ids = thompson_sampler.sample(catalog, ctr_stats, catalog.index.live_rows(tenant_id), top_n, rng=rng)
+    return [catalog.ads[ad_id] for ad_id in ad_ids]
+
+def _fill_recommendations(recommendations: List[Dict[str, Any]], catalog: CatalogSnapshot, top_n: int, tenant_id: Optional[int] = None, rng=None) -> List[Dict[str, Any]]:
+    # If not enough recommendations from collaborative filtering, fill the remaining slots by Thompson sampling
+    if len(recommendations) < top_n:
+        ad_ids = thompson_sampler.sample(catalog, ctr_stats, catalog.index.live_rows(tenant_id), top_n - len(recommendations),
+                                         exclude=[ad['id'] for ad in recommendations], rng=rng)
+        recommendations.extend(catalog.ads[ad_id] for ad_id in ad_ids)
+    return recommendations
+
+@contextmanager
+def _stage(name: str):
+    """Time a recommendation stage in its histogram and, for a traced request, as a span."""
+    with metrics.RECOMMENDATION_STAGE_LATENCY.labels(name).time(), tracing.span(name):
+        yield
+
+def _recommender_state() -> Tuple[CatalogSnapshot, Mapping[int, float]]:
+    """
+    The catalog and CTRs for async handlers, refreshed first when due with a session of their
+    own (it only opens a connection for a refresh). Does blocking I/O: call it in a worker thread.
+    """
+    db = SessionLocal()
+    try:
+        with _stage("catalog"):
+            catalog = ad_catalog.snapshot(db)
+        with _stage("ctr"):
+            ad_ctrs = ctr_stats.ctrs(db)
+        return catalog, ad_ctrs
+    finally:
+        db.close()
+
+def _rank_user(user_id: int, tag_profile: Optional[Tuple[Dict[str, float], Set[int]]], catalog: CatalogSnapshot, ad_ctrs, top_n: int, scoring_engine: Optional[str], tenant_id: Optional[int], seed: Optional[int]) -> List[Dict[str, Any]]:
+    """Recommendations for a loaded profile: ranked, or sampled for cold-start users, then filled up to `top_n`."""
+    if tag_profile is None:
+        print(f"User {user_id} has no history. Falling back to Thompson sampling over the CTRs.")
+        with _stage("cold_start"):
+            return _cold_start_recommendations(catalog, top_n, tenant_id, new_rng(seed))
+
+    timings: Dict[str, float] = {}
+    with tracing.span("rank"):
+        ranked_ad_ids = _rank_profiles(catalog, [tag_profile], ad_ctrs, top_n, scoring_engine, tenant_id, timings)[0]
+    for stage, seconds in timings.items():
+        metrics.RECOMMENDATION_STAGE_LATENCY.labels(stage).observe(seconds)
+        tracing.record_span(stage, seconds)
+    recommendations = [catalog.ads[ad_id] for ad_id in ranked_ad_ids]
+    with _stage("fill"):
+        return _fill_recommendations(recommendations, catalog, top_n, tenant_id, new_rng(seed))
+
+def _rank_users(user_ids: List[int], tag_profiles: Dict[int, Optional[Tuple[Dict[str, float], Set[int]]]], catalog: CatalogSnapshot, ad_ctrs, top_n: int, scoring_engine: Optional[str], tenant_id: Optional[int], seed: Optional[int]) -> Dict[int, List[Dict[str, Any]]]:
+    """`_rank_user` for many users, all users with history scored together."""
+    rng = new_rng(seed)
+    results: Dict[int, List[Dict[str, Any]]] = {}
+    warm_user_ids = []
+    profiles = []
+    for user_id in user_ids:
+        if tag_profiles[user_id] is None:
+            results[user_id] = _cold_start_recommendations(catalog, top_n, tenant_id, rng)
+            continue
+        warm_user_ids.append(user_id)
+        profiles.append(tag_profiles[user_id])
+
+    for user_id, ranked_ad_ids in zip(warm_user_ids, _rank_profiles(catalog, profiles, ad_ctrs, top_n, scoring_engine, tenant_id)):
+        recommendations = [catalog.ads[ad_id] for ad_id in ranked_ad_ids]
+        results[user_id] = _fill_recommendations(recommendations, catalog, top_n, tenant_id, rng)
+    return results
+
+def _fallback_recommendations(catalog: Optional[CatalogSnapshot], user_ids: List[int], top_n: int, tenant_id: Optional[int] = None) -> Dict[int, List[Dict[str, Any]]]:
+    """Random live ads per user when the DB fails mid-recommendation (none before the first catalog load)."""
+    live_ads = _live_ads(catalog, tenant_id) if catalog is not None else []
+    if live_ads:
+        print("Falling back to random recommendations due to DB error.")
+        return {user_id: random.sample(live_ads, min(top_n, len(live_ads))) for user_id in user_ids}
+    print("No ads available for recommendation even with fallback.")
+    return {user_id: [] for user_id in user_ids}
+
+def enhanced_collaborative_filtering(user_id: int, db: Session, top_n: int = 5, scoring_engine: Optional[str] = None, tenant_id: Optional[int] = None, seed: Optional[int] = None) -> List[Dict[str, Any]]:
     """
     Enhanced item-based collaborative filtering simulation, considering:
-    1. User's interacted ads (from MySQL events table).
-    2. Simulated recency and frequency (via occurred_at and event_type).
+    1. User's interacted ads (materialized profile, built from the MySQL events table when missing).
+    2. Recency and frequency (exponentially decayed click/impression weights).
     3. Similarity between ads (based on shared tags - fetched from DB ads).
     4. Ad click-through rates (CTR) for a general popularity boost.
+    Only ads that are live and belong to `tenant_id` (every tenant if None) are recommended.
+    `scoring_engine` ("python" or "numpy") overrides RECOMMENDER_SCORING_ENGINE; both produce the same ranking.
+    Cold-start and fill ads are sampled; `seed` makes the draws reproducible.
     """
+    catalog = None
     try:
-        ads_from_db = db.query(AdModel).all()
-        all_ads_data = {ad.id: {"id": ad.id, "name": ad.name, "tags": ad.target_audience.get("interests", []) if ad.target_audience else []} for ad in ads_from_db}
-
-        # Calculate general ad CTRs
-        ad_impressions = {}
-        ad_clicks = {}
-        all_events = db.query(EventModel).all() # Fetch all events to calculate global CTR
-        for event in all_events:
-            if event.event_type == 'impression':
-                ad_impressions[event.ad_id] = ad_impressions.get(event.ad_id, 0) + 1
-            elif event.event_type == 'click':
-                ad_clicks[event.ad_id] = ad_clicks.get(event.ad_id, 0) + 1
-        
-        ad_ctrs = {ad_id: ad_clicks.get(ad_id, 0) / ad_impressions[ad_id] if ad_impressions.get(ad_id, 0) > 0 else 0 for ad_id in ad_impressions}
+        with _stage("catalog"):
+            catalog = ad_catalog.snapshot(db)
 
-        # Fetch user's event history from the database
-        user_events = db.query(EventModel).filter(EventModel.user_id == user_id).order_by(EventModel.occurred_at.desc()).all()
-        
-        user_interactions = []
-        for event in user_events:
-            # Assign weights based on event type and recency
-            weight = 1.0 if event.event_type == 'click' else 0.5 # Clicks are weighted higher
-            
-            # Recency factor: more recent events have higher impact
-            time_diff_seconds = (datetime.now() - event.occurred_at).total_seconds()
-            # Normalize recency over a period (e.g., 60 days)
-            recency_factor = max(0.1, 1 - (time_diff_seconds / (86400 * 60))) # Max 60 days relevance
-            
-            user_interactions.append({"ad_id": event.ad_id, "timestamp": event.occurred_at.timestamp(), "weight": weight * recency_factor})
-
-        if not user_interactions:
-            print(f"User {user_id} has no history. Falling back to random recommendation with CTR bias.")
-            # If no history, recommend based on general popularity (CTR)
-            sorted_by_ctr = sorted(all_ads_data.values(), key=lambda ad: ad_ctrs.get(ad['id'], 0), reverse=True)
-            return random.sample(sorted_by_ctr, min(top_n, len(sorted_by_ctr)))
-
-        tag_scores: Dict[str, float] = {}
-        interacted_ad_ids = set()
-        for interaction in user_interactions:
-            ad_id = interaction["ad_id"]
-            interacted_ad_ids.add(ad_id)
-            ad_info = all_ads_data.get(ad_id)
-            if ad_info and "tags" in ad_info:
-                weight = interaction.get("weight", 1.0)
-                for tag in ad_info["tags"]:
-                    tag_scores[tag] = tag_scores.get(tag, 0.0) + weight
-
-        total_score = sum(tag_scores.values())
-        if total_score > 0:
-            for tag in tag_scores:
-                tag_scores[tag] /= total_score # Normalize tag scores
-
-        ad_scores: Dict[int, float] = {}
-        for ad_id, ad_info in all_ads_data.items():
-            if ad_id in interacted_ad_ids:
-                continue # Do not recommend ads the user has already interacted with recently
-
-            current_ad_score = 0.0
-            if "tags" in ad_info:
-                for tag in ad_info["tags"]:
-                    current_ad_score += tag_scores.get(tag, 0.0) # Add score from collaborative filtering
-
-            # Add a component for general popularity (CTR), scaled down to not overpower personalization
-            current_ad_score += ad_ctrs.get(ad_id, 0) * 0.5 # CTR has a weight of 0.5
-
-            ad_scores[ad_id] = current_ad_score
-        
-        sorted_ads = sorted(ad_scores.items(), key=lambda item: item[1], reverse=True)
-        
-        recommendations = []
-        for ad_id, score in sorted_ads:
-            if score > 0: # Only recommend ads with a positive score
-                recommendations.append(all_ads_data[ad_id])
-                if len(recommendations) >= top_n:
-                    break
-        
-        # If not enough recommendations from collaborative filtering, fill with top CTR ads (excluding already recommended)
-        if len(recommendations) < top_n:
-            fill_count = top_n - len(recommendations)
-            current_recommended_ids = {ad['id'] for ad in recommendations}
-            
-            # Get all ads sorted by CTR, filter out already recommended ones
-            all_ads_sorted_by_ctr = sorted(all_ads_data.values(), key=lambda ad: ad_ctrs.get(ad['id'], 0), reverse=True)
-            available_ads_for_fill = [ad for ad in all_ads_sorted_by_ctr if ad['id'] not in current_recommended_ids]
-
-            if available_ads_for_fill:
-                random_fill = random.sample(available_ads_for_fill, min(fill_count, len(available_ads_for_fill)))
-                recommendations.extend(random_fill)
-
-        return recommendations
+        # General ad CTRs, pre-aggregated instead of scanning the events table
+        with _stage("ctr"):
+            ad_ctrs = ctr_stats.ctrs(db)
+
+        # User's tag affinities and interacted ads
+        with _stage("history"):
+            tag_profile = _load_tag_profiles([user_id], db, catalog.ads, tenant_id=tenant_id)[user_id]
+
+        return _rank_user(user_id, tag_profile, catalog, ad_ctrs, top_n, scoring_engine, tenant_id, seed)
+    except Exception as e:
+        print(f"Database query failed during recommendation: {e}", file=sys.stderr)
+        return _fallback_recommendations(catalog, [user_id], top_n, tenant_id)[user_id]
+
+async def enhanced_collaborative_filtering_async(user_id: int, db: AsyncSession, top_n: int = 5, scoring_engine: Optional[str] = None, tenant_id: Optional[int] = None, seed: Optional[int] = None) -> List[Dict[str, Any]]:
+    """
+    `enhanced_collaborative_filtering` for async handlers. Only the history query runs on the event
+    loop, through `run_sync`; the catalog and CTR refreshes, the Redis profile reads and writes and the
+    scoring run in worker threads, so none of them holds up the other requests of the worker.
+    """
+    catalog = None
+    try:
+        catalog, ad_ctrs = await run_in_threadpool(_recommender_state)
+        with _stage("history"):
+            tag_profile = (await _load_tag_profiles_async([user_id], db, catalog.ads, tenant_id=tenant_id))[user_id]
+        return await run_in_threadpool(_rank_user, user_id, tag_profile, catalog, ad_ctrs, top_n, scoring_engine, tenant_id, seed)
     except Exception as e:
         print(f"Database query failed during recommendation: {e}", file=sys.stderr)
-        # Fallback to random recommendations if DB fails
-        if 'all_ads_data' in locals() and all_ads_data:
-            print("Falling back to random recommendations due to DB error.")
-            return random.sample(list(all_ads_data.values()), min(top_n, len(all_ads_data)))
+        return _fallback_recommendations(catalog, [user_id], top_n, tenant_id)[user_id]
+
+def batch_collaborative_filtering(user_ids: List[int], db: Session, top_n: int = 5, tenant_id: Optional[int] = None, scoring_engine: Optional[str] = None, seed: Optional[int] = None) -> Dict[int, List[Dict[str, Any]]]:
+    """
+    Same recommendations as `enhanced_collaborative_filtering` for many users at once:
+    the catalog and CTRs are read once, missing profiles come from a single `IN (...)` query,
+    and all users with history are scored together. `tenant_id` restricts both the histories and
+    the recommended ads to that tenant. With `seed`, the sampled ads are reproducible for the same user_ids.
+    """
+    unique_user_ids = list(dict.fromkeys(user_ids))
+    catalog = None
+    try:
+        catalog = ad_catalog.snapshot(db)
+        ad_ctrs = ctr_stats.ctrs(db)
+        tag_profiles = _load_tag_profiles(unique_user_ids, db, catalog.ads, tenant_id=tenant_id)
+        return _rank_users(unique_user_ids, tag_profiles, catalog, ad_ctrs, top_n, scoring_engine, tenant_id, seed)
+    except Exception as e:
+        print(f"Database query failed during batch recommendation: {e}", file=sys.stderr)
+        return _fallback_recommendations(catalog, unique_user_ids, top_n, tenant_id)
+
+async def batch_collaborative_filtering_async(user_ids: List[int], db: AsyncSession, top_n: int = 5, tenant_id: Optional[int] = None, scoring_engine: Optional[str] = None, seed: Optional[int] = None) -> Dict[int, List[Dict[str, Any]]]:
+    """`batch_collaborative_filtering` for async handlers, split like `enhanced_collaborative_filtering_async`."""
+    unique_user_ids = list(dict.fromkeys(user_ids))
+    catalog = None
+    try:
+        catalog, ad_ctrs = await run_in_threadpool(_recommender_state)
+        tag_profiles = await _load_tag_profiles_async(unique_user_ids, db, catalog.ads, tenant_id=tenant_id)
+        return await run_in_threadpool(_rank_users, unique_user_ids, tag_profiles, catalog, ad_ctrs, top_n, scoring_engine, tenant_id, seed)
+    except Exception as e:
+        print(f"Database query failed during batch recommendation: {e}", file=sys.stderr)
+        return _fallback_recommendations(catalog, unique_user_ids, top_n, tenant_id)
+
+
+# --- Event Ingestion ---
+# "sync" writes every event before responding; "async" buffers it and flushes to Kafka in batches.
+EVENT_INGESTION_MODE = os.getenv("EVENT_INGESTION_MODE", "sync")
+# How long a request with wait_for_ack=true waits for its batch to be delivered
+EVENT_ACK_TIMEOUT = float(os.getenv("EVENT_ACK_TIMEOUT", "5"))
+KAFKA_FLUSH_TIMEOUT = float(os.getenv("KAFKA_FLUSH_TIMEOUT", "5"))
+# Upper bound on events per /log-events call
+LOG_EVENTS_MAX_BATCH = int(os.getenv("LOG_EVENTS_MAX_BATCH", "1000"))
+
+def _on_events_logged(events: List[Dict[str, Any]]) -> None:
+    """
+    Update in-memory state that depends on events as soon as events are accepted. The profile
+    updates of the whole batch go to Redis in one pipeline, grouped per user.
+    """
+    catalog = ad_catalog.current()
+    profile_updates = []
+    for event_data in events:
+        ctr_stats.record(event_data['tenant_id'], event_data['ad_id'], event_data['event_type'])
+        if event_data['event_type'] == 'click':
+            recommendation_cache.invalidate(event_data['tenant_id'], event_data['user_id'])
+        ad_info = catalog.ads.get(event_data['ad_id']) if catalog else None
+        profile_updates.append((event_data['user_id'], event_data['ad_id'], ad_info["tags"] if ad_info else (),
+                                event_data['event_type'], event_data.get('timestamp'), event_data['tenant_id']))
+    user_profiles.record_many(profile_updates)
+
+# Last sink of the fallback chain (reported as 'file'): a local segmented write-ahead spool.
+# Its background replayer sends the spooled events to Kafka once Kafka is back.
+event_spool = EventSpool()
+atexit.register(event_spool.close) # Registered before event_pipeline.stop, so it runs after it
+
+def _replay_spooled_events(events: List[Dict[str, Any]]) -> None:
+    """Send a batch of spooled events to Kafka; raises while Kafka is unavailable, so they stay spooled."""
+    if not _kafka_available():
+        raise ConnectionError("Kafka is unavailable")
+    try:
+        futures = [kafka_in_flight.track(kafka_producer.send('ad_events', event)) for event in events]
+        kafka_producer.flush(timeout=KAFKA_FLUSH_TIMEOUT)
+        for future in futures:
+            future.get(timeout=0) # Already resolved by the flush
+    except Exception as e:
+        kafka_breaker.record_failure(e)
+        raise
+    kafka_breaker.record_success()
+    metrics.EVENTS_REPLAYED.inc(len(events))
+    _on_events_logged(events)
+
+def _deliver_event_batch(events: List[Dict[str, Any]]) -> List[str]:
+    """
+    Write a batch of events through the Kafka -> Redis -> spool fallback chain with a single
+    round-trip per sink: one producer flush, one multi-value RPUSH, one spool write.
+    Returns the sink that took each event ('kafka', 'redis' or 'file'), or 'failed' for the
+    events that not even the spool could take.
+    """
+    sinks: List[Optional[str]] = [None] * len(events)
+    remaining = list(range(len(events)))
+
+    if _kafka_available():
+        futures = []
+        failed = []
+        error = None
+        for i in remaining:
+            try:
+                futures.append((i, kafka_in_flight.track(kafka_producer.send('ad_events', events[i]))))
+            except Exception as e:
+                print(f"Failed to push to Kafka: {e}. Falling back to Redis.", file=sys.stderr)
+                failed.append(i)
+                error = e
+        try:
+            kafka_producer.flush(timeout=KAFKA_FLUSH_TIMEOUT) # One flush for the whole batch
+        except Exception as e:
+            print(f"Kafka flush failed: {e}. Undelivered events fall back to Redis.", file=sys.stderr)
+        for i, future in futures:
+            try:
+                future.get(timeout=0) # Already resolved by the flush
+                sinks[i] = 'kafka'
+            except Exception as e:
+                failed.append(i)
+                error = e
+        remaining = sorted(failed)
+        # One outcome per batch: a single rejected record should not count as a broker failure
+        if len(remaining) < len(events):
+            kafka_breaker.record_success()
         else:
-            print("No ads available for recommendation even with fallback.")
-            return [] # No ads available for recommendation
+            kafka_breaker.record_failure(error)
+    if remaining:
+        metrics.EVENT_SINK_FAILURES.labels('kafka').inc(len(remaining))
 
+    if remaining and redis_client and redis_breaker.allow():
+        try:
+            redis_client.rpush('event_queue', *[json.dumps(events[i]) for i in remaining])
+            redis_breaker.record_success()
+            for i in remaining:
+                sinks[i] = 'redis'
+            remaining = []
+        except Exception as redis_e:
+            redis_breaker.record_failure(redis_e)
+            print(f"Failed to push batch to Redis: {redis_e}. Final fallback: writing to the spool.", file=sys.stderr)
+    if remaining:
+        metrics.EVENT_SINK_FAILURES.labels('redis').inc(len(remaining))
+
+    if remaining:
+        try:
+            event_spool.append([events[i] for i in remaining])
+            spooled = 'file'
+        except Exception as e:
+            print(f"Failed to spool event batch: {e}. {len(remaining)} events were not logged.", file=sys.stderr)
+            spooled = 'failed'
+        for i in remaining:
+            sinks[i] = spooled
+
+    for sink in sinks:
+        if sink != 'failed':
+            metrics.EVENTS_LOGGED.labels(sink).inc()
+    _on_events_logged([event for event, sink in zip(events, sinks) if sink in ('kafka', 'redis')])
+    return sinks
+
+event_pipeline = EventPipeline(deliver=_deliver_event_batch)
+atexit.register(event_pipeline.stop) # Drain the buffer on shutdown
 
 # --- Pydantic Models ---
 class Event(BaseModel):
@@ -215,77 +572,393 @@ class Event(BaseModel):
     tenant_id: int
     timestamp: Optional[int] = None
 
+class BatchRecommendationRequest(BaseModel):
+    user_ids: List[int]
+    tenant_id: Optional[int] = None
+    top_n: conint(ge=1, le=RECOMMEND_MAX_TOP_N) = RECOMMEND_DEFAULT_TOP_N
+    seed: Optional[int] = None # Reproducible exploration (cold-start and fill ads)
+
+# --- Startup ---
+# Set once the ad catalog and CTR counters are loaded; /ready reports 503 until then.
+recommender_warm = threading.Event()
+_warm_up_stop = threading.Event()
+
+def _load_recommender_state() -> None:
+    """
+    Load (or refresh) the ad catalog and CTR counters with a session of its own. The first load
+    waits on their threading locks while another thread holds them, so never call this on the event loop.
+    """
+    db = SessionLocal()
+    try:
+        ad_catalog.snapshot(db)
+        ctr_stats.ensure_fresh(db)
+    finally:
+        db.close()
+
+def _warm_up_recommender() -> None:
+    """Load the ad catalog and CTR counters before the first request needs them, retrying until the DB answers."""
+    started = time.perf_counter()
+    delay = CLIENT_RECONNECT_DELAY
+    while not _warm_up_stop.is_set():
+        try:
+            _load_recommender_state()
+            recommender_warm.set()
+            metrics.STARTUP_DURATION.labels("warm_up").set(time.perf_counter() - started)
+            return
+        except Exception as e:
+            print(f"Recommender warm-up failed: {e}. Retrying in {delay:.0f}s.", file=sys.stderr)
+        _warm_up_stop.wait(delay)
+        delay = min(delay * 2, CLIENT_RECONNECT_MAX_DELAY)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Everything slow happens on background threads, so the server accepts connections right away
+    started = time.perf_counter()
+    _warm_up_stop.clear()
+    kafka_connection.start()
+    redis_connection.start()
+    kafka_breaker.start()
+    redis_breaker.start()
+    event_spool.start(replay=_replay_spooled_events)
+    threading.Thread(target=_warm_up_recommender, name="recommender-warm-up", daemon=True).start()
+    metrics.STARTUP_DURATION.labels("startup").set(time.perf_counter() - started)
+    yield
+    _warm_up_stop.set()
+    event_pipeline.stop() # Drain buffered events while the clients are still open
+    event_spool.close()
+    kafka_breaker.stop()
+    redis_breaker.stop()
+    kafka_connection.stop()
+    redis_connection.stop()
+
 # --- FastAPI App ---
 app = FastAPI(
     title="Advertisement Recommendation and Event Logging API",
     description="Provides ad recommendations and records user events.",
     version="1.0.0",
     docs_url="/docs",
-    redoc_url="/redoc"
+    redoc_url="/redoc",
+    lifespan=lifespan,
 )
 
+@app.middleware("http")
+async def record_request_latency(request: Request, call_next):
+    """Observe every request in a latency histogram labelled with its route template (not the raw path)."""
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        route = request.scope.get("route")
+        metrics.REQUEST_LATENCY.labels(request.method, getattr(route, "path", "unmatched"), str(status)).observe(time.perf_counter() - started)
+
+def _is_admin(token: Optional[str]) -> bool:
+    return bool(ADMIN_TOKEN) and token is not None and hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode())
+
+def require_admin(x_admin_token: Optional[str] = Header(None)):
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Admin endpoints are disabled; set ADMIN_TOKEN to enable them.")
+    if not _is_admin(x_admin_token):
+        raise HTTPException(status_code=401, detail="Invalid or missing X-Admin-Token.")
+
+@app.middleware("http")
+async def trace_request(request: Request, call_next):
+    """
+    Opt-in per-request trace: with `X-Trace: 1` or `?trace=1`, the request's SQL statements and
+    recommendation stages are timed. The summary comes back in a `Server-Timing` header (shown by
+    browser dev tools), the full trace is written to REQUEST_TRACE_DIR under the `X-Trace-Id`.
+    """
+    requested = request.headers.get("X-Trace", request.query_params.get("trace", "")).lower() in ("1", "true", "yes")
+    if not requested or not (REQUEST_TRACE_ENABLED or _is_admin(request.headers.get("X-Admin-Token"))):
+        return await call_next(request)
+    with tracing.start(request.method, request.url.path) as trace:
+        response = await call_next(request)
+    response.headers["Server-Timing"] = trace.server_timing()
+    response.headers["X-Trace-Id"] = trace.trace_id
+    tracing.write(trace)
+    return response
+
+# A request arriving before the first catalog load and CTR reconciliation finished (in the warm-up
+# thread or in another request) has to wait on their threading locks. It does so in a worker thread,
+# never on the event loop, which would stall every request of the worker, /health included. Concurrent
+# requests share one such wait, and its error if the load fails. Later refreshes never block other
+# callers: one request refreshes, the others keep the current state.
+_initial_load_flight = SingleFlight("initial_load")
+
+async def _ensure_initial_load() -> None:
+    if ad_catalog.current() is not None and ctr_stats.loaded:
+        return
+    with tracing.span("initial_load"):
+        await _initial_load_flight.do_async("state", lambda: run_in_threadpool(_load_recommender_state))
+
 @app.get("/recommend", summary="Get ad recommendations for a user")
-def get_recommendations(user_id: int, db: Session = Depends(get_db)):
+async def get_recommendations(user_id: int, tenant_id: Optional[int] = None, seed: Optional[int] = None,
+                              top_n: int = Query(RECOMMEND_DEFAULT_TOP_N, ge=1, le=RECOMMEND_MAX_TOP_N),
+                              db: AsyncSession = Depends(get_async_db)):
     """
     Retrieve personalized ad recommendations for a given user based on enhanced collaborative filtering.
-    Data is fetched from the MySQL database.
+    With `tenant_id`, only that tenant's live ads are recommended, based on the user's events for that tenant.
+    Data is fetched from the MySQL database; results are cached per user until they click or the TTL expires.
+    Only the history query runs on the event loop (awaiting the async driver); the rest of the recommender runs in worker threads.
+    A `seed` makes the explored (cold-start and fill) ads reproducible; such requests bypass the cache,
+    as do requests for another `top_n` than the default.
     """
-    recommendations = enhanced_collaborative_filtering(user_id, db)
-    return {"user_id": user_id, "recommendations": recommendations}
+    await _ensure_initial_load()
+    if seed is not None or top_n != RECOMMEND_DEFAULT_TOP_N:
+        recommendations = await enhanced_collaborative_filtering_async(user_id, db, top_n=top_n, tenant_id=tenant_id, seed=seed)
+        return {"user_id": user_id, "tenant_id": tenant_id, "recommendations": recommendations}
+    recommendations = await recommendation_cache.get_or_compute_async(
+        tenant_id, user_id,
+        compute=lambda: enhanced_collaborative_filtering_async(user_id, db, tenant_id=tenant_id),
+        refresh=lambda: _recompute_recommendations(user_id, tenant_id),
+    )
+    return {"user_id": user_id, "tenant_id": tenant_id, "recommendations": recommendations}
+
+def _recompute_recommendations(user_id: int, tenant_id: Optional[int] = None) -> List[Dict[str, Any]]:
+    """Background refresh of a cached entry; runs outside the request, so it opens its own session."""
+    db = SessionLocal()
+    try:
+        return enhanced_collaborative_filtering(user_id, db, tenant_id=tenant_id)
+    finally:
+        db.close()
+
+@app.post("/recommend/batch", summary="Get ad recommendations for many users in one call")
+async def get_batch_recommendations(request: BatchRecommendationRequest, db: AsyncSession = Depends(get_async_db)):
+    """
+    Bulk variant of /recommend for ad servers rendering pages for many users at once.
+    Histories are fetched with one query and all users are scored together.
+    """
+    if len(request.user_ids) > RECOMMEND_BATCH_MAX_USERS:
+        raise HTTPException(status_code=413, detail=f"At most {RECOMMEND_BATCH_MAX_USERS} user_ids per batch.")
+    await _ensure_initial_load()
+    results = await batch_collaborative_filtering_async(request.user_ids, db, top_n=request.top_n, tenant_id=request.tenant_id, seed=request.seed)
+    return {
+        "tenant_id": request.tenant_id,
+        "results": [{"user_id": user_id, "recommendations": results[user_id]} for user_id in dict.fromkeys(request.user_ids)],
+    }
+
+@app.get("/reports/events", summary="Event counts per day or hour from the rollups", dependencies=[Depends(require_admin)])
+async def get_events_report(tenant_id: int, start: Optional[date] = None, end: Optional[date] = None,
+                            granularity: str = "day", ad_id: Optional[int] = None, db: AsyncSession = Depends(get_async_db)):
+    """
+    Impressions and clicks per bucket between `start` and `end` (inclusive), in the shape of
+    Laravel's /api/reports/events. Reads the `event_rollups` table maintained by the events
+    sink, so a dashboard costs one row per bucket and ad instead of a scan of the events.
+    Always scoped to one tenant; requires the X-Admin-Token header.
+    """
+    if granularity not in GRANULARITIES:
+        raise HTTPException(status_code=422, detail=f"granularity must be one of: {', '.join(GRANULARITIES)}")
+    return await db.run_sync(lambda session: events_report(session, tenant_id=tenant_id, start=start, end=end,
+                                                           granularity=granularity, ad_id=ad_id))
+
+@app.get("/reports/conversions", summary="Impressions, clicks and conversion rate from the rollups", dependencies=[Depends(require_admin)])
+async def get_conversion_report(tenant_id: int, start: Optional[date] = None, end: Optional[date] = None,
+                                ad_id: Optional[int] = None, db: AsyncSession = Depends(get_async_db)):
+    """
+    Totals of one tenant over the daily rollups; `conversion_rate` is clicks per impression in percent.
+    Requires the X-Admin-Token header.
+    """
+    return await db.run_sync(lambda session: conversion_report(session, tenant_id=tenant_id, start=start, end=end, ad_id=ad_id))
+
+@app.post("/ad-catalog/invalidate", summary="Force the in-memory ad catalog to refresh")
+def invalidate_ad_catalog(full: bool = False):
+    """
+    Invalidation hook for writers of the ads table (e.g. the Laravel ad management API).
+    The next recommendation request refreshes the catalog; `full=true` also drops deleted ads.
+    """
+    ad_catalog.invalidate(full=full)
+    return {"message": "Ad catalog invalidated", "full": full}
 
 @app.post("/log-event", summary="Log a user event (click or impression)")
-def log_event(event: Event):
+def log_event(event: Event, response: Response, wait_for_ack: bool = False):
     """
     Logs a user event to a message queue (Kafka) or a fallback storage (Redis or file).
+    In async ingestion mode the event is buffered and acknowledged with 202 right away,
+    unless `wait_for_ack` is set, in which case the call waits for its batch to be written.
     """
     if event.timestamp is None:
         event.timestamp = int(time.time())
     
     event_data = event.dict()
+
+    if EVENT_INGESTION_MODE == "async":
+        return _log_event_async(event_data, wait_for_ack, response)
     
     # Try pushing to Kafka first
-    if kafka_producer and kafka_producer.bootstrap_connected():
+    if _kafka_available():
         try:
-            future = kafka_producer.send('ad_events', event_data)
+            future = kafka_in_flight.track(kafka_producer.send('ad_events', event_data))
             future.get(timeout=5) # Block until the message is sent, short timeout
+            kafka_breaker.record_success()
             print(f"Event pushed to Kafka topic 'ad_events': {event_data}")
+            metrics.EVENTS_LOGGED.labels('kafka').inc()
+            _on_events_logged([event_data])
             return {"message": "Event logged to Kafka successfully", "event": event_data}
         except Exception as e:
+            kafka_breaker.record_failure(e)
             print(f"Failed to push to Kafka: {e}. Falling back to Redis.", file=sys.stderr)
     else:
-        print("Kafka producer not connected or not initialized. Falling back to Redis.", file=sys.stderr)
+        print("Kafka producer not connected, not initialized or its circuit is open. Falling back to Redis.", file=sys.stderr)
+    metrics.EVENT_SINK_FAILURES.labels('kafka').inc()
 
     # Fallback to Redis
-    if redis_client:
+    if redis_client and redis_breaker.allow():
         try:
             redis_client.rpush('event_queue', json.dumps(event_data))
+            redis_breaker.record_success()
             print(f"Event pushed to Redis (fallback): {event_data}")
+            metrics.EVENTS_LOGGED.labels('redis').inc()
+            _on_events_logged([event_data])
             return {"message": "Event logged to Redis (fallback) successfully", "event": event_data}
         except Exception as redis_e:
-            print(f"Failed to push to Redis as well: {redis_e}. Final fallback: writing to file.", file=sys.stderr)
-            # Final fallback: log to a file
-            with open("event_log_fallback.txt", "a") as f:
-                f.write(json.dumps(event_data) + "\n")
-            raise HTTPException(status_code=500, detail="Failed to log event to Redis; logged to file instead.")
+            redis_breaker.record_failure(redis_e)
+            print(f"Failed to push to Redis as well: {redis_e}. Final fallback: writing to the spool.", file=sys.stderr)
     
-    # If neither is available and file logging also failed (unlikely for open("a")), or if file logging isn't desired for hard failure
-    with open("event_log_fallback.txt", "a") as f:
-        f.write(json.dumps(event_data) + "\n")
-    raise HTTPException(status_code=503, detail="Event logging service is unavailable (Kafka/Redis/File fallback attempted).")
+    # Neither Kafka nor Redis took the event: spool it, delivery to Kafka is only delayed
+    metrics.EVENT_SINK_FAILURES.labels('redis').inc()
+    return _spool_event(event_data, response)
+
+def _spool_event(event_data: Dict[str, Any], response: Response) -> Dict[str, Any]:
+    """
+    Final fallback: the local spool, replayed to Kafka later. Once written the event is durable,
+    so it is accepted with 202; only a failing spool write makes the call fail.
+    """
+    try:
+        event_spool.append([event_data])
+    except Exception as e:
+        print(f"Failed to spool event: {e}", file=sys.stderr)
+        raise HTTPException(status_code=503, detail="Event logging service is unavailable (Kafka/Redis/spool fallback attempted).")
+    metrics.EVENTS_LOGGED.labels('file').inc()
+    response.status_code = 202
+    return {"message": "Event spooled locally, it is delivered to Kafka once Kafka is back", "status": "spooled", "event": event_data}
+
+@app.post("/log-events", summary="Log a batch of user events")
+def log_events(events: List[Any] = Body(...)):
+    """
+    Bulk variant of /log-event for SDKs that collect events client-side. All events are
+    validated in one pass and the valid ones are written as one batch per sink (a single
+    Kafka flush, one multi-value Redis RPUSH, one spool write). Each event gets its own
+    result so partial failures are visible to the caller. Spooled events are durable and
+    delivered to Kafka later, so they count as logged (and are also totalled as `spooled`):
+    only `invalid` and `failed` events need to be retried.
+    """
+    if len(events) > LOG_EVENTS_MAX_BATCH:
+        raise HTTPException(status_code=413, detail=f"At most {LOG_EVENTS_MAX_BATCH} events per request.")
+
+    now = int(time.time())
+    results: List[Dict[str, Any]] = []
+    valid_events: List[Dict[str, Any]] = []
+    valid_indexes: List[int] = []
+    for index, raw_event in enumerate(events):
+        if not isinstance(raw_event, dict):
+            results.append({"index": index, "status": "invalid", "error": "event: must be a JSON object"})
+            continue
+        try:
+            event = Event(**raw_event)
+        except ValidationError as e:
+            detail = "; ".join(f"{'.'.join(str(part) for part in error['loc']) or 'event'}: {error['msg']}" for error in e.errors())
+            results.append({"index": index, "status": "invalid", "error": detail})
+            continue
+        if event.timestamp is None:
+            event.timestamp = now
+        results.append({"index": index, "status": None})
+        valid_indexes.append(index)
+        valid_events.append(event.dict())
+
+    if valid_events:
+        for index, sink in zip(valid_indexes, _deliver_event_batch(valid_events)):
+            results[index]["status"] = sink
+
+    logged = sum(1 for result in results if result["status"] in ('kafka', 'redis', 'file'))
+    return {
+        "received": len(events),
+        "logged": logged,
+        "spooled": sum(1 for result in results if result["status"] == 'file'),
+        "failed": len(events) - logged,
+        "results": results,
+    }
+
+def _log_event_async(event_data: Dict[str, Any], wait_for_ack: bool, response: Response):
+    try:
+        pending = event_pipeline.submit(event_data)
+    except BufferFull as e:
+        print(f"Rejecting event, {e}.", file=sys.stderr)
+        raise HTTPException(status_code=429, detail="Event buffer is full, retry later.", headers={"Retry-After": "1"})
+
+    if not wait_for_ack:
+        response.status_code = 202
+        return {"message": "Event accepted for asynchronous delivery", "event": event_data}
+
+    sink = pending.wait(EVENT_ACK_TIMEOUT)
+    if sink is None:
+        raise HTTPException(status_code=504, detail="Event is buffered but its delivery was not acknowledged in time.")
+    if sink == 'kafka':
+        return {"message": "Event logged to Kafka successfully", "event": event_data}
+    if sink == 'redis':
+        return {"message": "Event logged to Redis (fallback) successfully", "event": event_data}
+    if sink == 'file':
+        response.status_code = 202 # Written to the spool by the pipeline
+        return {"message": "Event spooled locally, it is delivered to Kafka once Kafka is back", "status": "spooled", "event": event_data}
+    # 'failed': the batch delivery raised (e.g. the spool write), the event is lost
+    raise HTTPException(status_code=503, detail="Event logging service is unavailable (Kafka/Redis/spool fallback attempted).")
+
+@app.get("/ingestion/stats", summary="Event ingestion buffer statistics")
+def ingestion_stats():
+    """Queue depth, batch sizes and flush latency of the asynchronous ingestion pipeline, and the spool backlog."""
+    return {"mode": EVENT_INGESTION_MODE, **event_pipeline.stats(), "spool": event_spool.stats()}
+
+@app.get("/admin/profile", summary="Sample the stacks of all threads", dependencies=[Depends(require_admin)],
+         response_class=PlainTextResponse)
+def admin_profile(seconds: float = 10.0, interval: float = 0.01, idle: bool = False):
+    """
+    Run the sampling profiler for `seconds` (at most PROFILER_MAX_SECONDS) and return the sampled
+    stacks in collapsed format, one `thread;outer;...;inner count` line per stack, for flamegraph.pl
+    or speedscope. Covers the whole worker process, so profile while the slow traffic is running.
+    Requires the X-Admin-Token header.
+    """
+    stacks = sampling_profiler.profile(seconds, interval=interval, idle=idle)
+    if stacks is None:
+        raise HTTPException(status_code=409, detail="A profile is already running.")
+    return PlainTextResponse(render_collapsed(stacks))
+
+@app.get("/metrics", summary="Prometheus metrics", include_in_schema=False)
+def prometheus_metrics():
+    payload, content_type = metrics.render()
+    return Response(content=payload, media_type=content_type)
 
 @app.get("/health")
 def health_check():
-    kafka_status = "connected"
-    if not kafka_producer or not kafka_producer.bootstrap_connected():
-        kafka_status = "disconnected"
-        
-    redis_status = "connected"
-    if not redis_client:
-        redis_status = "disconnected"
-    else:
-        try:
-            redis_client.ping()
-        except Exception:
-            redis_status = "disconnected"
-            
-    return {"status": "ok", "kafka_status": kafka_status, "redis_status": redis_status}
+    """
+    Liveness and sink status from in-memory state only: no broker round-trip, so the probe stays
+    fast during an outage. A sink is disconnected while it has no client or its circuit is open;
+    the clients' own health checks and the circuit probes run in the background.
+    """
+    kafka_status = "connected" if kafka_producer and kafka_breaker.state != OPEN else "disconnected"
+    redis_status = "connected" if redis_client and redis_breaker.state != OPEN else "disconnected"
+    return {
+        "status": "ok",
+        "kafka_status": kafka_status,
+        "redis_status": redis_status,
+        "circuit_breakers": {"kafka": kafka_breaker.status(), "redis": redis_breaker.status()},
+    }
+
+@app.get("/ready", summary="Readiness probe")
+def readiness_check(response: Response):
+    """
+    503 until the recommender state is loaded, 200 afterwards. Unlike /health, which only says
+    the process is up, this tells a load balancer whether to route traffic here. Kafka and Redis
+    are reported but not required: events fall back to the next sink while they reconnect.
+    """
+    ready = recommender_warm.is_set()
+    if not ready:
+        response.status_code = 503
+    return {
+        "status": "ready" if ready else "starting",
+        "recommender": "warm" if ready else "loading",
+        "kafka": kafka_connection.status(),
+        "redis": redis_connection.status(),
+    }
+
+metrics.STARTUP_DURATION.labels("import").set(time.perf_counter() - _import_started)
@@ -0,0 +1,32 @@
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool, StaticPool
+
+from app.models.models import Base
+
+
+@pytest.fixture
+def db_session(tmp_path_factory):
+    """
+    SQLite database with the FastAPI models' tables, shared across threads so it can
+    also back requests served by the TestClient. It lives in a file so the async
+    engine of `async_session_factory` sees the same data.
+    """
+    engine = create_engine(f"sqlite:///{tmp_path_factory.mktemp('db') / 'test.db'}", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    Base.metadata.create_all(bind=engine)
+    session = sessionmaker(autocommit=False, autoflush=False, bind=engine)()
+    yield session
+    session.close()
+    engine.dispose()
+
+
+@pytest.fixture
+def async_session_factory(db_session):
+    """Async (aiosqlite) sessions on the database of `db_session`, for `async def` handlers."""
+    url = db_session.get_bind().url.set(drivername="sqlite+aiosqlite")
+    # NullPool: the TestClient runs the app on its own event loop, so connections must not outlive a request
+    engine = create_async_engine(url, poolclass=NullPool)
+    yield async_sessionmaker(engine, autoflush=False, expire_on_commit=False)
+    engine.sync_engine.dispose()
@@ -0,0 +1,130 @@
+from datetime import datetime, timedelta
+
+from app.models.models import AdModel
+from app.services.ad_catalog import AdCatalog, SharedAdCatalog
+
+
+def _ad(ad_id, interests, updated_at, tenant_id=1, **kwargs):
+    return AdModel(id=ad_id, tenant_id=tenant_id, name=f"Ad {ad_id}", content="",
+                   target_audience={"interests": interests}, updated_at=updated_at, **kwargs)
+
+
+def test_catalog_preloads_tags_and_windows(db_session):
+    start = datetime(2025, 1, 1)
+    db_session.add_all([
+        _ad(1, ["tech", "sale"], start, start_time=start, end_time=start + timedelta(days=1)),
+        AdModel(id=2, tenant_id=2, name="No audience", content="", updated_at=start),
+    ])
+    db_session.commit()
+
+    snapshot = AdCatalog().snapshot(db_session)
+    assert snapshot.ads[1] == {"id": 1, "name": "Ad 1", "tags": ("tech", "sale")}
+    assert snapshot.ads[2]["tags"] == ()
+    assert snapshot.tenants == {1: 1, 2: 2}
+    assert snapshot.windows[1] == (start.timestamp(), (start + timedelta(days=1)).timestamp())
+    assert snapshot.windows[2] == (float("-inf"), float("inf"))
+
+
+def test_catalog_is_served_from_memory_within_staleness_bound(db_session):
+    db_session.add(_ad(1, ["tech"], datetime(2025, 1, 1)))
+    db_session.commit()
+    catalog = AdCatalog(max_staleness=3600)
+    first = catalog.snapshot(db_session)
+
+    db_session.add(_ad(2, ["travel"], datetime(2025, 1, 2)))
+    db_session.commit()
+    assert catalog.snapshot(db_session) is first
+
+    catalog.invalidate()
+    refreshed = catalog.snapshot(db_session)
+    assert set(refreshed.ads) == {1, 2}
+    assert refreshed.version == first.version + 1
+    assert set(first.ads) == {1} # Published snapshots are never modified in place
+
+
+def test_incremental_refresh_picks_up_updates_but_full_reload_drops_deleted_ads(db_session):
+    db_session.add_all([_ad(1, ["tech"], datetime(2025, 1, 1)), _ad(2, ["travel"], datetime(2025, 1, 1))])
+    db_session.commit()
+    catalog = AdCatalog(max_staleness=0)
+    version = catalog.snapshot(db_session).version
+
+    # Nothing changed: the rows re-read at the watermark must not produce a new version
+    assert catalog.snapshot(db_session).version == version
+
+    ad = db_session.get(AdModel, 1)
+    ad.target_audience = {"interests": ["fashion"]}
+    ad.updated_at = datetime(2025, 1, 2)
+    db_session.delete(db_session.get(AdModel, 2))
+    db_session.commit()
+
+    snapshot = catalog.snapshot(db_session)
+    assert snapshot.ads[1]["tags"] == ("fashion",)
+    assert 2 in snapshot.ads
+
+    catalog.invalidate(full=True)
+    assert set(catalog.snapshot(db_session).ads) == {1}
+
+
+def test_failed_refresh_keeps_serving_previous_snapshot(db_session):
+    db_session.add(_ad(1, ["tech"], datetime(2025, 1, 1)))
+    db_session.commit()
+    catalog = AdCatalog(max_staleness=0)
+    snapshot = catalog.snapshot(db_session)
+
+    class BrokenSession:
+        def query(self, *args):
+            raise RuntimeError("MySQL is down")
+
+    assert catalog.snapshot(BrokenSession()) is snapshot
+
+
+class _BrokenSession:
+    def query(self, *args):
+        raise RuntimeError("MySQL is down")
+
+
+def test_shared_catalog_is_loaded_once_and_mapped_by_other_workers(db_session, tmp_path):
+    start = datetime(2025, 1, 1)
+    db_session.add_all([
+        _ad(2, ["tech", "sale"], start, start_time=start, end_time=start + timedelta(days=1)),
+        AdModel(id=1, tenant_id=None, name=None, content="", updated_at=start),
+    ])
+    db_session.commit()
+    directory = str(tmp_path / "catalog")
+    leader = SharedAdCatalog(directory, max_staleness=3600).snapshot(db_session)
+
+    # A second worker maps the published columns without querying MySQL
+    worker = SharedAdCatalog(directory, max_staleness=3600)
+    shared = worker.snapshot(_BrokenSession())
+    assert dict(shared.ads) == dict(leader.ads) == {
+        2: {"id": 2, "name": "Ad 2", "tags": ("tech", "sale")}, 1: {"id": 1, "name": None, "tags": ()}}
+    assert list(shared.ads) == list(leader.ads) # Catalog order is kept
+    assert dict(shared.tenants) == {2: 1, 1: None}
+    assert shared.windows[2] == (start.timestamp(), (start + timedelta(days=1)).timestamp())
+    assert 3 not in shared.ads
+    assert shared.index.live_rows(now=start.timestamp()).tolist() == [0, 1]
+
+    # A refresh published by one worker is picked up by the others
+    db_session.add(_ad(3, ["travel"], start + timedelta(days=1)))
+    db_session.commit()
+    refresher = SharedAdCatalog(directory, max_staleness=3600)
+    refresher.invalidate()
+    assert set(refresher.snapshot(db_session).ads) == {1, 2, 3}
+    worker._checked_at = float("-inf")
+    assert set(worker.snapshot(_BrokenSession()).ads) == {1, 2, 3}
+
+
+def test_shared_catalog_keeps_serving_while_another_worker_refreshes(db_session, tmp_path):
+    db_session.add(_ad(1, ["tech"], datetime(2025, 1, 1)))
+    db_session.commit()
+    directory = str(tmp_path / "catalog")
+    catalog = SharedAdCatalog(directory, max_staleness=0)
+    first = catalog.snapshot(db_session)
+
+    with catalog._state.refresh_lock() as held: # Held as if by another worker
+        assert held
+        assert catalog.snapshot(_BrokenSession()) is first
+        # Before anything is published, a worker that loses the race loads a private snapshot
+        private = SharedAdCatalog(str(tmp_path / "other"))
+        with private._state.refresh_lock():
+            assert set(private.snapshot(db_session).ads) == {1}
@@ -0,0 +1,53 @@
+from collections import Counter
+
+import numpy as np
+
+from app.services.ad_catalog import CatalogSnapshot
+from app.services.bandit import ThompsonSampler, new_rng
+from app.services.ctr_stats import CtrStats
+
+
+def _setup(num_ads=50):
+    ads = {ad_id: {"id": ad_id, "name": f"Ad {ad_id}", "tags": ()} for ad_id in range(1, num_ads + 1)}
+    snapshot = CatalogSnapshot(ads, {ad_id: 1 for ad_id in ads}, {}, version=1)
+    stats = CtrStats(version_interval=0)
+    for ad_id in ads:
+        stats.record(1, ad_id, "impression", 1000)
+        stats.record(1, ad_id, "click", 300 if ad_id == 7 else 10) # Ad 7 is the clear winner
+    return snapshot, stats
+
+
+def test_same_seed_reproduces_the_selection_and_exclusions_are_respected():
+    snapshot, stats = _setup()
+    sampler = ThompsonSampler()
+    rows = snapshot.index.live_rows(1)
+    first = sampler.sample(snapshot, stats, rows, 5, exclude=[7, 8], rng=new_rng(42))
+    assert first == sampler.sample(snapshot, stats, rows, 5, exclude=[7, 8], rng=new_rng(42))
+    assert len(first) == len(set(first)) == 5 and not {7, 8} & set(first)
+    assert len(sampler.sample(snapshot, stats, rows, 500, rng=new_rng(1))) == 50
+    assert sampler.sample(snapshot, stats, rows[:0], 5, rng=new_rng(1)) == []
+
+
+def test_sampling_favours_high_ctr_ads_and_still_explores_unseen_ones():
+    snapshot, stats = _setup()
+    ads = dict(snapshot.ads)
+    ads[100] = {"id": 100, "name": "New", "tags": ()}
+    snapshot = CatalogSnapshot(ads, {ad_id: 1 for ad_id in ads}, {}, version=2) # Ad 100 has no events yet
+    sampler = ThompsonSampler()
+    rng = new_rng(0)
+    firsts = Counter(sampler.sample(snapshot, stats, snapshot.index.live_rows(1), 1, rng=rng)[0] for _ in range(500))
+    assert firsts[7] > 450
+    assert firsts[100] > 0 # Its wide prior sometimes draws above ad 7
+
+
+def test_posteriors_follow_the_counters():
+    snapshot, stats = _setup(3)
+    sampler = ThompsonSampler(prior_strength=10)
+    alpha, beta = sampler.posteriors(snapshot, stats)
+    assert sampler.posteriors(snapshot, stats)[0] is alpha # Cached until the counters change
+    stats.record(1, 2, "impression", 100)
+    stats.record(1, 2, "click", 100) # 100 more impressions, all clicked
+    new_alpha, new_beta = sampler.posteriors(snapshot, stats)
+    assert new_alpha is not alpha
+    # Ads 1 and 2 had the same counts; the prior (shifted by the new catalog-wide CTR) is shared
+    assert np.isclose(new_alpha[1] - new_alpha[0], 100) and np.isclose(new_beta[1], new_beta[0])
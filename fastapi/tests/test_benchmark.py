@@ -0,0 +1,35 @@
+import benchmark
+import main
+from app.services.ad_catalog import AdCatalog
+from app.services.ctr_stats import CtrStats
+
+
+def test_generated_dataset_is_reproducible(tmp_path):
+    counts = []
+    for name in ("a.db", "b.db"):
+        db_url = f"sqlite:///{tmp_path / name}"
+        benchmark.generate(db_url, ads=50, events=2000, users=100, tenants=3, days=7, seed=1)
+        engine = benchmark._engine(db_url)
+        with engine.connect() as connection:
+            counts.append(connection.exec_driver_sql(
+                "SELECT COUNT(*), SUM(ad_id), SUM(user_id), SUM(event_type = 'click') FROM events").fetchone())
+        engine.dispose()
+    assert counts[0] == counts[1]
+    assert counts[0][0] == 2000
+
+
+def test_ecf_benchmark_reports_percentiles(tmp_path, monkeypatch):
+    monkeypatch.setattr("main.USER_PROFILE_SOURCE", "history")
+    monkeypatch.setattr("main.ad_catalog", AdCatalog())
+    monkeypatch.setattr("main.ctr_stats", CtrStats())
+    db_url = f"sqlite:///{tmp_path / 'bench.db'}"
+    benchmark.generate(db_url, ads=50, events=2000, users=100, tenants=3, days=7, seed=1)
+    results = benchmark.bench_ecf(db_url, requests=20, warmup=2, top_n=5, engine_name="numpy",
+                                  profile_source=None, tenant_id=None, seed=1)
+    assert results["count"] == 20 and results["errors"] == 0
+    assert results["p50_ms"] <= results["p95_ms"] <= results["p99_ms"] <= results["max_ms"]
+
+
+def test_summarize_handles_empty_runs():
+    assert benchmark.summarize([], errors=3) == {"count": 0, "errors": 3}
+    assert benchmark.summarize([0.001, 0.002, 0.003], elapsed=1.0)["p50_ms"] == 2.0
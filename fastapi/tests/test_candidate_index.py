@@ -0,0 +1,43 @@
+from app.services.candidate_index import CandidateIndex
+
+INF = float("inf")
+
+
+def _index():
+    ads = {
+        10: {"id": 10, "tags": ("tech", "sale")},
+        20: {"id": 20, "tags": ("tech",)},
+        30: {"id": 30, "tags": ("food",)},
+        40: {"id": 40, "tags": ("sale",)},
+    }
+    tenants = {10: 1, 20: 2, 30: 1, 40: 1}
+    windows = {10: (-INF, INF), 20: (100.0, 200.0), 30: (-INF, 150.0), 40: (150.0, INF)}
+    return CandidateIndex(ads, tenants, windows)
+
+
+def _ids(index, rows):
+    return index.ad_ids[rows].tolist()
+
+
+def test_live_ads_follow_the_schedule():
+    index = _index()
+    assert _ids(index, index.live_rows(None, now=50.0)) == [10, 30]
+    assert _ids(index, index.live_rows(None, now=120.0)) == [10, 20, 30]
+    assert _ids(index, index.live_rows(None, now=150.0)) == [10, 20, 40] # Windows are [start, end)
+    assert _ids(index, index.live_rows(None, now=200.0)) == [10, 40]
+    assert _ids(index, index.live_rows(3, now=200.0)) == []
+
+
+def test_candidates_share_a_tag_and_belong_to_the_tenant():
+    index = _index()
+    assert _ids(index, index.candidate_rows(None, ["tech"], now=120.0)) == [10, 20]
+    assert _ids(index, index.candidate_rows(1, ["tech"], now=120.0)) == [10]
+    assert _ids(index, index.candidate_rows(1, ["sale", "food", "tech"], now=160.0)) == [10, 40]
+    assert _ids(index, index.candidate_rows(1, ["travel"], now=160.0)) == []
+
+
+def test_live_set_is_reused_until_the_next_schedule_boundary():
+    index = _index()
+    first = index._live_set(110.0)
+    assert index._live_set(149.9) is first
+    assert index._live_set(150.0) is not first
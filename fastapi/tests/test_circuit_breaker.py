@@ -0,0 +1,50 @@
+import threading
+import time
+
+from app.services.circuit_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker
+
+
+def test_circuit_opens_after_consecutive_failures_and_closes_after_a_successful_trial():
+    breaker = CircuitBreaker("test", failure_threshold=3, reset_timeout=0.05)
+    breaker.record_failure("boom")
+    breaker.record_success() # Resets the count: failures must be consecutive
+    for _ in range(3):
+        assert breaker.allow()
+        breaker.record_failure("boom")
+    assert breaker.state == OPEN and not breaker.allow()
+
+    time.sleep(0.06)
+    assert breaker.allow() and breaker.state == HALF_OPEN
+    assert not breaker.allow() # A single trial call at a time
+    breaker.record_failure("still down")
+    assert breaker.state == OPEN and breaker.status()["last_error"] == "still down"
+
+    time.sleep(0.06)
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == CLOSED and breaker.status()["opened_count"] == 2
+
+
+def test_background_probe_half_opens_the_circuit_once_the_sink_recovers():
+    healthy = threading.Event()
+
+    def probe():
+        if not healthy.is_set():
+            raise ConnectionError("refused")
+        return True
+
+    breaker = CircuitBreaker("test", probe=probe, failure_threshold=1, reset_timeout=0.01, probe_interval=0.01)
+    breaker.start()
+    try:
+        breaker.record_failure("refused")
+        time.sleep(0.1)
+        assert breaker.state == OPEN and not breaker.allow() # The failing probe keeps it open
+        healthy.set()
+        deadline = time.monotonic() + 5
+        while breaker.state != HALF_OPEN and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert breaker.allow()
+        breaker.record_success()
+        assert breaker.state == CLOSED
+    finally:
+        breaker.stop()
@@ -0,0 +1,54 @@
+import threading
+import time
+
+from app.services.clients import ManagedClient
+
+
+def _wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def test_client_connects_in_background_and_retries_until_it_succeeds():
+    attempts = []
+    published = []
+
+    def connect():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise ConnectionError("broker down")
+        return "client"
+
+    connection = ManagedClient("test", connect, check=lambda client: True, on_change=published.append,
+                               reconnect_delay=0.01, health_check_interval=0.01)
+    connection.start() # Returns at once even though the broker is down
+    assert _wait_for(lambda: connection.connected)
+    assert connection.client == "client" and published == ["client"]
+    assert connection.status()["attempts"] == 3 and connection.status()["last_error"] is None
+
+    connection.stop()
+    assert published == ["client", None]
+    assert connection.status()["status"] == "disconnected"
+
+
+def test_failed_health_check_marks_client_disconnected_until_it_recovers():
+    healthy = threading.Event()
+    closed = []
+
+    def check(client):
+        if not healthy.is_set():
+            raise ConnectionError("ping failed")
+        return True
+
+    connection = ManagedClient("test", lambda: "client", check=check, close=closed.append, health_check_interval=0.01)
+    connection.start()
+    assert _wait_for(lambda: connection.client == "client" and not connection.connected)
+    assert connection.status()["last_error"] == "ping failed"
+    healthy.set()
+    assert _wait_for(lambda: connection.connected)
+    connection.stop()
+    assert closed == ["client"]
@@ -0,0 +1,88 @@
+from datetime import datetime
+
+from app.models.models import EventModel
+from app.services.ctr_stats import CtrStats
+
+
+def _events(tenant_id, ad_id, impressions, clicks):
+    rows = [EventModel(tenant_id=tenant_id, ad_id=ad_id, user_id=1, event_type="impression", occurred_at=datetime.now())
+            for _ in range(impressions)]
+    rows += [EventModel(tenant_id=tenant_id, ad_id=ad_id, user_id=1, event_type="click", occurred_at=datetime.now())
+             for _ in range(clicks)]
+    return rows
+
+
+def test_reconcile_aggregates_events_table(db_session):
+    db_session.add_all(_events(1, 10, 4, 1) + _events(1, 11, 0, 2) + _events(2, 20, 5, 5))
+    db_session.commit()
+
+    stats = CtrStats()
+    ctrs = stats.ctrs(db_session)
+    assert dict(ctrs) == {10: 0.25, 20: 1.0} # Ads without impressions have no CTR entry
+    assert stats.counts(11) == (0, 2)
+    assert stats.tenant_ctr(1) == 0.75
+    assert stats.tenant_ctr(3) == 0.0
+
+
+def test_record_updates_counters_incrementally():
+    stats = CtrStats(version_interval=0)
+    stats.record(1, 10, "impression", count=3)
+    stats.record(1, 10, "click")
+    stats.record(1, 10, "conversion") # Not part of CTR
+    assert stats.ctr(10) == 1 / 3
+    assert stats.counts(10) == (3, 1)
+    assert stats.version == 1 # One bump for everything recorded since the last read
+    assert stats.version == 1
+
+
+def test_recorded_events_bump_the_version_at_most_once_per_interval(db_session):
+    stats = CtrStats(version_interval=3600)
+    stats.record(1, 10, "impression")
+    version = stats.version
+    stats.record(1, 10, "click")
+    assert stats.version == version and stats.ctr(10) == 1.0 # Counters are live, derived caches may lag
+    stats.reconcile(db_session)
+    assert stats.version == version + 1 # Reconciliations show right away
+
+
+def test_reconcile_runs_only_after_interval(db_session):
+    db_session.add_all(_events(1, 10, 2, 1))
+    db_session.commit()
+    stats = CtrStats(reconcile_interval=3600)
+    assert stats.ctrs(db_session)[10] == 0.5
+
+    db_session.add_all(_events(1, 10, 2, 0))
+    db_session.commit()
+    assert stats.ctrs(db_session)[10] == 0.5 # Still within the interval
+
+    stats.reconcile_interval = 0
+    assert stats.ctrs(db_session)[10] == 0.25
+
+
+def test_failed_reconcile_keeps_incremental_counters():
+    stats = CtrStats()
+    stats.record(1, 10, "impression")
+
+    class BrokenSession:
+        def query(self, *args):
+            raise RuntimeError("MySQL is down")
+
+    assert stats.ctrs(BrokenSession())[10] == 0.0
+    assert stats.counts(10) == (1, 0)
+
+
+def test_shared_reconciliation_is_loaded_by_other_workers(db_session, tmp_path):
+    db_session.add_all(_events(1, 10, 4, 1) + _events(2, 20, 2, 2))
+    db_session.commit()
+    directory = str(tmp_path / "ctr")
+    leader = CtrStats(shared_dir=directory)
+    leader.reconcile(db_session)
+
+    class BrokenSession:
+        def query(self, *args):
+            raise RuntimeError("MySQL is down")
+
+    worker = CtrStats(shared_dir=directory)
+    assert dict(worker.ctrs(BrokenSession())) == {10: 0.25, 20: 1.0}
+    assert worker.counts(20) == (2, 2)
+    assert worker.tenant_ctr(1) == 0.25
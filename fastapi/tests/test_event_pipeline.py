@@ -0,0 +1,63 @@
+import threading
+import time
+
+import pytest
+
+from app.services.event_pipeline import BufferFull, EventPipeline
+
+
+def test_events_are_flushed_in_batches():
+    batches = []
+    pipeline = EventPipeline(deliver=lambda events: batches.append(list(events)) or ["kafka"] * len(events),
+                             batch_size=3, linger_ms=200)
+    pending = [pipeline.submit({"n": n}) for n in range(7)]
+    assert [p.wait(timeout=2) for p in pending] == ["kafka"] * 7
+    pipeline.stop()
+
+    assert [event["n"] for batch in batches for event in batch] == list(range(7))
+    assert max(len(batch) for batch in batches) == 3
+    stats = pipeline.stats()
+    assert stats["events_flushed"] == 7
+    assert stats["batches_flushed"] == len(batches)
+    assert stats["queue_depth"] == 0
+
+
+def test_linger_bounds_latency_of_small_batches():
+    pipeline = EventPipeline(deliver=lambda events: ["redis"] * len(events), batch_size=1000, linger_ms=20)
+    started = time.monotonic()
+    assert pipeline.submit({"n": 1}).wait(timeout=2) == "redis"
+    assert time.monotonic() - started < 1
+    pipeline.stop()
+
+
+def test_full_buffer_applies_backpressure():
+    release = threading.Event()
+
+    def slow_deliver(events):
+        release.wait(5)
+        return ["kafka"] * len(events)
+
+    pipeline = EventPipeline(deliver=slow_deliver, buffer_size=2, batch_size=1, linger_ms=0, enqueue_timeout=0.01)
+    first = pipeline.submit({"n": 0})
+    deadline = time.monotonic() + 2
+    while pipeline.queue_depth() and time.monotonic() < deadline:
+        time.sleep(0.01) # Wait for the flusher to pick up the first event and block on it
+    pipeline.submit({"n": 1})
+    pipeline.submit({"n": 2})
+    with pytest.raises(BufferFull):
+        pipeline.submit({"n": 3})
+    assert pipeline.stats()["events_rejected"] == 1
+
+    release.set()
+    assert first.wait(timeout=2) == "kafka"
+    pipeline.stop()
+    assert pipeline.stats()["events_flushed"] == 3
+
+
+def test_failed_delivery_resolves_pending_events():
+    def broken_deliver(events):
+        raise RuntimeError("boom")
+
+    pipeline = EventPipeline(deliver=broken_deliver, linger_ms=0)
+    assert pipeline.submit({"n": 1}).wait(timeout=2) == "failed"
+    pipeline.stop()
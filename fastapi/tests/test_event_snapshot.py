@@ -0,0 +1,64 @@
+import os
+from datetime import datetime
+
+import numpy as np
+
+from app.models.models import EventModel
+from app.services.ctr_stats import CtrStats
+from app.services.event_snapshot import EventSnapshot, export_events
+
+
+def _add_events(db_session, events):
+    db_session.add_all(EventModel(tenant_id=tenant_id, ad_id=ad_id, user_id=user_id, event_type=event_type,
+                                  occurred_at=datetime(2024, 1, 1, 12, 0, 0))
+                       for tenant_id, ad_id, user_id, event_type in events)
+    db_session.commit()
+
+
+def test_export_appends_incrementally_by_last_id(db_session, tmp_path):
+    _add_events(db_session, [(1, 10, 1, "impression"), (1, 10, None, "click"), (2, 20, 3, "impression")])
+    engine = db_session.get_bind()
+    directory = str(tmp_path / "events")
+
+    assert export_events(engine, directory, chunk_size=2) == 3
+    assert export_events(engine, directory) == 0 # Nothing new
+    _add_events(db_session, [(1, 11, 4, "conversion")])
+    assert export_events(engine, directory) == 1
+
+    snapshot = EventSnapshot.load(directory)
+    assert snapshot.rows == 4 and snapshot.last_id == 4
+    assert isinstance(snapshot["ad_id"], np.memmap)
+    assert snapshot["ad_id"].tolist() == [10, 10, 20, 11]
+    assert snapshot["user_id"].tolist() == [1, -1, 3, 4]
+    assert [snapshot.event_types[code] for code in snapshot["event_type"]] == ["impression", "click", "impression", "conversion"]
+    assert snapshot["occurred_at"][0] == int(datetime(2024, 1, 1, 12, 0, 0).timestamp())
+    assert snapshot.count_by("ad_id", "impression") == {10: 1, 20: 1}
+
+
+def test_export_drops_rows_of_an_interrupted_append(db_session, tmp_path):
+    _add_events(db_session, [(1, 10, 1, "impression")])
+    directory = str(tmp_path / "events")
+    export_events(db_session.get_bind(), directory)
+    with open(os.path.join(directory, "ad_id"), "ab") as f:
+        f.write(b"\x00" * 6) # Partial write, no manifest update
+
+    _add_events(db_session, [(1, 12, 1, "click")])
+    export_events(db_session.get_bind(), directory)
+    assert EventSnapshot.load(directory)["ad_id"].tolist() == [10, 12]
+
+
+def test_ctr_stats_reconcile_from_snapshot_and_newer_events(db_session, tmp_path):
+    _add_events(db_session, [(1, 10, 1, "impression")] * 4 + [(1, 10, 1, "click")])
+    directory = str(tmp_path / "events")
+    export_events(db_session.get_bind(), directory)
+    _add_events(db_session, [(1, 10, 2, "impression")] * 4 + [(2, 20, 2, "impression"), (1, 10, 2, "click")])
+
+    stats = CtrStats(snapshot_dir=directory)
+    assert dict(stats.ctrs(db_session)) == {10: 0.25, 20: 0.0}
+    assert stats.tenant_ctr(1) == 0.25
+    assert stats.counts(10) == (8, 2)
+
+    export_events(db_session.get_bind(), directory) # Catching up moves rows from MySQL to the snapshot
+    stats.reconcile(db_session)
+    assert stats.counts(10) == (8, 2)
+    assert stats.counts(20) == (1, 0)
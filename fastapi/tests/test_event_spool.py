@@ -0,0 +1,69 @@
+import json
+import os
+import threading
+
+import pytest
+
+from app.services.event_spool import EventSpool
+
+
+def _events(start, count):
+    return [{"user_id": n, "ad_id": 1, "event_type": "impression", "tenant_id": 1} for n in range(start, start + count)]
+
+
+def test_concurrent_appends_are_group_committed_without_losing_or_tearing_events(tmp_path, monkeypatch):
+    spool = EventSpool(str(tmp_path), fsync_interval=0)
+    fsyncs = []
+    real_fsync = os.fsync
+    monkeypatch.setattr(os, "fsync", lambda fd: (fsyncs.append(fd), real_fsync(fd)))
+
+    threads = [threading.Thread(target=lambda t=t: [spool.append(_events(t * 1000 + i * 10, 10)) for i in range(20)])
+               for t in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    user_ids = sorted(event["user_id"] for event in spool.events())
+    assert user_ids == sorted(t * 1000 + n for t in range(8) for n in range(200))
+    assert len(fsyncs) <= 8 * 20 # Waiting appends share the leader's write and fsync
+
+
+def test_segments_rotate_by_size_and_replay_resumes_from_the_checkpoint(tmp_path):
+    spool = EventSpool(str(tmp_path), segment_bytes=500, replay_batch=4)
+    for start in range(0, 30, 5):
+        spool.append(_events(start, 5))
+    assert len(spool.segments()) > 1
+
+    sent = []
+    def flaky_send(batch):
+        if len(sent) == 2:
+            raise ConnectionError("broker down")
+        sent.append([event["user_id"] for event in batch])
+
+    with pytest.raises(ConnectionError):
+        spool.replay(flaky_send)
+    assert [n for batch in sent for n in batch] == list(range(8))
+    assert [event["user_id"] for event in spool.events()] == list(range(8, 30)) # Nothing lost, nothing resent
+
+    sent.clear()
+    assert spool.replay(lambda batch: sent.extend(event["user_id"] for event in batch)) == 22
+    assert sent == list(range(8, 30))
+    assert spool.segments() == [] and spool.stats() == {"segments": 0, "bytes": 0}
+
+
+def test_replay_skips_segments_another_process_is_writing_and_torn_tails(tmp_path):
+    writer = EventSpool(str(tmp_path))
+    writer.append(_events(0, 2)) # Active, flock held by the "other process"
+    orphan = tmp_path / "segment-00000000000000000001-99999.log"
+    orphan.write_bytes(b"".join(json.dumps(event).encode() + b"\n" for event in _events(10, 2)) + b'{"user_id": 1')
+
+    sent = []
+    replayer = EventSpool(str(tmp_path))
+    assert replayer.replay(sent.extend) == 2
+    assert [event["user_id"] for event in sent] == [10, 11]
+    assert [os.path.basename(path) for path in replayer.segments()] == [os.path.basename(writer.segments()[0])]
+
+    writer.close() # Sealed: now replayable
+    assert replayer.replay(sent.extend) == 2
+    assert replayer.segments() == []
@@ -0,0 +1,123 @@
+import json
+from collections import namedtuple
+
+import pytest
+from sqlalchemy.orm import sessionmaker
+
+from app.models.models import EventModel, EventRollupModel
+from app.services.event_spool import EventSpool
+from events_sink import EventsSink
+
+Record = namedtuple("Record", "offset value")
+
+
+class FakeConsumer:
+    def __init__(self, records):
+        self.pending = list(records)
+        self.committed = 0
+        self.seeks = []
+
+    def poll(self, timeout_ms=0, max_records=None):
+        batch, self.pending = self.pending[:max_records], self.pending[max_records:]
+        return {"ad_events-0": batch} if batch else {}
+
+    def commit(self):
+        self.committed += 1
+
+    def seek(self, partition, offset):
+        self.seeks.append((partition, offset))
+
+
+class FakeRedis:
+    def __init__(self, values):
+        self.values = list(values)
+
+    def lrange(self, key, start, end):
+        return self.values[start:end + 1]
+
+    def ltrim(self, key, start, end):
+        self.values = self.values[start:]
+
+
+def _event(n, event_type="impression"):
+    return json.dumps({"user_id": n, "ad_id": 10 + n % 3, "event_type": event_type, "tenant_id": 1, "timestamp": 1700000000 + n})
+
+
+@pytest.fixture
+def session_factory(db_session):
+    return sessionmaker(bind=db_session.get_bind())
+
+
+def test_kafka_records_are_inserted_before_offsets_are_committed(db_session, session_factory):
+    consumer = FakeConsumer([Record(n, _event(n).encode()) for n in range(5)] + [Record(5, b"not json")])
+    sink = EventsSink(session_factory, consumer=consumer, fallback_path=None, batch_size=4, flush_interval=0.1)
+
+    assert sink.drain_kafka() == 4
+    assert consumer.committed == 1
+    assert sink.drain_kafka() == 2 # The malformed record is skipped, not retried forever
+    assert consumer.committed == 2
+
+    rows = db_session.query(EventModel).order_by(EventModel.user_id).all()
+    assert [row.user_id for row in rows] == [0, 1, 2, 3, 4]
+    assert rows[1].ad_id == 11 and rows[1].occurred_at.timestamp() == 1700000001
+
+
+def test_failed_insert_rewinds_kafka_without_committing(session_factory):
+    consumer = FakeConsumer([Record(7, _event(1).encode())])
+
+    def broken_factory():
+        session = session_factory()
+        session.execute = lambda *args, **kwargs: (_ for _ in ()).throw(RuntimeError("MySQL is down"))
+        return session
+
+    sink = EventsSink(broken_factory, consumer=consumer, fallback_path=None, flush_interval=0.1)
+    with pytest.raises(RuntimeError):
+        sink.drain_kafka()
+    assert consumer.committed == 0
+    assert consumer.seeks == [("ad_events-0", 7)]
+
+
+def test_redis_queue_is_trimmed_only_after_insert(db_session, session_factory):
+    redis_client = FakeRedis([_event(n).encode() for n in range(5)])
+    sink = EventsSink(session_factory, redis_client=redis_client, fallback_path=None, batch_size=3)
+
+    assert sink.run_once() == 3
+    assert len(redis_client.values) == 2
+    assert sink.run_once() == 2
+    assert redis_client.values == []
+    assert db_session.query(EventModel).count() == 5
+
+
+def test_fallback_file_is_replayed_and_removed(db_session, session_factory, tmp_path):
+    fallback = tmp_path / "event_log_fallback.txt"
+    fallback.write_text("".join(_event(n, "click") + "\n" for n in range(5)))
+    # A previous replay stopped after its first batch of two events
+    (tmp_path / "event_log_fallback.txt.replaying").write_text("".join(_event(n) + "\n" for n in range(100, 104)))
+    (tmp_path / "event_log_fallback.txt.replaying.offset").write_text("2")
+    sink = EventsSink(session_factory, fallback_path=str(fallback), batch_size=2)
+
+    assert sink.replay_fallback_file() == 2 # Resumes the interrupted replay first
+    assert sink.replay_fallback_file() == 5
+    assert sink.replay_fallback_file() == 0
+    assert sorted(row.user_id for row in db_session.query(EventModel)) == [0, 1, 2, 3, 4, 102, 103]
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_spool_segments_are_inserted_and_removed(db_session, session_factory, tmp_path):
+    spool = EventSpool(str(tmp_path / "spool"), segment_bytes=1) # Every append seals its segment
+    spool.append([json.loads(_event(n)) for n in range(3)])
+    spool.append([json.loads(_event(3, "click"))])
+    sink = EventsSink(session_factory, fallback_path=None, batch_size=2, spool_dir=str(tmp_path / "spool"))
+
+    assert sink.run_once() == 4
+    assert sorted(row.user_id for row in db_session.query(EventModel)) == [0, 1, 2, 3]
+    assert spool.segments() == []
+
+
+def test_rollups_are_updated_in_the_insert_transaction(db_session, session_factory):
+    redis_client = FakeRedis([_event(n).encode() for n in range(3)] + [_event(3, "click").encode()])
+    EventsSink(session_factory, redis_client=redis_client, fallback_path=None).run_once()
+
+    day = db_session.query(EventRollupModel).filter_by(granularity="day").all()
+    assert sorted((row.ad_id, row.event_type, row.count) for row in day) == [
+        (10, "click", 1), (10, "impression", 1), (11, "impression", 1), (12, "impression", 1)]
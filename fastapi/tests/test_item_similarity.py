@@ -0,0 +1,56 @@
+import os
+from datetime import datetime
+
+import pytest
+
+from app.models.models import EventModel
+from app.services.event_snapshot import EventSnapshot, export_events
+from app.services.item_similarity import ItemSimilarity, compute_similarity, publish_similarity
+
+
+@pytest.fixture
+def snapshot(db_session, tmp_path):
+    # Users 1 and 2 saw ads 10 and 11, user 2 also clicked 12, user 3 only saw 12
+    events = [(1, 10, "impression"), (1, 11, "click"), (2, 10, "impression"), (2, 11, "impression"),
+              (2, 12, "click"), (3, 12, "impression"), (None, 10, "impression"), (1, 13, "conversion")]
+    db_session.add_all(EventModel(tenant_id=1, ad_id=ad_id, user_id=user_id, event_type=event_type,
+                                  occurred_at=datetime(2024, 1, 1)) for user_id, ad_id, event_type in events)
+    db_session.commit()
+    export_events(db_session.get_bind(), str(tmp_path / "events"))
+    return EventSnapshot.load(str(tmp_path / "events"))
+
+
+def test_cosine_similarity_keeps_top_k_neighbours(snapshot, tmp_path):
+    directory = str(tmp_path / "similarity")
+    publish_similarity(compute_similarity(snapshot), directory)
+    matrix = ItemSimilarity(directory).current()
+
+    # Anonymous and non-interaction events are ignored: ad 13 has no row
+    assert matrix.ad_ids.tolist() == [10, 11, 12]
+    assert matrix.neighbours(10) == [(11, 1.0), (12, 0.5)]
+    assert matrix.neighbours(13) == []
+    assert matrix.scores([10, 11]) == {10: 0.5, 11: 0.5, 12: 0.5}
+
+    publish_similarity(compute_similarity(snapshot, top_k=1), directory)
+    assert ItemSimilarity(directory).current().neighbours(10) == [(11, 1.0)]
+
+
+def test_reload_swaps_to_new_version_and_keeps_serving_on_errors(snapshot, tmp_path):
+    directory = str(tmp_path / "similarity")
+    similarity = ItemSimilarity(directory, reload_interval=0)
+    assert similarity.current() is None # Nothing published yet
+
+    publish_similarity(compute_similarity(snapshot, top_k=1), directory)
+    first = similarity.current()
+    assert first.neighbours(12) == [(10, 0.5)]
+
+    publish_similarity(compute_similarity(snapshot), directory)
+    second = similarity.current()
+    assert second is not first and second.neighbours(12) == [(10, 0.5), (11, 0.5)]
+    assert first.neighbours(12) == [(10, 0.5)] # In-flight readers keep the old matrix
+
+    with open(os.path.join(directory, "CURRENT"), "w") as f:
+        f.write("v-missing")
+    assert similarity.current() is second
+    publish_similarity(compute_similarity(snapshot), directory)
+    assert len([name for name in os.listdir(directory) if name.startswith("v")]) == 2
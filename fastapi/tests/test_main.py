@@ -1,12 +1,23 @@
 import pytest
 from fastapi.testclient import TestClient
-from main import app, kafka_producer, redis_client, get_db, AdModel, EventModel, engine, Base
+import main
+from main import app, get_async_db, AdModel, EventModel
+from app.services.ad_catalog import AdCatalog
+from app.services.circuit_breaker import CircuitBreaker
+from app.services.ctr_stats import CtrStats
+from app.services.event_pipeline import EventPipeline
+from app.services.event_spool import EventSpool
+from app.services.item_similarity import ItemSimilarity, publish_similarity
+from app.services.recommendation_cache import RecommendationCache
+from app.services import tracing
+from app.services.user_profiles import UserProfiles
+import asyncio
 import json
 import time
-import os
-from unittest.mock import MagicMock, patch
-from sqlalchemy.orm import sessionmaker, Session
-from sqlalchemy import create_engine as create_mock_engine
+import numpy as np
+from unittest.mock import MagicMock
+from prometheus_client import REGISTRY
+from sqlalchemy.orm import sessionmaker
 from datetime import datetime, timedelta
 
 # Use TestClient to test the FastAPI application
@@ -14,26 +25,33 @@ client = TestClient(app)
 
 # Fixture to mock database for tests
 @pytest.fixture(name="mock_db_session")
-def mock_db_session_fixture(monkeypatch):
+def mock_db_session_fixture(db_session, async_session_factory, monkeypatch):
     """
-    Mocks the database session for FastAPI tests.
+    Replaces the MySQL sessions (sync and async) with SQLite sessions for FastAPI tests.
     """
-    MockSession = sessionmaker()
-    mock_db = MockSession()
+    monkeypatch.setattr('main.SessionLocal', sessionmaker(bind=db_session.get_bind())) # Loads run outside the request's session
+    async def override_get_async_db():
+        async with async_session_factory() as db:
+            yield db
 
-    def override_get_db():
-        try:
-            yield mock_db
-        finally:
-            mock_db.close()
+    app.dependency_overrides[get_async_db] = override_get_async_db
+    yield db_session
+    app.dependency_overrides.pop(get_async_db, None)
 
-    monkeypatch.setattr("main.get_db", override_get_db)
-    yield mock_db
-    mock_db.close()
+# Fixture to start every test with empty process-wide caches
+@pytest.fixture(autouse=True)
+def fresh_caches(monkeypatch):
+    monkeypatch.setattr('main.ad_catalog', AdCatalog())
+    monkeypatch.setattr('main.ctr_stats', CtrStats())
+    monkeypatch.setattr('main.recommendation_cache', RecommendationCache(redis_client=lambda: None))
+    monkeypatch.setattr('main.user_profiles', UserProfiles(redis_client=lambda: None))
+    monkeypatch.setattr('main.item_similarity', ItemSimilarity(directory=None))
+    monkeypatch.setattr('main.kafka_breaker', CircuitBreaker("kafka", failure_threshold=2, reset_timeout=60))
+    monkeypatch.setattr('main.redis_breaker', CircuitBreaker("redis", failure_threshold=2, reset_timeout=60))
 
 # Fixture to mock Kafka and Redis clients
 @pytest.fixture(autouse=True)
-def mock_clients(monkeypatch):
+def mock_clients(monkeypatch, tmp_path):
     """
     Mock Kafka and Redis clients to prevent actual connections during tests.
     By default, they are mocked as connected.
@@ -44,22 +62,23 @@ def mock_clients(monkeypatch):
             return self # Return self to allow .get() call
         def get(self, timeout=None):
             return True # Simulate successful send
+        def flush(self, timeout=None):
+            pass
         def bootstrap_connected(self):
             return True # Simulate connected state
 
     class MockRedis:
-        def rpush(self, key, value):
-            print(f"Mock Redis: Pushed to list '{key}': {value}")
-            return 1
+        def rpush(self, key, *values):
+            print(f"Mock Redis: Pushed to list '{key}': {values}")
+            return len(values)
         def ping(self):
             return True
 
     monkeypatch.setattr('main.kafka_producer', MockKafkaProducer())
     monkeypatch.setattr('main.redis_client', MockRedis())
     
-    # Ensure any fallback log file is clean before each test
-    if os.path.exists("event_log_fallback.txt"):
-        os.remove("event_log_fallback.txt")
+    # Every test spools to its own empty directory
+    monkeypatch.setattr('main.event_spool', EventSpool(str(tmp_path / "spool"), fsync_interval=0))
 
 def test_health_check_endpoint():
     """Test the /health endpoint."""
@@ -69,6 +88,57 @@ def test_health_check_endpoint():
     assert response.json()["kafka_status"] == "connected"
     assert response.json()["redis_status"] == "connected"
 
+def test_log_event_skips_kafka_while_its_circuit_is_open(monkeypatch):
+    """After the failure threshold, events go straight to Redis without waiting on Kafka, and /health shows the open circuit."""
+    sends = []
+    def failing_send(topic, value):
+        sends.append(value)
+        raise TimeoutError("broker not answering")
+    monkeypatch.setattr(main.kafka_producer, 'send', failing_send, raising=False)
+
+    event_data = {"user_id": 108, "ad_id": 9, "event_type": "impression", "tenant_id": 1}
+    for _ in range(4):
+        response = client.post("/log-event", json=event_data)
+        assert "logged to Redis (fallback) successfully" in response.json()["message"]
+    assert len(sends) == 2 # The threshold; the next events never touched the producer
+
+    health = client.get("/health").json()
+    assert health["kafka_status"] == "disconnected" and health["redis_status"] == "connected"
+    assert health["circuit_breakers"]["kafka"]["state"] == "open"
+    assert health["circuit_breakers"]["kafka"]["last_error"] == "broker not answering"
+
+def test_readiness_waits_for_the_recommender_warm_up(mock_db_session, monkeypatch):
+    """/ready is 503 until the catalog and CTRs are loaded, while /health answers right away."""
+    monkeypatch.setattr('main.recommender_warm', main.threading.Event())
+    response = client.get("/ready")
+    assert response.status_code == 503
+    assert response.json()["recommender"] == "loading"
+    assert response.json()["kafka"]["status"] == "disconnected" # Not started outside the lifespan
+    assert client.get("/health").status_code == 200
+
+    main._warm_up_recommender()
+    assert main.ad_catalog.current() is not None and main.ctr_stats.loaded
+    response = client.get("/ready")
+    assert response.status_code == 200
+    assert response.json()["status"] == "ready"
+
+def test_first_load_waits_off_the_event_loop(mock_db_session):
+    """A request arriving while the warm-up holds the catalog lock waits in a worker thread, not on the loop."""
+    main.ad_catalog._lock.acquire() # The warm-up thread is loading the catalog
+    main.threading.Timer(0.3, main.ad_catalog._lock.release).start()
+
+    async def first_request():
+        loading = asyncio.ensure_future(main._ensure_initial_load())
+        started = time.perf_counter()
+        await asyncio.sleep(0.01) # Returns late if the load blocks the loop
+        loop_delay = time.perf_counter() - started
+        assert not loading.done()
+        await loading
+        return loop_delay
+
+    assert asyncio.run(first_request()) < 0.2
+    assert main.ad_catalog.current() is not None and main.ctr_stats.loaded
+
 def test_recommendation_endpoint_with_history(mock_db_session):
     """
     Test the /recommend endpoint for a user with history,
@@ -76,12 +146,12 @@ def test_recommendation_endpoint_with_history(mock_db_session):
     """
     # Mock data directly in the session to avoid complex factory setups for SQLAlchemy models
     mock_ads = [
-        AdModel(id=1, tenant_id=1, name="Summer Sale", content="", start_time=datetime.now(), end_time=datetime.now(), target_audience={"interests": ["fashion", "sale"]}),
-        AdModel(id=2, tenant_id=1, name="New Gadget", content="", start_time=datetime.now(), end_time=datetime.now(), target_audience={"interests": ["tech", "electronics"]}),
-        AdModel(id=3, tenant_id=1, name="Travel Package", content="", start_time=datetime.now(), end_time=datetime.now(), target_audience={"interests": ["travel", "sale"]}),
-        AdModel(id=4, tenant_id=1, name="Sports Gear", content="", start_time=datetime.now(), end_time=datetime.now(), target_audience={"interests": ["sports", "fitness"]}),
-        AdModel(id=5, tenant_id=1, name="Winter Jackets", content="", start_time=datetime.now(), end_time=datetime.now(), target_audience={"interests": ["fashion", "winter"]}),
-        AdModel(id=6, tenant_id=1, name="Outdoor Adventure", content="", start_time=datetime.now(), end_time=datetime.now(), target_audience={"interests": ["travel", "sports"]}),
+        AdModel(id=1, tenant_id=1, name="Summer Sale", content="", start_time=datetime.now() - timedelta(days=1), end_time=datetime.now() + timedelta(days=1), target_audience={"interests": ["fashion", "sale"]}),
+        AdModel(id=2, tenant_id=1, name="New Gadget", content="", start_time=datetime.now() - timedelta(days=1), end_time=datetime.now() + timedelta(days=1), target_audience={"interests": ["tech", "electronics"]}),
+        AdModel(id=3, tenant_id=1, name="Travel Package", content="", start_time=datetime.now() - timedelta(days=1), end_time=datetime.now() + timedelta(days=1), target_audience={"interests": ["travel", "sale"]}),
+        AdModel(id=4, tenant_id=1, name="Sports Gear", content="", start_time=datetime.now() - timedelta(days=1), end_time=datetime.now() + timedelta(days=1), target_audience={"interests": ["sports", "fitness"]}),
+        AdModel(id=5, tenant_id=1, name="Winter Jackets", content="", start_time=datetime.now() - timedelta(days=1), end_time=datetime.now() + timedelta(days=1), target_audience={"interests": ["fashion", "winter"]}),
+        AdModel(id=6, tenant_id=1, name="Outdoor Adventure", content="", start_time=datetime.now() - timedelta(days=1), end_time=datetime.now() + timedelta(days=1), target_audience={"interests": ["travel", "sports"]}),
     ]
     mock_events = [
         EventModel(ad_id=1, user_id=101, event_type="click", tenant_id=1, occurred_at=datetime.now() - timedelta(days=5)),
@@ -91,13 +161,8 @@ def test_recommendation_endpoint_with_history(mock_db_session):
         EventModel(ad_id=7, user_id=101, event_type="impression", tenant_id=1, occurred_at=datetime.now() - timedelta(days=3)),
     ]
     
-    # Mock the query calls to return the predefined data
-    # First call for ads, second for user events filter, then order by
-    mock_db_session.query.side_effect = [
-        MagicMock(all=MagicMock(return_value=mock_ads)), # For AdModel query
-        MagicMock(all=MagicMock(return_value=mock_events)), # For all events query (for CTR)
-        MagicMock(filter=MagicMock(return_value=MagicMock(order_by=MagicMock(all=MagicMock(return_value=mock_events))))), # For EventModel query
-    ]
+    mock_db_session.add_all(mock_ads + mock_events)
+    mock_db_session.commit()
 
     user_id = 101
     response = client.get(f"/recommend?user_id={user_id}")
@@ -121,20 +186,16 @@ def test_recommendation_endpoint_with_history(mock_db_session):
 def test_recommendation_endpoint_no_history(mock_db_session):
     """Test the /recommend endpoint for a user with no history."""
     mock_ads = [
-        AdModel(id=1, tenant_id=1, name="Summer Sale", content="", start_time=datetime.now(), end_time=datetime.now(), target_audience={"interests": ["fashion", "sale"]}),
-        AdModel(id=2, tenant_id=1, name="New Gadget", content="", start_time=datetime.now(), end_time=datetime.now(), target_audience={"interests": ["tech"]}),
+        AdModel(id=1, tenant_id=1, name="Summer Sale", content="", start_time=datetime.now() - timedelta(days=1), end_time=datetime.now() + timedelta(days=1), target_audience={"interests": ["fashion", "sale"]}),
+        AdModel(id=2, tenant_id=1, name="New Gadget", content="", start_time=datetime.now() - timedelta(days=1), end_time=datetime.now() + timedelta(days=1), target_audience={"interests": ["tech"]}),
     ]
     mock_events_for_ctr = [
         EventModel(ad_id=1, user_id=1, event_type="impression", tenant_id=1, occurred_at=datetime.now()),
         EventModel(ad_id=1, user_id=2, event_type="click", tenant_id=1, occurred_at=datetime.now()),
         EventModel(ad_id=2, user_id=3, event_type="impression", tenant_id=1, occurred_at=datetime.now()),
     ]
-    # Mock query for ads, then mock query for all events (for CTR), then mock query for user events to return empty list
-    mock_db_session.query.side_effect = [
-        MagicMock(all=MagicMock(return_value=mock_ads)),
-        MagicMock(all=MagicMock(return_value=mock_events_for_ctr)),
-        MagicMock(filter=MagicMock(return_value=MagicMock(order_by=MagicMock(all=MagicMock(return_value=[]))))),
-    ]
+    mock_db_session.add_all(mock_ads + mock_events_for_ctr)
+    mock_db_session.commit()
 
     response = client.get("/recommend?user_id=999") # User 999 has no mock history
     assert response.status_code == 200
@@ -144,6 +205,283 @@ def test_recommendation_endpoint_no_history(mock_db_session):
     # For no history, it should fall back to random sampling of existing ads.
     assert all(ad['id'] in {a.id for a in mock_ads} for ad in data['recommendations'])
 
+def test_cold_start_recommendations_are_reproducible_with_a_seed(mock_db_session):
+    now = datetime.now()
+    mock_db_session.add_all([AdModel(id=ad_id, tenant_id=1, name=f"Ad {ad_id}", content="", start_time=now - timedelta(days=1),
+                                     end_time=now + timedelta(days=1), target_audience={"interests": ["tech"]}) for ad_id in range(1, 21)])
+    mock_db_session.commit()
+
+    def recommended(seed):
+        response = client.get("/recommend", params={"user_id": 999, "seed": seed})
+        return [ad["id"] for ad in response.json()["recommendations"]]
+    assert recommended(7) == recommended(7)
+    assert len({tuple(recommended(seed)) for seed in range(5)}) > 1
+    batch = {"user_ids": [998, 999], "seed": 7}
+    assert client.post("/recommend/batch", json=batch).json() == client.post("/recommend/batch", json=batch).json()
+
+def test_recommendations_are_cached_until_the_user_clicks(mock_db_session, monkeypatch):
+    """Repeated /recommend calls are served from the cache; a click invalidates it."""
+    calls = []
+    async def counting_filtering(user_id, db, top_n=5, scoring_engine=None, tenant_id=None):
+        calls.append(user_id)
+        return [{"id": len(calls), "name": "Ad", "tags": []}]
+    monkeypatch.setattr('main.enhanced_collaborative_filtering_async', counting_filtering)
+
+    first = client.get("/recommend?user_id=7").json()
+    assert client.get("/recommend?user_id=7").json() == first
+    assert calls == [7]
+
+    client.post("/log-event", json={"user_id": 7, "ad_id": 1, "event_type": "impression", "tenant_id": 1})
+    client.get("/recommend?user_id=7")
+    assert calls == [7] # Impressions don't invalidate
+
+    client.post("/log-event", json={"user_id": 7, "ad_id": 1, "event_type": "click", "tenant_id": 1})
+    assert client.get("/recommend?user_id=7").json()["recommendations"][0]["id"] == 2
+    assert calls == [7, 7]
+
+def test_recommendation_redis_calls_run_off_the_event_loop(mock_db_session, monkeypatch):
+    """The cache and profile reads and writes of /recommend block worker threads, never the event loop."""
+    calls = []
+    def recording(name, result=None):
+        def call(*args, **kwargs):
+            try:
+                asyncio.get_running_loop()
+                calls.append((name, "event loop"))
+            except RuntimeError:
+                calls.append((name, "worker"))
+            return result
+        return call
+    redis_client = MagicMock(get=recording("get"), set=recording("set"), hgetall=recording("hgetall", {}))
+    redis_client.pipeline.return_value.execute = recording("pipeline")
+    monkeypatch.setattr('main.recommendation_cache', RecommendationCache(redis_client=lambda: redis_client))
+    monkeypatch.setattr('main.user_profiles', UserProfiles(redis_client=lambda: redis_client))
+    now = datetime.now()
+    mock_db_session.add_all([
+        AdModel(id=1, tenant_id=1, name="Summer Sale", content="", start_time=now - timedelta(days=1), end_time=now + timedelta(days=1), target_audience={"interests": ["fashion"]}),
+        EventModel(ad_id=1, user_id=101, event_type="click", tenant_id=1, occurred_at=now),
+    ])
+    mock_db_session.commit()
+
+    assert client.get("/recommend?user_id=101").json()["recommendations"]
+    assert {name for name, _ in calls} == {"get", "set", "hgetall", "pipeline"}
+    assert all(where == "worker" for _, where in calls)
+
+def test_traced_recommendation_reports_sql_and_stage_timings(mock_db_session, async_session_factory, monkeypatch, tmp_path):
+    tracing.instrument_engine(mock_db_session.get_bind()) # The initial load uses a session of its own
+    tracing.instrument_engine(async_session_factory.kw["bind"].sync_engine)
+    monkeypatch.setattr(tracing, "REQUEST_TRACE_DIR", str(tmp_path))
+    now = datetime.now()
+    mock_db_session.add_all([
+        AdModel(id=1, tenant_id=1, name="Summer Sale", content="", start_time=now - timedelta(days=1), end_time=now + timedelta(days=1), target_audience={"interests": ["fashion"]}),
+        AdModel(id=2, tenant_id=1, name="Winter Jackets", content="", start_time=now - timedelta(days=1), end_time=now + timedelta(days=1), target_audience={"interests": ["fashion"]}),
+        EventModel(ad_id=1, user_id=101, event_type="click", tenant_id=1, occurred_at=now),
+    ])
+    mock_db_session.commit()
+
+    monkeypatch.setattr("main.REQUEST_TRACE_ENABLED", True)
+    response = client.get("/recommend?user_id=101", headers={"X-Trace": "1"})
+    assert response.status_code == 200 and response.json()["recommendations"]
+    timing = response.headers["Server-Timing"]
+    assert timing.startswith("sql;dur=") and "catalog;dur=" in timing and "history;dur=" in timing and "total;dur=" in timing
+
+    with open(tmp_path / f"{response.headers['X-Trace-Id']}.json") as f:
+        trace = json.load(f)
+    assert trace["path"] == "/recommend" and trace["sql"]["count"] == len(trace["queries"]) > 0
+    assert any("FROM ads" in query["statement"] for query in trace["queries"])
+    stages = {span["name"]: span for span in trace["spans"]}
+    assert stages["initial_load"]["sql_ms"] > 0 and stages["history"]["duration_ms"] >= stages["history"]["sql_ms"]
+
+    monkeypatch.setattr("main.REQUEST_TRACE_ENABLED", False)
+    assert "Server-Timing" not in client.get("/recommend?user_id=101&trace=1").headers # Only for admins now
+
+def test_admin_profile_returns_collapsed_stacks(monkeypatch):
+    monkeypatch.setattr("main.ADMIN_TOKEN", "")
+    assert client.get("/admin/profile?seconds=0").status_code == 403
+    monkeypatch.setattr("main.ADMIN_TOKEN", "secret")
+    assert client.get("/admin/profile?seconds=0", headers={"X-Admin-Token": "wrong"}).status_code == 401
+
+    response = client.get("/admin/profile", params={"seconds": 0.05, "interval": 0.005, "idle": True},
+                          headers={"X-Admin-Token": "secret"})
+    assert response.status_code == 200 and response.headers["content-type"].startswith("text/plain")
+    lines = response.text.splitlines()
+    assert lines and all(";" in line and line.rsplit(" ", 1)[1].isdigit() for line in lines)
+    assert any("test_admin_profile_returns_collapsed_stacks" in line for line in lines) # This thread, waiting for the response
+
+def test_recommendation_profiles_are_updated_by_logged_events(mock_db_session, monkeypatch):
+    """The history is read once per user; later events update the materialized profile."""
+    monkeypatch.setattr('main.recommendation_cache', RecommendationCache(redis_client=lambda: None, ttl=0, stale_ttl=0))
+    mock_db_session.add_all([
+        AdModel(id=1, tenant_id=1, name="Summer Sale", content="", target_audience={"interests": ["fashion", "sale"]}),
+        AdModel(id=2, tenant_id=1, name="New Gadget", content="", target_audience={"interests": ["tech"]}),
+        AdModel(id=3, tenant_id=1, name="Laptop Deal", content="", target_audience={"interests": ["tech"]}),
+        AdModel(id=4, tenant_id=1, name="Winter Jackets", content="", target_audience={"interests": ["fashion", "sale"]}),
+        EventModel(ad_id=1, user_id=101, event_type="click", tenant_id=1, occurred_at=datetime.now()),
+    ])
+    mock_db_session.commit()
+
+    assert client.get("/recommend?user_id=101").json()["recommendations"][0]["id"] == 4
+    assert client.get("/recommend?user_id=101&tenant_id=1").json()["recommendations"][0]["id"] == 4
+    # The events table is not read again: this click only reaches the profiles, the tenant's one too
+    mock_db_session.query(EventModel).delete()
+    mock_db_session.commit()
+    for _ in range(3):
+        client.post("/log-event", json={"user_id": 101, "ad_id": 2, "event_type": "click", "tenant_id": 1})
+    assert client.get("/recommend?user_id=101").json()["recommendations"][0]["id"] == 3
+    assert client.get("/recommend?user_id=101&tenant_id=1").json()["recommendations"][0]["id"] == 3
+
+def test_batch_recommendation_endpoint(mock_db_session):
+    """Batch recommendations rank each user's history exactly like the single-user endpoint."""
+    mock_ads = [
+        AdModel(id=1, tenant_id=1, name="Summer Sale", content="", target_audience={"interests": ["fashion", "sale"]}),
+        AdModel(id=2, tenant_id=1, name="New Gadget", content="", target_audience={"interests": ["tech", "electronics"]}),
+        AdModel(id=3, tenant_id=1, name="Travel Package", content="", target_audience={"interests": ["travel", "sale"]}),
+        AdModel(id=4, tenant_id=2, name="Laptop Deal", content="", target_audience={"interests": ["tech", "sale"]}),
+    ]
+    mock_events = [
+        EventModel(ad_id=1, user_id=101, event_type="click", tenant_id=1, occurred_at=datetime.now()),
+        EventModel(ad_id=2, user_id=102, event_type="click", tenant_id=1, occurred_at=datetime.now() - timedelta(days=1)),
+        EventModel(ad_id=4, user_id=102, event_type="impression", tenant_id=2, occurred_at=datetime.now()),
+    ]
+    mock_db_session.add_all(mock_ads + mock_events)
+    mock_db_session.commit()
+
+    response = client.post("/recommend/batch", json={"user_ids": [102, 101, 999, 101], "top_n": 1})
+    assert response.status_code == 200
+    results = response.json()["results"]
+    assert [result["user_id"] for result in results] == [102, 101, 999]
+    # User 102 saw "tech" and "sale" ads, user 101 clicked a "sale" ad
+    assert [ad["id"] for ad in results[0]["recommendations"]] == [1]
+    assert [ad["id"] for ad in results[1]["recommendations"]] == [3]
+    assert len(results[2]["recommendations"]) == 1 # Cold start
+
+    single = client.get("/recommend?user_id=101").json()["recommendations"]
+    assert single[0]["id"] == 3
+
+    # A tenant restricts both the histories and the recommended ads to that tenant
+    response = client.post("/recommend/batch", json={"user_ids": [102, 101], "tenant_id": 2, "top_n": 2})
+    for result in response.json()["results"]:
+        assert [ad["id"] for ad in result["recommendations"]] == [4]
+
+def test_recommendation_top_n_is_bounded(mock_db_session):
+    """top_n must be between 1 and RECOMMEND_MAX_TOP_N on both endpoints; other counts are honoured."""
+    mock_db_session.add_all([
+        AdModel(id=i, tenant_id=1, name=f"Ad {i}", content="", target_audience={"interests": ["tech"]})
+        for i in range(1, 5)
+    ])
+    mock_db_session.commit()
+
+    for top_n in (0, -1, main.RECOMMEND_MAX_TOP_N + 1):
+        assert client.get(f"/recommend?user_id=101&top_n={top_n}").status_code == 422
+        assert client.post("/recommend/batch", json={"user_ids": [101], "top_n": top_n}).status_code == 422
+
+    assert len(client.get("/recommend?user_id=101&top_n=2").json()["recommendations"]) == 2
+    # The default count is still served (and cached) as before
+    assert len(client.get("/recommend?user_id=101").json()["recommendations"]) == 4
+    response = client.post("/recommend/batch", json={"user_ids": [101], "top_n": 3})
+    assert len(response.json()["results"][0]["recommendations"]) == 3
+
+def test_recommendations_only_include_live_ads_of_the_tenant(mock_db_session):
+    """Ads outside their start_time/end_time window or of another tenant are never recommended."""
+    now = datetime.now()
+    mock_db_session.add_all([
+        AdModel(id=1, tenant_id=1, name="Clicked", content="", target_audience={"interests": ["tech"]}),
+        AdModel(id=2, tenant_id=1, name="Expired", content="", end_time=now - timedelta(days=1), target_audience={"interests": ["tech"]}),
+        AdModel(id=3, tenant_id=1, name="Upcoming", content="", start_time=now + timedelta(days=1), target_audience={"interests": ["tech"]}),
+        AdModel(id=4, tenant_id=2, name="Other Tenant", content="", target_audience={"interests": ["tech"]}),
+        AdModel(id=5, tenant_id=1, name="Running", content="", start_time=now - timedelta(days=1), end_time=now + timedelta(days=1), target_audience={"interests": ["tech", "sale"]}),
+        AdModel(id=6, tenant_id=1, name="Untagged", content="", target_audience={"interests": ["food"]}),
+        EventModel(ad_id=1, user_id=101, event_type="click", tenant_id=1, occurred_at=now),
+    ])
+    mock_db_session.commit()
+
+    for engine_name in ("python", "numpy"):
+        recommendations = main.enhanced_collaborative_filtering(101, mock_db_session, top_n=1, scoring_engine=engine_name, tenant_id=1)
+        assert [ad["id"] for ad in recommendations] == [5]
+    # Fill and cold start draw from the same live ads
+    recommended = {ad["id"] for ad in client.get("/recommend?user_id=101&tenant_id=1").json()["recommendations"]}
+    assert recommended == {1, 5, 6}
+    recommended = {ad["id"] for ad in client.get("/recommend?user_id=999&tenant_id=1").json()["recommendations"]}
+    assert recommended == {1, 5, 6}
+
+def test_recommendations_use_item_similarity(mock_db_session, monkeypatch, tmp_path):
+    """Ads similar to the user's ads are recommended even without a shared tag."""
+    mock_db_session.add_all([
+        AdModel(id=1, tenant_id=1, name="Clicked", content="", target_audience={"interests": ["tech"]}),
+        AdModel(id=2, tenant_id=1, name="Same Tag", content="", target_audience={"interests": ["tech"]}),
+        AdModel(id=3, tenant_id=1, name="Co-Clicked", content="", target_audience={"interests": ["food"]}),
+        EventModel(ad_id=1, user_id=101, event_type="click", tenant_id=1, occurred_at=datetime.now()),
+    ])
+    mock_db_session.commit()
+    directory = str(tmp_path / "similarity")
+    publish_similarity({"ad_ids": np.array([1, 3]), "indptr": np.array([0, 1, 2]), "indices": np.array([1, 0], dtype=np.int32),
+                        "data": np.array([0.9, 0.9], dtype=np.float32)}, directory)
+    monkeypatch.setattr('main.item_similarity', ItemSimilarity(directory))
+
+    catalog = main.ad_catalog.snapshot(mock_db_session)
+    profile = main._load_tag_profiles([101], mock_db_session, catalog.ads)[101]
+    for engine_name in ("python", "numpy"):
+        # Ranked without the random fill: tag score 1.0 beats similarity 0.9
+        assert main._rank_profiles(catalog, [profile], {}, 3, engine_name) == [[2, 3]]
+    recommendations = main.enhanced_collaborative_filtering(101, mock_db_session, top_n=2)
+    assert [ad["id"] for ad in recommendations] == [2, 3]
+
+def test_batch_recommendation_endpoint_rejects_oversized_batches(mock_db_session, monkeypatch):
+    monkeypatch.setattr('main.RECOMMEND_BATCH_MAX_USERS', 2)
+    response = client.post("/recommend/batch", json={"user_ids": [1, 2, 3]})
+    assert response.status_code == 413
+
+def test_metrics_endpoint_exposes_route_latency_stages_and_sinks(mock_db_session):
+    """/metrics reports per-route latency, recommendation stage timers and per-sink event counters."""
+    def sample(name, **labels):
+        return REGISTRY.get_sample_value(name, labels) or 0
+
+    mock_db_session.add_all([
+        AdModel(id=1, tenant_id=1, name="Summer Sale", content="", target_audience={"interests": ["sale"]}),
+        AdModel(id=2, tenant_id=1, name="Laptop Deal", content="", target_audience={"interests": ["tech", "sale"]}),
+        EventModel(ad_id=1, user_id=101, event_type="click", tenant_id=1, occurred_at=datetime.now()),
+    ])
+    mock_db_session.commit()
+    requests_before = sample("http_request_duration_seconds_count", method="GET", route="/recommend", status="200")
+    scoring_before = sample("recommendation_stage_duration_seconds_count", stage="score")
+    kafka_before = sample("events_logged_total", sink="kafka")
+
+    client.get("/recommend?user_id=101")
+    client.post("/log-event", json={"user_id": 101, "ad_id": 2, "event_type": "click", "tenant_id": 1})
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    assert 'route="/recommend"' in response.text
+    assert sample("http_request_duration_seconds_count", method="GET", route="/recommend", status="200") == requests_before + 1
+    assert sample("recommendation_stage_duration_seconds_count", stage="score") == scoring_before + 1
+    for stage in ("catalog", "ctr", "history", "candidates", "sort"):
+        assert sample("recommendation_stage_duration_seconds_count", stage=stage) > 0
+    assert sample("events_logged_total", sink="kafka") == kafka_before + 1
+
+def test_report_endpoints_read_the_rollups(mock_db_session, monkeypatch):
+    from app.services.event_rollups import rollup_counts, upsert_rollups
+    upsert_rollups(mock_db_session, rollup_counts([
+        {"tenant_id": 1, "ad_id": 10, "event_type": event_type, "occurred_at": datetime(2025, 7, day, 12)}
+        for day, event_type in ((1, "impression"), (1, "impression"), (1, "click"), (2, "impression"))]))
+    mock_db_session.commit()
+    monkeypatch.setattr("main.ADMIN_TOKEN", "secret")
+    admin = {"X-Admin-Token": "secret"}
+
+    response = client.get("/reports/events", params={"tenant_id": 1, "start": "2025-07-01", "end": "2025-07-31"}, headers=admin)
+    assert response.status_code == 200
+    assert response.json() == {"2025-07-01": {"impression": 2, "click": 1}, "2025-07-02": {"impression": 1, "click": 0}}
+    assert client.get("/reports/events", params={"tenant_id": 2}, headers=admin).json() == {}
+    assert client.get("/reports/events", params={"tenant_id": 1, "granularity": "week"}, headers=admin).status_code == 422
+    assert client.get("/reports/conversions", params={"tenant_id": 1}, headers=admin).json() == {
+        "impressions": 3, "clicks": 1, "conversion_rate": 33.33}
+
+def test_report_endpoints_require_a_tenant_and_the_admin_token(mock_db_session, monkeypatch):
+    monkeypatch.setattr("main.ADMIN_TOKEN", "secret")
+    for path in ("/reports/events", "/reports/conversions"):
+        assert client.get(path, params={"tenant_id": 1}).status_code == 401
+        assert client.get(path, params={"tenant_id": 1}, headers={"X-Admin-Token": "wrong"}).status_code == 401
+        assert client.get(path, headers={"X-Admin-Token": "secret"}).status_code == 422 # No cross-tenant reports
+
 def test_log_event_endpoint_success():
     """Test logging an event successfully to Kafka (mocked)."""
     event_data = {
@@ -157,12 +495,145 @@ def test_log_event_endpoint_success():
     assert "logged to Kafka successfully" in response.json()["message"]
     assert response.json()["event"]["user_id"] == 105
 
+def test_log_event_updates_ctr_counters():
+    """Logged events are counted immediately, without waiting for them to reach MySQL."""
+    import main
+    for event_type in ("impression", "impression", "click"):
+        response = client.post("/log-event", json={"user_id": 1, "ad_id": 42, "event_type": event_type, "tenant_id": 2})
+        assert response.status_code == 200
+    assert main.ctr_stats.counts(42) == (2, 1)
+    assert main.ctr_stats.ctr(42) == 0.5
+    assert main.ctr_stats.tenant_ctr(2) == 0.5
+
+def test_log_event_async_mode(monkeypatch):
+    """In async mode events are acknowledged immediately and flushed to Kafka in batches."""
+    import main
+    pipeline = EventPipeline(deliver=main._deliver_event_batch, linger_ms=1)
+    monkeypatch.setattr('main.EVENT_INGESTION_MODE', 'async')
+    monkeypatch.setattr('main.event_pipeline', pipeline)
+    event_data = {"user_id": 108, "ad_id": 11, "event_type": "impression", "tenant_id": 1}
+    try:
+        response = client.post("/log-event", json=event_data)
+        assert response.status_code == 202
+        assert response.json()["event"]["user_id"] == 108
+
+        response = client.post("/log-event?wait_for_ack=true", json=event_data)
+        assert response.status_code == 200
+        assert "logged to Kafka successfully" in response.json()["message"]
+        assert main.ctr_stats.counts(11) == (2, 0)
+
+        stats = client.get("/ingestion/stats").json()
+        assert stats["mode"] == "async"
+        assert stats["events_flushed"] == 2
+    finally:
+        pipeline.stop()
+
+def test_log_event_async_ack_reports_a_failed_spool_write(monkeypatch):
+    """With wait_for_ack, a spooled event is accepted with 202 but a lost one is a 503."""
+    import main
+    pipeline = EventPipeline(deliver=main._deliver_event_batch, linger_ms=1)
+    monkeypatch.setattr('main.EVENT_INGESTION_MODE', 'async')
+    monkeypatch.setattr('main.event_pipeline', pipeline)
+    monkeypatch.setattr('main.kafka_producer', None)
+    monkeypatch.setattr('main.redis_client', None)
+    event_data = {"user_id": 110, "ad_id": 11, "event_type": "click", "tenant_id": 1}
+    try:
+        response = client.post("/log-event?wait_for_ack=true", json=event_data)
+        assert response.status_code == 202 and response.json()["status"] == "spooled"
+
+        monkeypatch.setattr('main.event_spool.append', MagicMock(side_effect=OSError("disk full")))
+        response = client.post("/log-event?wait_for_ack=true", json=event_data)
+        assert response.status_code == 503
+    finally:
+        pipeline.stop()
+
+def test_log_events_bulk_endpoint_reports_per_event_results(monkeypatch):
+    """Valid events are written as one batch, invalid ones are reported individually."""
+    pushed = []
+    class MockRedis:
+        def rpush(self, key, *values):
+            pushed.append((key, values))
+            return len(values)
+    monkeypatch.setattr('main.kafka_producer', None)
+    monkeypatch.setattr('main.redis_client', MockRedis())
+
+    events = [
+        {"user_id": 1, "ad_id": 10, "event_type": "impression", "tenant_id": 1},
+        {"user_id": 1, "ad_id": 10, "tenant_id": 1}, # Missing event_type
+        {"user_id": 2, "ad_id": 11, "event_type": "click", "tenant_id": 1, "timestamp": 1700000000},
+        "not an event",
+    ]
+    response = client.post("/log-events", json=events)
+    assert response.status_code == 200
+    data = response.json()
+    assert (data["received"], data["logged"], data["spooled"], data["failed"]) == (4, 2, 0, 2)
+    assert [result["status"] for result in data["results"]] == ["redis", "invalid", "redis", "invalid"]
+    assert "event_type" in data["results"][1]["error"]
+
+    assert len(pushed) == 1 # One multi-value RPUSH for the whole batch
+    key, values = pushed[0]
+    assert key == "event_queue"
+    assert [json.loads(value)["ad_id"] for value in values] == [10, 11]
+    assert json.loads(values[1])["timestamp"] == 1700000000
+
+def test_log_events_bulk_endpoint_falls_back_to_a_single_file_append(monkeypatch):
+    monkeypatch.setattr('main.kafka_producer', None)
+    monkeypatch.setattr('main.redis_client', None)
+    events = [{"user_id": n, "ad_id": 10, "event_type": "impression", "tenant_id": 1} for n in range(3)]
+    response = client.post("/log-events", json=events)
+    data = response.json()
+    assert [result["status"] for result in data["results"]] == ["file"] * 3
+    # Spooled events are durable: logged, not failed, so clients do not retry them
+    assert (data["logged"], data["spooled"], data["failed"]) == (3, 3, 0)
+    assert [event["user_id"] for event in main.event_spool.events()] == [0, 1, 2]
+    assert len(main.event_spool.segments()) == 1 # One group commit to a single segment
+
+def test_log_events_bulk_endpoint_reports_a_failed_spool_write_per_event(monkeypatch):
+    monkeypatch.setattr('main.kafka_producer', None)
+    monkeypatch.setattr('main.redis_client', None)
+    monkeypatch.setattr('main.event_spool.append', MagicMock(side_effect=OSError("disk full")))
+    events = [{"user_id": n, "ad_id": 10, "event_type": "impression", "tenant_id": 1} for n in range(2)] + ["not an event"]
+    response = client.post("/log-events", json=events)
+    assert response.status_code == 200
+    data = response.json()
+    assert [result["status"] for result in data["results"]] == ["failed", "failed", "invalid"]
+    assert (data["logged"], data["spooled"], data["failed"]) == (0, 0, 3)
+
+def test_log_events_bulk_endpoint_rejects_oversized_batches(monkeypatch):
+    monkeypatch.setattr('main.LOG_EVENTS_MAX_BATCH', 1)
+    events = [{"user_id": 1, "ad_id": 10, "event_type": "impression", "tenant_id": 1}] * 2
+    assert client.post("/log-events", json=events).status_code == 413
+
+def test_spooled_events_are_replayed_to_kafka_once_it_is_back(monkeypatch):
+    monkeypatch.setattr('main.kafka_producer', None)
+    monkeypatch.setattr('main.redis_client', None)
+    events = [{"user_id": n, "ad_id": 10, "event_type": "click", "tenant_id": 1} for n in range(3)]
+    client.post("/log-events", json=events)
+    with pytest.raises(ConnectionError):
+        main.event_spool.replay(main._replay_spooled_events) # Kafka still down: nothing is lost
+    assert len(list(main.event_spool.events())) == 3
+
+    sent = []
+    class RecoveredProducer:
+        def send(self, topic, value):
+            sent.append(value)
+            return self
+        def get(self, timeout=None):
+            return True
+        def flush(self, timeout=None):
+            pass
+        def bootstrap_connected(self):
+            return True
+    monkeypatch.setattr('main.kafka_producer', RecoveredProducer())
+    assert main.event_spool.replay(main._replay_spooled_events) == 3
+    assert [event["user_id"] for event in sent] == [0, 1, 2]
+    assert main.event_spool.segments() == []
+    assert main.ctr_stats.counts(10) == (0, 3) # Replayed events count like freshly logged ones
+
 def test_log_event_endpoint_fallback_to_redis_when_kafka_fails(monkeypatch):
     """Test logging an event when Kafka is unavailable, falling back to Redis (mocked)."""
     # Simulate Kafka producer connection failure
-    def mock_bootstrap_connected_false(self):
-        return False
-    monkeypatch.setattr('main.kafka_producer.bootstrap_connected', mock_bootstrap_connected_false)
+    monkeypatch.setattr('main.kafka_producer.bootstrap_connected', lambda: False)
 
     event_data = {
         "user_id": 106,
@@ -181,9 +652,7 @@ def test_log_event_endpoint_fallback_to_file_when_kafka_and_redis_fail(monkeypat
     falling back to file logging.
     """
     # Simulate Kafka producer connection failure
-    def mock_bootstrap_connected_false(self):
-        return False
-    monkeypatch.setattr('main.kafka_producer.bootstrap_connected', mock_bootstrap_connected_false)
+    monkeypatch.setattr('main.kafka_producer.bootstrap_connected', lambda: False)
     
     # Simulate Redis connection failure (by setting redis_client to None)
     monkeypatch.setattr('main.redis_client', None)
@@ -195,16 +664,28 @@ def test_log_event_endpoint_fallback_to_file_when_kafka_and_redis_fail(monkeypat
         "tenant_id": 3
     }
     response = client.post("/log-event", json=event_data)
-    assert response.status_code == 503 # Or 500, depending on desired strictness for file fallback
-    assert "Event logging service is unavailable" in response.json()["detail"]
+    assert response.status_code == 202 # Durably spooled, delivered to Kafka later
+    assert response.json()["status"] == "spooled"
     
-    # Verify content in fallback file
-    with open("event_log_fallback.txt", "r") as f:
-        lines = f.readlines()
-        assert len(lines) == 1
-        logged_event = json.loads(lines[0])
-        assert logged_event["user_id"] == 107
-        assert logged_event["event_type"] == "click"
+    # Verify content in the spool
+    spooled = list(main.event_spool.events())
+    assert len(spooled) == 1
+    assert spooled[0]["user_id"] == 107
+    assert spooled[0]["event_type"] == "click"
+
+def test_log_event_is_spooled_when_redis_rejects_it(monkeypatch):
+    monkeypatch.setattr('main.kafka_producer.bootstrap_connected', lambda: False)
+    monkeypatch.setattr('main.redis_client.rpush', MagicMock(side_effect=ConnectionError("redis down")))
+    response = client.post("/log-event", json={"user_id": 108, "ad_id": 10, "event_type": "click", "tenant_id": 3})
+    assert response.status_code == 202 and response.json()["status"] == "spooled"
+    assert [event["user_id"] for event in main.event_spool.events()] == [108]
+
+def test_log_event_fails_only_when_the_spool_write_fails(monkeypatch):
+    monkeypatch.setattr('main.kafka_producer.bootstrap_connected', lambda: False)
+    monkeypatch.setattr('main.redis_client', None)
+    monkeypatch.setattr('main.event_spool.append', MagicMock(side_effect=OSError("disk full")))
+    response = client.post("/log-event", json={"user_id": 109, "ad_id": 10, "event_type": "click", "tenant_id": 3})
+    assert response.status_code == 503
 
 def test_log_event_with_missing_data():
     """Test logging an event with missing required data (should fail Pydantic validation)."""
@@ -229,7 +710,7 @@ def test_database_connection_failure_during_recommendation(monkeypatch):
     def override_get_db_failing():
         yield mock_session_failing_query
 
-    monkeypatch.setattr("main.get_db", override_get_db_failing)
+    monkeypatch.setattr("app.services.database.get_db", override_get_db_failing)
 
     response = client.get("/recommend?user_id=1")
     # Expect a 500 internal server error due to DB issues
@@ -0,0 +1,66 @@
+import os
+import subprocess
+import sys
+
+from kafka.future import Future
+from prometheus_client import REGISTRY
+from sqlalchemy import create_engine, text
+from sqlalchemy.pool import QueuePool
+
+from app.services import metrics
+
+
+def test_pool_checkouts_are_timed():
+    engine = create_engine("sqlite://", poolclass=QueuePool)
+    metrics.instrument_pool(engine.pool, "test")
+    before = REGISTRY.get_sample_value("db_pool_checkout_wait_seconds_count", {"pool": "test"}) or 0
+
+    with engine.connect() as connection:
+        connection.execute(text("SELECT 1"))
+        assert REGISTRY.get_sample_value("db_pool_connections", {"pool": "test", "state": "checked_out"}) == 1
+    assert REGISTRY.get_sample_value("db_pool_checkout_wait_seconds_count", {"pool": "test"}) == before + 1
+    assert REGISTRY.get_sample_value("db_pool_connections", {"pool": "test", "state": "checked_out"}) == 0
+
+
+def test_in_flight_records_are_released_on_success_and_failure():
+    in_flight = metrics.InFlightRecords()
+    acked, failed, done = Future(), Future(), Future().success(None)
+    for future in (acked, failed, done):
+        in_flight.track(future)
+    in_flight.track(object()) # Futures without callbacks are not counted
+    assert in_flight() == 2
+
+    acked.success("metadata")
+    failed.failure(Exception("broker down"))
+    assert in_flight() == 0
+
+
+def test_multiprocess_mode_creates_its_directory(tmp_path):
+    """Services started without the image's entrypoint must not fail on a missing PROMETHEUS_MULTIPROC_DIR."""
+    directory = tmp_path / "not-created-yet"
+    script = "from app.services import metrics; metrics.EVENTS_REPLAYED.inc(); print(metrics.render()[0].decode())"
+    result = subprocess.run([sys.executable, "-c", script], cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                            env={**os.environ, "PROMETHEUS_MULTIPROC_DIR": str(directory)}, capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+    assert "events_replayed_total 1.0" in result.stdout
+
+
+def test_gauges_are_exported_in_multiprocess_mode(tmp_path):
+    script = "\n".join([
+        "from kafka.future import Future",
+        "from sqlalchemy import create_engine",
+        "from sqlalchemy.pool import QueuePool",
+        "from app.services import metrics",
+        "engine = create_engine('sqlite://', poolclass=QueuePool)",
+        "metrics.instrument_pool(engine.pool, 'test')",
+        "connection = engine.connect()",
+        "metrics.InFlightRecords(metrics.KAFKA_PRODUCER_QUEUE_DEPTH).track(Future())",
+        "metrics.EVENT_SPOOL_BYTES.set(42)",
+        "print(metrics.render()[0].decode())",
+    ])
+    result = subprocess.run([sys.executable, "-c", script], cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                            env={**os.environ, "PROMETHEUS_MULTIPROC_DIR": str(tmp_path)}, capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+    assert 'db_pool_connections{pool="test",state="checked_out"} 1.0' in result.stdout
+    assert "kafka_producer_queue_depth 1.0" in result.stdout
+    assert "event_spool_bytes 42.0" in result.stdout
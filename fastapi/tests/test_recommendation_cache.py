@@ -0,0 +1,173 @@
+import asyncio
+import threading
+import time
+
+from app.services.recommendation_cache import RecommendationCache
+
+
+class FakeRedis:
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None):
+        self.data[key] = value
+
+    def delete(self, *keys):
+        for key in keys:
+            self.data.pop(key, None)
+
+
+class BrokenRedis:
+    def __getattr__(self, name):
+        def fail(*args, **kwargs):
+            raise ConnectionError("Redis is down")
+        return fail
+
+
+def _recs(n):
+    return [{"id": n, "name": f"Ad {n}", "tags": []}]
+
+
+def test_entries_are_shared_through_redis():
+    redis_client = FakeRedis()
+    first = RecommendationCache(lambda: redis_client)
+    second = RecommendationCache(lambda: redis_client)
+
+    assert first.get_or_compute(1, 7, lambda: _recs(1)) == _recs(1)
+    assert second.get_or_compute(1, 7, lambda: _recs(2)) == _recs(1) # Served from Redis
+    assert (second.hits, second.misses) == (1, 0)
+
+
+def test_invalidate_drops_tenant_and_tenantless_entries():
+    redis_client = FakeRedis()
+    cache = RecommendationCache(lambda: redis_client)
+    cache.get_or_compute(1, 7, lambda: _recs(1))
+    cache.get_or_compute(None, 7, lambda: _recs(1))
+    cache.get_or_compute(1, 8, lambda: _recs(1))
+
+    cache.invalidate(1, 7)
+    assert set(redis_client.data) == {"reco:1:8"}
+    assert cache.get_or_compute(None, 7, lambda: _recs(2)) == _recs(2)
+
+
+def test_stale_entries_are_served_while_refreshing_in_background():
+    cache = RecommendationCache(lambda: None, ttl=0.05, stale_ttl=60)
+    cache.get_or_compute(None, 7, lambda: _recs(1))
+    time.sleep(0.06)
+
+    refreshed = threading.Event()
+    def refresh():
+        refreshed.set()
+        return _recs(2)
+
+    assert cache.get_or_compute(None, 7, lambda: _recs(3), refresh=refresh) == _recs(1)
+    assert refreshed.wait(2)
+    deadline = time.time() + 2
+    while cache.get_or_compute(None, 7, lambda: _recs(3)) != _recs(2) and time.time() < deadline:
+        time.sleep(0.01)
+    assert cache.get_or_compute(None, 7, lambda: _recs(3)) == _recs(2)
+    assert cache.stale_hits == 1
+
+
+def test_expired_entries_are_recomputed_without_stale_window():
+    cache = RecommendationCache(lambda: None, ttl=0.01, stale_ttl=0)
+    cache.get_or_compute(None, 7, lambda: _recs(1))
+    time.sleep(0.02)
+    assert cache.get_or_compute(None, 7, lambda: _recs(2), refresh=lambda: _recs(3)) == _recs(2)
+
+
+def test_local_tier_is_bounded_and_survives_redis_errors():
+    cache = RecommendationCache(lambda: BrokenRedis(), local_size=2, local_ttl=60)
+    for user_id in (1, 2, 3):
+        cache.get_or_compute(None, user_id, lambda: _recs(user_id))
+    assert len(cache._local) == 2
+    assert cache.get_or_compute(None, 3, lambda: _recs(9)) == _recs(3)
+    assert cache.get_or_compute(None, 1, lambda: _recs(9)) == _recs(9) # Evicted
+    cache.invalidate(None, 3) # Must not raise
+    assert cache.get_or_compute(None, 3, lambda: _recs(4)) == _recs(4)
+
+
+def test_empty_results_are_not_cached():
+    cache = RecommendationCache(lambda: None)
+    assert cache.get_or_compute(None, 7, lambda: []) == []
+    assert cache.get_or_compute(None, 7, lambda: _recs(1)) == _recs(1)
+
+
+def test_concurrent_misses_for_one_user_are_computed_once():
+    cache = RecommendationCache(lambda: None)
+    computed = []
+
+    async def compute():
+        computed.append(1)
+        await asyncio.sleep(0.02)
+        return _recs(len(computed))
+
+    async def requests():
+        return await asyncio.gather(*(cache.get_or_compute_async(None, 7, compute) for _ in range(10)),
+                                    cache.get_or_compute_async(None, 8, compute))
+
+    results = asyncio.run(requests())
+    assert len(computed) == 2
+    assert results[:10] == [results[0]] * 10
+    assert cache.get_or_compute(None, 7, lambda: _recs(9)) == results[0] # The shared result was cached
+
+
+def test_results_computed_across_an_invalidation_are_not_stored():
+    redis_client = FakeRedis()
+    cache = RecommendationCache(lambda: redis_client)
+
+    def compute_while_the_user_clicks():
+        cache.invalidate(None, 7) # The click is logged while the recommender runs
+        return _recs(1)
+
+    assert cache.get_or_compute(None, 7, compute_while_the_user_clicks) == _recs(1) # Still answers this request
+    assert "reco:all:7" not in redis_client.data
+    assert cache.get_or_compute(None, 7, lambda: _recs(2)) == _recs(2)
+    assert cache.get_or_compute(None, 7, lambda: _recs(3)) == _recs(2) # Later results are cached again
+
+
+def test_a_refresh_finishing_after_an_invalidation_is_dropped():
+    cache = RecommendationCache(lambda: None, ttl=0.05, stale_ttl=60)
+    cache.get_or_compute(None, 7, lambda: _recs(1))
+    time.sleep(0.06)
+
+    started, release = threading.Event(), threading.Event()
+    def slow_refresh():
+        started.set()
+        release.wait(2)
+        return _recs(2)
+
+    assert cache.get_or_compute(None, 7, lambda: _recs(3), refresh=slow_refresh) == _recs(1)
+    assert started.wait(2)
+    cache.invalidate(None, 7)
+    release.set()
+    deadline = time.time() + 2
+    while cache._refreshing and time.time() < deadline:
+        time.sleep(0.01)
+    assert cache.get_or_compute(None, 7, lambda: _recs(4)) == _recs(4) # Not the pre-click refresh
+
+
+def test_background_refreshes_are_bounded():
+    cache = RecommendationCache(lambda: None, ttl=0.01, stale_ttl=60, refresh_workers=1, refresh_backlog=2)
+    for user_id in range(5):
+        cache.get_or_compute(None, user_id, lambda: _recs(1))
+    time.sleep(0.02)
+
+    release = threading.Event()
+    refreshed = []
+    def refresh():
+        release.wait(2)
+        refreshed.append(1)
+        return _recs(2)
+
+    for user_id in range(5):
+        assert cache.get_or_compute(None, user_id, lambda: _recs(3), refresh=refresh) == _recs(1)
+    assert len(cache._refreshing) == 2 # The others keep serving their stale entry
+    release.set()
+    deadline = time.time() + 2
+    while cache._refreshing and time.time() < deadline:
+        time.sleep(0.01)
+    assert len(refreshed) == 2
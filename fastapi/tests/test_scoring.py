@@ -0,0 +1,119 @@
+import random
+
+import pytest
+
+from app.services.ad_catalog import CatalogSnapshot
+from app.services.scoring import NumpyScorer, rank_ads_python
+
+TAGS = ["tech", "fashion", "sports", "travel", "sale", "winter", "food"]
+
+
+def _snapshot(num_ads, rng, identical_tags=False):
+    ads = {}
+    for ad_id in rng.sample(range(1, num_ads * 10), num_ads):
+        tags = TAGS[:4] if identical_tags else rng.sample(TAGS, rng.randint(0, 4))
+        ads[ad_id] = {"id": ad_id, "name": f"Ad {ad_id}", "tags": tuple(tags)}
+    return CatalogSnapshot(ads, {ad_id: 1 for ad_id in ads}, {}, version=1)
+
+
+@pytest.mark.parametrize("seed", range(20))
+@pytest.mark.parametrize("identical_tags", [False, True])
+def test_numpy_engine_matches_reference_ranking(seed, identical_tags):
+    rng = random.Random(seed)
+    snapshot = _snapshot(300, rng, identical_tags)
+    ad_ids = list(snapshot.ads)
+    raw = {tag: rng.random() for tag in rng.sample(TAGS, 3)}
+    tag_scores = {tag: score / sum(raw.values()) for tag, score in raw.items()}
+    # Coarse CTR values produce many exact ties, which is where the two engines could diverge
+    ad_ctrs = {ad_id: rng.choice([0.0, 0.1, 0.25, 0.5]) for ad_id in rng.sample(ad_ids, 150)}
+    exclude = set(rng.sample(ad_ids, 20)) | {-1}
+
+    for top_n in (1, 5, 50, 1000):
+        expected = rank_ads_python(snapshot.ads, tag_scores, ad_ctrs, exclude, top_n)
+        assert NumpyScorer().rank(snapshot, tag_scores, ad_ctrs, exclude, top_n, ctr_version=1) == expected
+
+
+def test_numpy_engine_only_returns_positive_scores():
+    snapshot = CatalogSnapshot({
+        1: {"id": 1, "name": "a", "tags": ("tech",)},
+        2: {"id": 2, "name": "b", "tags": ("food",)},
+        3: {"id": 3, "name": "c", "tags": ()},
+    }, {}, {}, version=1)
+    scorer = NumpyScorer()
+    assert scorer.rank(snapshot, {"tech": 1.0}, {}, set(), 5) == [1]
+    assert scorer.rank(snapshot, {"tech": 1.0}, {3: 0.2}, {1}, 5) == [3]
+    assert scorer.rank(CatalogSnapshot({}, {}, {}, version=2), {"tech": 1.0}, {}, set(), 5) == []
+
+
+def test_numpy_engine_caches_ctr_vector_per_version():
+    snapshot = CatalogSnapshot({1: {"id": 1, "name": "a", "tags": ()}, 2: {"id": 2, "name": "b", "tags": ()}}, {}, {}, version=1)
+    scorer = NumpyScorer()
+    ad_ctrs = {1: 0.1, 2: 0.2}
+    assert scorer.rank(snapshot, {}, ad_ctrs, set(), 2, ctr_version=1) == [2, 1]
+    ad_ctrs[1] = 0.9
+    assert scorer.rank(snapshot, {}, ad_ctrs, set(), 2, ctr_version=1) == [2, 1] # Same version, cached vector
+    assert scorer.rank(snapshot, {}, ad_ctrs, set(), 2, ctr_version=2) == [1, 2]
+
+
+def test_rank_many_matches_per_user_ranking_across_chunks():
+    rng = random.Random(7)
+    snapshot = _snapshot(200, rng)
+    ad_ids = list(snapshot.ads)
+    ad_ctrs = {ad_id: rng.random() / 10 for ad_id in ad_ids}
+    profiles = []
+    for _ in range(150): # More users than one users x ads chunk holds
+        tags = rng.sample(TAGS, 2)
+        profiles.append(({tags[0]: 0.7, tags[1]: 0.3}, set(rng.sample(ad_ids, 5))))
+
+    ranked = NumpyScorer().rank_many(snapshot, profiles, ad_ctrs, 10, ctr_version=1)
+    assert ranked == [rank_ads_python(snapshot.ads, tag_scores, ad_ctrs, exclude, 10) for tag_scores, exclude in profiles]
+
+
+def test_engines_agree_on_candidate_restricted_rankings():
+    rng = random.Random(11)
+    ads = {}
+    windows = {}
+    for ad_id in rng.sample(range(1, 4000), 400):
+        ads[ad_id] = {"id": ad_id, "name": f"Ad {ad_id}", "tags": tuple(rng.sample(TAGS, rng.randint(0, 3)))}
+        windows[ad_id] = rng.choice([(float("-inf"), float("inf")), (0.0, 100.0), (100.0, 200.0)])
+    snapshot = CatalogSnapshot(ads, {ad_id: rng.choice([1, 2]) for ad_id in ads}, windows, version=1)
+    ad_ids = list(ads)
+    ad_ctrs = {ad_id: rng.choice([0.0, 0.1, 0.25]) for ad_id in ad_ids}
+    profiles = [({tag: rng.random() for tag in rng.sample(TAGS, 2)}, set(rng.sample(ad_ids, 30))) for _ in range(100)]
+    tenants = [rng.choice([None, 1, 2]) for _ in profiles]
+    candidate_rows = [snapshot.index.candidate_rows(tenant_id, tag_scores, now=50.0)
+                      for (tag_scores, _), tenant_id in zip(profiles, tenants)]
+
+    ranked = NumpyScorer().rank_many(snapshot, profiles, ad_ctrs, 10, ctr_version=1, candidate_rows=candidate_rows)
+    for (tag_scores, exclude), tenant_id, rows, ad_ranking in zip(profiles, tenants, candidate_rows, ranked):
+        candidates = snapshot.index.ad_ids[rows].tolist()
+        assert ad_ranking == rank_ads_python(ads, tag_scores, ad_ctrs, exclude, 10, candidates=candidates)
+        for ad_id in ad_ranking:
+            assert windows[ad_id][0] <= 50.0 < windows[ad_id][1]
+            assert tenant_id is None or snapshot.tenants[ad_id] == tenant_id
+            assert set(ads[ad_id]["tags"]) & set(tag_scores)
+
+
+def test_engines_agree_with_similarity_term():
+    rng = random.Random(13)
+    ads = {ad_id: {"id": ad_id, "name": f"Ad {ad_id}", "tags": tuple(rng.sample(TAGS, rng.randint(0, 2)))}
+           for ad_id in rng.sample(range(1, 3000), 300)}
+    snapshot = CatalogSnapshot(ads, {ad_id: 1 for ad_id in ads}, {}, version=1)
+    ad_ids = list(ads)
+    ad_ctrs = {ad_id: rng.choice([0.0, 0.1]) for ad_id in ad_ids}
+    profiles = [({tag: rng.random() for tag in rng.sample(TAGS, 1)}, set(rng.sample(ad_ids, 5))) for _ in range(80)]
+    # Similar ads without a shared tag become candidates through `ad_ids`
+    similarity = [{ad_id: rng.choice([0.25, 0.5]) for ad_id in rng.sample(ad_ids, 15)} for _ in profiles]
+    candidate_rows = [snapshot.index.candidate_rows(None, tag_scores, ad_ids=similar)
+                      for (tag_scores, _), similar in zip(profiles, similarity)]
+
+    ranked = NumpyScorer().rank_many(snapshot, profiles, ad_ctrs, 10, ctr_version=1,
+                                     candidate_rows=candidate_rows, similarity=similarity)
+    assert any(not set(ads[ad_id]["tags"]) & set(tag_scores)
+               for (tag_scores, _), ad_ranking in zip(profiles, ranked) for ad_id in ad_ranking)
+    for (tag_scores, exclude), rows, similar, ad_ranking in zip(profiles, candidate_rows, similarity, ranked):
+        candidates = snapshot.index.ad_ids[rows].tolist()
+        assert ad_ranking == rank_ads_python(ads, tag_scores, ad_ctrs, exclude, 10, candidates=candidates, similarity=similar)
+    tag_scores, exclude = profiles[0]
+    assert NumpyScorer().rank(snapshot, tag_scores, ad_ctrs, exclude, 10, similarity=similarity[0]) == \
+        rank_ads_python(ads, tag_scores, ad_ctrs, exclude, 10, similarity=similarity[0])
@@ -0,0 +1,69 @@
+import asyncio
+import threading
+import time
+
+import pytest
+from prometheus_client import REGISTRY
+
+from app.services.single_flight import SingleFlight
+
+
+def test_concurrent_threads_share_one_computation_and_its_error():
+    flight = SingleFlight("threads")
+    waiting = lambda: REGISTRY.get_sample_value("single_flight_calls_total", {"flight": "threads", "role": "follower"}) or 0
+    before = waiting()
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def compute():
+        calls.append(1)
+        started.set()
+        release.wait(2)
+        return [1, 2, 3]
+
+    results = []
+    leader = threading.Thread(target=lambda: results.append(flight.do("key", compute)))
+    leader.start()
+    assert started.wait(2)
+    followers = [threading.Thread(target=lambda: results.append(flight.do("key", compute))) for _ in range(4)]
+    for thread in followers:
+        thread.start()
+    while waiting() - before < 4: # Until all of them wait for the leader
+        time.sleep(0.01)
+    release.set()
+    for thread in [leader] + followers:
+        thread.join(2)
+    assert len(calls) == 1 and results == [[1, 2, 3]] * 5
+
+    def fail():
+        raise ConnectionError("MySQL is down")
+
+    with pytest.raises(ConnectionError):
+        flight.do("key", fail)
+    assert flight.do("key", lambda: "recomputed") == "recomputed" # Nothing is kept once it finished
+
+
+def test_coroutines_share_the_leaders_result_and_take_over_if_it_is_cancelled():
+    async def scenario():
+        flight = SingleFlight("test")
+        calls = []
+
+        async def compute():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return len(calls)
+
+        leader = asyncio.ensure_future(flight.do_async("user:7", compute))
+        await asyncio.sleep(0)
+        followers = [asyncio.ensure_future(flight.do_async("user:7", compute)) for _ in range(3)]
+        other = asyncio.ensure_future(flight.do_async("user:8", compute))
+        await asyncio.sleep(0.01)
+        leader.cancel() # Its client disconnected: one follower must compute instead
+        results = await asyncio.gather(*followers, other)
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return calls, results
+
+    calls, results = asyncio.run(scenario())
+    assert len(calls) == 3 # user:7 by the cancelled leader and by its successor, user:8 once
+    assert results[:3] == [results[0]] * 3
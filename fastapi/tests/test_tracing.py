@@ -0,0 +1,30 @@
+import json
+import os
+
+from sqlalchemy import create_engine, text
+
+from app.services import tracing
+
+
+def test_statements_are_recorded_only_inside_a_trace_and_old_traces_are_pruned(tmp_path):
+    engine = create_engine("sqlite://")
+    tracing.instrument_engine(engine)
+    with engine.connect() as conn:
+        conn.execute(text("SELECT 1")) # Untraced: nothing to record it in
+
+        paths = []
+        for _ in range(3):
+            with tracing.start("GET", "/recommend") as trace:
+                with tracing.span("history"):
+                    conn.execute(text("SELECT  2\n  AS two"))
+                tracing.record_span("score", 0.001)
+            paths.append(tracing.write(trace, str(tmp_path), keep=2))
+            os.utime(paths[-1], (len(paths), len(paths))) # Distinct mtimes, oldest first
+
+    assert tracing.current() is None
+    assert sorted(os.listdir(tmp_path)) == sorted(os.path.basename(path) for path in paths[1:])
+    with open(paths[-1]) as f:
+        written = json.load(f)
+    assert [query["statement"] for query in written["queries"]] == ["SELECT 2 AS two"]
+    assert [span["name"] for span in written["spans"]] == ["history", "score"] and "offset_ms" not in written["spans"][1]
+    assert trace.server_timing().startswith('sql;dur=') and 'desc="1 queries"' in trace.server_timing()
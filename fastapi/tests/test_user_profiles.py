@@ -0,0 +1,260 @@
+import threading
+import time
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import pytest
+from redis.exceptions import WatchError
+
+from app.services.user_profiles import UserProfiles
+
+DAY = 86400.0
+
+
+class FakePipeline:
+    """
+    Queues commands and runs them together, like a MULTI/EXEC transaction. After WATCH,
+    commands run immediately until MULTI, and EXEC fails if a watched key changed meanwhile.
+    """
+
+    def __init__(self, redis_client):
+        self.redis_client = redis_client
+        self.ops = []
+        self.watched = None
+
+    def __getattr__(self, command):
+        if self.watched is not None and not self.ops:
+            return getattr(self.redis_client, command)
+        return lambda *args, **kwargs: self.ops.append((command, args, kwargs))
+
+    def watch(self, key):
+        self.watched = (key, self.redis_client.versions.get(key, 0))
+
+    def multi(self):
+        self.ops.append(("multi", (), {}))
+
+    def reset(self):
+        self.ops, self.watched = [], None
+
+    def execute(self):
+        with self.redis_client.lock:
+            if self.watched is not None and self.redis_client.versions.get(self.watched[0], 0) != self.watched[1]:
+                raise WatchError()
+            return [getattr(self.redis_client, command)(*args, **kwargs) for command, args, kwargs in self.ops if command != "multi"]
+
+
+class FakeRedis:
+    def __init__(self):
+        self.hashes = {}
+        self.versions = {} # Bumped by every write, for WATCH
+        self.lock = threading.RLock()
+
+    def _changed(self, key):
+        self.versions[key] = self.versions.get(key, 0) + 1
+
+    def hgetall(self, key):
+        with self.lock:
+            fields = dict(self.hashes.get(key, {}))
+        time.sleep(0.001) # Lets other threads interleave, as a network round trip would
+        return fields
+
+    def hset(self, key, field=None, value=None, mapping=None):
+        with self.lock:
+            self._changed(key)
+            fields = self.hashes.setdefault(key, {})
+            if field is not None:
+                fields[field.encode()] = str(value).encode()
+            fields.update({name.encode(): str(value).encode() for name, value in (mapping or {}).items()})
+
+    def hincrbyfloat(self, key, field, amount):
+        with self.lock:
+            self._changed(key)
+            fields = self.hashes.setdefault(key, {})
+            fields[field.encode()] = repr(float(fields.get(field.encode(), 0.0)) + amount).encode()
+
+    def hsetnx(self, key, field, value):
+        with self.lock:
+            fields = self.hashes.setdefault(key, {})
+            if field.encode() not in fields:
+                self._changed(key)
+                fields[field.encode()] = str(value).encode()
+
+    def hdel(self, key, *fields):
+        with self.lock:
+            self._changed(key)
+            for field in fields:
+                self.hashes.get(key, {}).pop(field.encode(), None)
+
+    def delete(self, key):
+        with self.lock:
+            self._changed(key)
+            self.hashes.pop(key, None)
+
+    def expire(self, key, ttl):
+        pass
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+def _event(ad_id, event_type, days_ago):
+    return SimpleNamespace(ad_id=ad_id, event_type=event_type, occurred_at=datetime.now() - timedelta(days=days_ago))
+
+
+ADS = {1: {"tags": ("fashion", "sale")}, 2: {"tags": ("tech",)}}
+
+
+def test_scores_decay_with_the_configured_half_life():
+    profiles = UserProfiles(lambda: None, half_life_days=1, epoch=0.0)
+    profiles.materialize(7, [], ADS)
+    profiles.record(7, 2, ["tech"], "click", timestamp=DAY)
+    profiles.record(7, 1, ["sale"], "click", timestamp=2 * DAY)
+    profile = profiles.get(7)
+    # Scaled by 2^(days since the epoch): a day-old click weighs half as much as a new one
+    assert profile.tag_scores == {"tech": pytest.approx(2.0), "sale": pytest.approx(4.0)}
+    assert profiles.tag_profile(profile)[0] == {"tech": pytest.approx(1 / 3), "sale": pytest.approx(2 / 3)}
+    # Late events count with the weight they had when they happened, whatever the arrival order
+    profiles.record(7, 3, ["tech"], "click", timestamp=DAY)
+    assert profiles.tag_profile(profile)[0] == {"tech": pytest.approx(0.5), "sale": pytest.approx(0.5)}
+
+
+def test_only_the_most_recent_ads_are_remembered():
+    redis_client = FakeRedis()
+    profiles = UserProfiles(lambda: redis_client, max_ads=3)
+    profiles.materialize(7, [], ADS)
+    for ad_id in range(5):
+        profiles.record(7, ad_id, [], "click", timestamp=float(ad_id + 1))
+    assert set(profiles.get(7).ad_ids) == {2, 3, 4}
+    assert len(redis_client.hashes["profile:v2:7"]) == 5 # The markers and the three most recent ads
+
+
+def test_profiles_round_trip_through_redis():
+    redis_client = FakeRedis()
+    writer = UserProfiles(lambda: redis_client)
+    reader = UserProfiles(lambda: redis_client)
+    written = writer.materialize(7, [_event(1, "click", 2), _event(2, "impression", 1)], ADS)
+
+    read = reader.get(7)
+    assert read.tag_scores == pytest.approx(written.tag_scores)
+    assert read.ad_ids == pytest.approx(written.ad_ids)
+    tag_scores, interacted = reader.tag_profile(read)
+    assert interacted == {1, 2}
+    assert sum(tag_scores.values()) == pytest.approx(1.0)
+
+
+def test_events_only_update_existing_profiles():
+    profiles = UserProfiles(lambda: None)
+    profiles.record(7, 2, ["tech"], "click")
+    assert profiles.get(7) is None # Built from the events table on the next recommendation
+
+    empty = profiles.materialize(7, [], ADS)
+    assert empty.updated_at and not empty.ad_ids # "No history" is remembered too
+    profiles.record(7, 2, ["tech"], "click")
+    profiles.record(7, 2, ["tech"], "conversion") # Unweighted event types are ignored
+    assert profiles.tag_profile(profiles.get(7))[0] == {"tech": pytest.approx(1.0)}
+    assert set(profiles.get(7).ad_ids) == {2}
+
+
+def test_local_profiles_expire():
+    profiles = UserProfiles(lambda: None, local_ttl=0)
+    profiles.materialize(7, [_event(1, "click", 1)], ADS)
+    assert profiles.get(7) is None
+
+
+def test_concurrent_events_of_a_user_are_all_counted():
+    redis_client = FakeRedis()
+    profiles = UserProfiles(lambda: redis_client, epoch=time.time())
+    profiles.materialize(7, [], ADS)
+    now = time.time()
+
+    def log_clicks(ad_id, tag):
+        for _ in range(20):
+            profiles.record(7, ad_id, [tag], "click", timestamp=now)
+            profiles.get(7) # Readers running alongside must not get in the way either
+
+    threads = [threading.Thread(target=log_clicks, args=(ad_id, tag)) for ad_id, tag in ((1, "sale"), (2, "tech"), (3, "tech"))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    profile = UserProfiles(lambda: redis_client, epoch=now).get(7)
+    assert profile.tag_scores == {"sale": pytest.approx(20.0), "tech": pytest.approx(40.0)}
+    assert set(profile.ad_ids) == {1, 2, 3}
+
+
+def test_events_logged_before_the_profile_is_materialized_are_merged_in():
+    redis_client = FakeRedis()
+    now = float(int(time.time())) # Whole seconds, like logged events, so the events table row matches exactly
+    profiles = UserProfiles(lambda: redis_client, epoch=now, half_life_days=1)
+    profiles.record(7, 2, ["tech"], "click", timestamp=now)
+    assert profiles.get(7) is None # Only a partial hash; the profile is built from the events table
+
+    # The click is not in the events table yet, the older one is; an event table row as recent as
+    # the partial hash is already counted in it
+    history = [SimpleNamespace(ad_id=1, event_type="click", occurred_at=datetime.fromtimestamp(now - DAY)),
+               SimpleNamespace(ad_id=2, event_type="click", occurred_at=datetime.fromtimestamp(now))]
+    materialized = profiles.materialize(7, history, ADS)
+    profile = UserProfiles(lambda: redis_client, epoch=now, half_life_days=1).get(7)
+    assert set(profile.ad_ids) == {1, 2}
+    assert profile.tag_scores == pytest.approx(materialized.tag_scores)
+    assert profiles.tag_profile(profile)[0] == {"tech": pytest.approx(0.5), "fashion": pytest.approx(0.25), "sale": pytest.approx(0.25)}
+
+    # From now on events are added to the profile
+    profiles.record(7, 2, ["tech"], "click", timestamp=now)
+    assert profiles.tag_profile(profiles.get(7))[0]["tech"] == pytest.approx(2 / 3)
+
+
+def test_an_event_logged_while_materializing_is_not_lost():
+    redis_client = FakeRedis()
+    now = time.time()
+    profiles = UserProfiles(lambda: redis_client, epoch=now)
+    profiles.record(7, 2, ["tech"], "click", timestamp=now)
+    hgetall = redis_client.hgetall
+
+    def racing_hgetall(key):
+        fields = hgetall(key)
+        if redis_client.hgetall is racing_hgetall:
+            redis_client.hgetall = hgetall
+            profiles.record(7, 3, ["tech"], "click", timestamp=now) # Lands between the read and the write
+        return fields
+    redis_client.hgetall = racing_hgetall
+
+    profiles.materialize(7, [], ADS)
+    profile = profiles.get(7)
+    assert set(profile.ad_ids) == {2, 3}
+    assert profile.tag_scores["tech"] == pytest.approx(2.0)
+
+
+def test_a_batch_of_events_is_one_pipeline_grouped_per_user():
+    redis_client = FakeRedis()
+    executed = []
+    redis_client.pipeline = lambda transaction=True: executed.append(FakePipeline(redis_client)) or executed[-1]
+    profiles = UserProfiles(lambda: redis_client, epoch=0.0, half_life_days=1)
+    profiles.materialize(7, [], ADS)
+    profiles.materialize(8, [], ADS)
+    executed.clear()
+
+    profiles.record_many([(7, 1, ["fashion", "sale"], "click", DAY, None), (8, 2, ["tech"], "impression", DAY, None),
+                          (7, 1, ["fashion", "sale"], "impression", 2 * DAY, None), (7, 2, ["tech"], "conversion", DAY, None)])
+    assert len(executed) == 1
+    assert [op[0] for op in executed[0].ops] == ["hincrbyfloat", "hincrbyfloat", "hset", "hsetnx", "expire",
+                                                 "hincrbyfloat", "hset", "hsetnx", "expire"]
+    profile = profiles.get(7)
+    assert profile.tag_scores == {"fashion": pytest.approx(2.0 + 2.0), "sale": pytest.approx(2.0 + 2.0)}
+    assert profile.ad_ids == {1: 2 * DAY}
+
+
+def test_tenant_profiles_only_see_the_events_of_their_tenant():
+    redis_client = FakeRedis()
+    profiles = UserProfiles(lambda: redis_client)
+    profiles.materialize(7, [_event(1, "click", 1)], ADS) # Across tenants
+    profiles.materialize(7, [], ADS, tenant_id=2)
+    assert profiles.get(7, tenant_id=1) is None # Not materialized for that tenant yet
+
+    profiles.record(7, 2, ["tech"], "click", tenant_id=2)
+    profiles.record(7, 3, ["travel"], "click", tenant_id=3)
+    assert set(profiles.get(7).ad_ids) == {1, 2, 3}
+    assert set(profiles.get(7, tenant_id=2).ad_ids) == {2}
+    assert profiles.tag_profile(profiles.get(7, tenant_id=2))[0] == {"tech": pytest.approx(1.0)}
+    assert "profile:v2:2:7" in redis_client.hashes